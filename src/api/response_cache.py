@@ -0,0 +1,107 @@
+"""
+Bounded LRU cache of the API responses. The key is the normalized query (parse_query
+in segment_api.py) and the data version, so a response of an older version of the
+segments is never served; the cache is also cleared when new segments are loaded.
+The size of the cache is limited by the total bytes of the cached bodies (raw and
+gzipped) and optionally the number of entries. Hits, misses, and evictions are counted.
+Created by: Apoorba Bibeka
+"""
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 64 * 1024**2
+# Rough per entry overhead (key, dict, OrderedDict node) added to the body size.
+ENTRY_OVERHEAD_BYTES = 512
+
+
+def new_response_cache(max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+    """
+    Create an empty response cache.
+    Parameters
+    ----------
+    max_bytes: int
+        Maximum total size of the cached responses. 0 disables the cache.
+    max_entries: int
+        Maximum number of cached responses. None for no limit.
+    """
+    return {
+        "entries": OrderedDict(),
+        "num_bytes": 0,
+        "max_bytes": max_bytes,
+        "max_entries": max_entries,
+        "hits": 0,
+        "misses": 0,
+        "evictions": 0,
+        "invalidations": 0,
+        "lock": threading.Lock(),
+    }
+
+
+def get_cache_key(params, version):
+    """
+    Cache key of a parsed query. Parameters are sorted by name so that the order in
+    the url does not matter.
+    """
+    return (version,) + tuple(sorted(params.items()))
+
+
+def cache_get(cache, key):
+    """
+    Get the cached response of key (and mark it as recently used) or None.
+    """
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is None:
+            cache["misses"] += 1
+            return None
+        cache["entries"].move_to_end(key)
+        cache["hits"] += 1
+        return entry["value"]
+
+
+def cache_put(cache, key, value, num_bytes):
+    """
+    Cache value (num_bytes in size) under key and evict the least recently used
+    responses until the cache is within its limits. Values larger than the cache are
+    not stored.
+    """
+    num_bytes += ENTRY_OVERHEAD_BYTES
+    if num_bytes > cache["max_bytes"]:
+        return
+    with cache["lock"]:
+        entries = cache["entries"]
+        if key in entries:
+            cache["num_bytes"] -= entries.pop(key)["num_bytes"]
+        entries[key] = {"value": value, "num_bytes": num_bytes}
+        cache["num_bytes"] += num_bytes
+        while cache["num_bytes"] > cache["max_bytes"] or (
+            cache["max_entries"] is not None and len(entries) > cache["max_entries"]
+        ):
+            _, evicted = entries.popitem(last=False)
+            cache["num_bytes"] -= evicted["num_bytes"]
+            cache["evictions"] += 1
+
+
+def cache_clear(cache):
+    """
+    Drop all the cached responses, e.g. when new segments are published.
+    """
+    with cache["lock"]:
+        cache["entries"].clear()
+        cache["num_bytes"] = 0
+        cache["invalidations"] += 1
+
+
+def get_cache_stats(cache):
+    with cache["lock"]:
+        num_lookups = cache["hits"] + cache["misses"]
+        return {
+            "num_entries": len(cache["entries"]),
+            "num_bytes": cache["num_bytes"],
+            "max_bytes": cache["max_bytes"],
+            "hits": cache["hits"],
+            "misses": cache["misses"],
+            "hit_rate": cache["hits"] / num_lookups if num_lookups > 0 else None,
+            "evictions": cache["evictions"],
+            "invalidations": cache["invalidations"],
+        }
@@ -0,0 +1,502 @@
+"""
+Small asyncio HTTP API that serves the scored segments to the dashboard. The final
+layer is loaded once into memory with a spatial index (bounding box queries), a
+route and milepost interval index, and a county index.
+Endpoints:
+    GET /segments?bbox=minx,miny,maxx,maxy&route_id=...&mp_from=...&mp_to=...
+        &county=...&fields=a,b&limit=...&offset=...
+        Filters are combined with "and". mp selects the segment at one milepost.
+        Returns compact GeoJSON; the number of matched segments is in the
+        X-Total-Count header. Responses are gzipped when the client accepts it.
+    GET /health
+        Number of segments, the data version, and the response cache statistics.
+Responses of /segments are cached (response_cache.py). The segment file is checked
+every few seconds; a new version is loaded and the cache cleared.
+Run: python -m src.api.segment_api --port 8080
+Created by: Apoorba Bibeka
+"""
+import os
+import json
+import gzip
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import geopandas as gpd
+from src.utils import get_project_root
+from src.data.aadt_crash_merge import get_route_ranges
+from src.visualization.compact_geojson import to_compact_geojson
+from src.api.response_cache import DEFAULT_MAX_BYTES
+from src.api.response_cache import new_response_cache
+from src.api.response_cache import get_cache_key
+from src.api.response_cache import cache_get
+from src.api.response_cache import cache_put
+from src.api.response_cache import cache_clear
+from src.api.response_cache import get_cache_stats
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+MIN_GZIP_BYTES = 1024
+MAX_HEADER_BYTES = 16384
+# Seconds between checks of the segment file for a new version.
+REFRESH_SECONDS = 5
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+def get_data_version(path_segments):
+    """
+    Version of the segment file from its modification time and size.
+    """
+    file_stat = os.stat(path_segments)
+    return f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+
+
+def build_segment_index(segment_gdf_, version=""):
+    """
+    Build the in-memory indexes of the scored segments.
+    Parameters
+    ----------
+    segment_gdf_: gpd.GeoDataFrame()
+        Scored segments with route_id, aadt_interval_left, aadt_interval_right, and
+        route_county, e.g. if_si_detour_nat_imp_census_padt.gpkg.
+    version: str
+        Data version.
+    Returns
+    -------
+    segment_index: dict
+        gdf: segments sorted by route and milepost; the index is seg_id when
+        available (feature id in the GeoJSON).
+        sindex: spatial index of gdf.
+        route_ranges: {route_id: (first row, last row + 1)}.
+        interval_left, interval_right_cummax: interval starts and running maximum of
+        the interval ends along each route.
+        county_rows: {county: rows}.
+        fields: columns that can be requested.
+        version: data version.
+    """
+    if segment_gdf_.crs is not None and segment_gdf_.crs.to_epsg() != 4326:
+        segment_gdf_ = segment_gdf_.to_crs(epsg=4326)
+    segment_gdf_ = segment_gdf_.assign(
+        route_id=lambda df: df.route_id.astype(str)
+    ).sort_values(["route_id", "aadt_interval_left"], kind="mergesort")
+    segment_gdf_.index = (
+        segment_gdf_.seg_id.values
+        if "seg_id" in segment_gdf_.columns
+        else np.arange(len(segment_gdf_))
+    )
+    route_ids = segment_gdf_.route_id.values
+    route_ranges = get_route_ranges(route_ids)
+    interval_right_cummax = segment_gdf_.aadt_interval_right.values.astype(float)
+    for route_st, route_end in route_ranges.values():
+        interval_right_cummax[route_st:route_end] = np.maximum.accumulate(
+            interval_right_cummax[route_st:route_end]
+        )
+    county_rows = {
+        str(int(county)): np.sort(rows)
+        for county, rows in segment_gdf_.reset_index(drop=True)
+        .groupby("route_county")
+        .indices.items()
+    }
+    return {
+        "gdf": segment_gdf_,
+        "sindex": segment_gdf_.sindex,
+        "route_ranges": route_ranges,
+        "interval_left": segment_gdf_.aadt_interval_left.values.astype(float),
+        "interval_right_cummax": interval_right_cummax,
+        "county_rows": county_rows,
+        "fields": [
+            col for col in segment_gdf_.columns if col != segment_gdf_.geometry.name
+        ],
+        "version": version,
+    }
+
+
+def load_segment_index(path_segments):
+    """
+    Read the scored segments and build the indexes.
+    """
+    # Version before the read: a file replaced during the read gets a new version and
+    # is loaded again by watch_segment_file.
+    version = get_data_version(path_segments)
+    segment_gdf = gpd.read_file(path_segments, driver="gpkg")
+    return build_segment_index(segment_gdf, version=version)
+
+
+def parse_query(query_string, segment_index):
+    """
+    Parse and normalize the query parameters of /segments.
+    Raises
+    ------
+    ValueError
+        If a parameter is not valid.
+    """
+    query = {key: values[-1] for key, values in parse_qs(query_string).items()}
+    unknown_params = set(query) - {
+        "bbox",
+        "route_id",
+        "mp",
+        "mp_from",
+        "mp_to",
+        "county",
+        "fields",
+        "limit",
+        "offset",
+    }
+    if unknown_params:
+        raise ValueError(f"Unknown parameters: {sorted(unknown_params)}")
+    params = {}
+    if "bbox" in query:
+        bbox = [float(value) for value in query["bbox"].split(",")]
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("bbox should be minx,miny,maxx,maxy.")
+        params["bbox"] = tuple(bbox)
+    if "route_id" in query:
+        params["route_id"] = query["route_id"].split(".")[0]
+    if "mp" in query:
+        if "mp_from" in query or "mp_to" in query:
+            raise ValueError("Use mp or mp_from and mp_to.")
+        params["mp"] = float(query["mp"])
+    else:
+        for key in ["mp_from", "mp_to"]:
+            if key in query:
+                params[key] = float(query[key])
+    if ("mp" in params or "mp_from" in params or "mp_to" in params) and (
+        "route_id" not in params
+    ):
+        raise ValueError("Milepost filters need a route_id.")
+    if "county" in query:
+        params["county"] = str(int(query["county"]))
+    if "fields" in query:
+        fields = [field for field in query["fields"].split(",") if field != ""]
+        unknown_fields = set(fields) - set(segment_index["fields"])
+        if unknown_fields:
+            raise ValueError(f"Unknown fields: {sorted(unknown_fields)}")
+        params["fields"] = tuple(fields)
+    params["limit"] = int(query.get("limit", DEFAULT_LIMIT))
+    params["offset"] = int(query.get("offset", 0))
+    if not (0 <= params["limit"] <= MAX_LIMIT) or params["offset"] < 0:
+        raise ValueError(f"limit should be 0 to {MAX_LIMIT} and offset >= 0.")
+    return params
+
+
+def get_route_mp_rows(segment_index, route_id, mp_from=-np.inf, mp_to=np.inf):
+    """
+    Rows of the segments on route_id that overlap [mp_from, mp_to]; with mp_from ==
+    mp_to, the segment that contains the milepost.
+    """
+    if route_id not in segment_index["route_ranges"]:
+        return np.array([], dtype=np.int64)
+    route_st, route_end = segment_index["route_ranges"][route_id]
+    interval_left = segment_index["interval_left"][route_st:route_end]
+    interval_right_cummax = segment_index["interval_right_cummax"][route_st:route_end]
+    # Segments before lo end at or before mp_from; segments from hi on start after
+    # mp_to.
+    lo = np.searchsorted(interval_right_cummax, mp_from, side="right")
+    hi = np.searchsorted(interval_left, mp_to, side="right")
+    rows = np.arange(lo, max(lo, hi))
+    interval_right = segment_index["gdf"].aadt_interval_right.values[route_st:route_end]
+    return rows[interval_right[rows] > mp_from] + route_st
+
+
+def query_segments(segment_index, params):
+    """
+    Get the rows of the segments that match the filters in params (sorted by route
+    and milepost).
+    """
+    rows = None
+
+    def combine(rows_, new_rows):
+        return new_rows if rows_ is None else np.intersect1d(rows_, new_rows)
+
+    if "county" in params:
+        rows = combine(
+            rows,
+            segment_index["county_rows"].get(
+                params["county"], np.array([], dtype=np.int64)
+            ),
+        )
+    if "route_id" in params:
+        mp_from = params.get("mp", params.get("mp_from", -np.inf))
+        mp_to = params.get("mp", params.get("mp_to", np.inf))
+        rows = combine(
+            rows,
+            get_route_mp_rows(segment_index, params["route_id"], mp_from, mp_to),
+        )
+    if "bbox" in params:
+        bbox_rows = np.sort(
+            np.fromiter(
+                segment_index["sindex"].intersection(params["bbox"]), dtype=np.int64
+            )
+        )
+        rows = combine(rows, bbox_rows)
+    if rows is None:
+        rows = np.arange(len(segment_index["gdf"]))
+    return rows
+
+
+def get_segments_body(segment_index, params):
+    """
+    Query the segments and serialize one page to compact GeoJSON.
+    Returns
+    -------
+    (body, num_matched): tuple
+        body: GeoJSON bytes.
+        num_matched: number of segments that match the filters (all pages).
+    """
+    rows = query_segments(segment_index, params)
+    page_rows = rows[params["offset"] : params["offset"] + params["limit"]]
+    page_gdf = segment_index["gdf"].iloc[page_rows]
+    body = to_compact_geojson(
+        page_gdf, properties=params.get("fields", segment_index["fields"])
+    ).encode("utf-8")
+    return body, len(rows)
+
+
+def new_api_state(segment_index, cache_max_bytes=DEFAULT_MAX_BYTES, path_segments=None):
+    """
+    State shared by the connections: the current segment index, the response cache,
+    and the segment file that is watched for new versions (None to not watch).
+    """
+    return {
+        "segment_index": segment_index,
+        "cache": new_response_cache(max_bytes=cache_max_bytes),
+        "path_segments": path_segments,
+    }
+
+
+def get_response(api_state, method, target, headers):
+    """
+    Get the status, headers, and body for a request. /segments responses are served
+    from the cache when the same query was answered for the current data version.
+    The body is gzipped when the client accepts it.
+    """
+    segment_index = api_state["segment_index"]
+    if method != "GET":
+        return 405, {}, json.dumps({"error": "Only GET is supported."}).encode()
+    url = urlsplit(target)
+    if url.path == "/health":
+        body = json.dumps(
+            {
+                "num_segments": len(segment_index["gdf"]),
+                "version": segment_index["version"],
+                "cache": get_cache_stats(api_state["cache"]),
+            }
+        ).encode()
+        return 200, {"Content-Type": "application/json"}, body
+    if url.path != "/segments":
+        return 404, {}, json.dumps({"error": f"Unknown path {url.path}"}).encode()
+    try:
+        params = parse_query(url.query, segment_index)
+    except ValueError as err:
+        return 400, {}, json.dumps({"error": str(err)}).encode()
+    cache_key = get_cache_key(params, segment_index["version"])
+    cached_response = cache_get(api_state["cache"], cache_key)
+    if cached_response is None:
+        body, num_matched = get_segments_body(segment_index, params)
+        # The gzipped body is cached with the body so that hits are not compressed
+        # again.
+        cached_response = {
+            "body": body,
+            "gzip_body": (
+                gzip.compress(body, compresslevel=5)
+                if len(body) >= MIN_GZIP_BYTES
+                else None
+            ),
+            "num_matched": num_matched,
+        }
+        cache_put(
+            api_state["cache"],
+            cache_key,
+            cached_response,
+            num_bytes=len(body) + len(cached_response["gzip_body"] or b""),
+        )
+    response_headers = {
+        "Content-Type": "application/geo+json",
+        "X-Total-Count": str(cached_response["num_matched"]),
+        "X-Data-Version": segment_index["version"],
+    }
+    if (
+        "gzip" in headers.get("accept-encoding", "")
+        and cached_response["gzip_body"] is not None
+    ):
+        response_headers["Content-Encoding"] = "gzip"
+        return 200, response_headers, cached_response["gzip_body"]
+    return 200, response_headers, cached_response["body"]
+
+
+def encode_response(status, response_headers, body, keep_alive):
+    """
+    Build the HTTP/1.1 response bytes.
+    """
+    response_headers = {
+        "Content-Type": "application/json",
+        **response_headers,
+        "Content-Length": str(len(body)),
+        "Connection": "keep-alive" if keep_alive else "close",
+        "Access-Control-Allow-Origin": "*",
+    }
+    head = f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in response_headers.items()
+    )
+    return head.encode("latin-1") + b"\r\n" + body
+
+
+def get_response_bytes(api_state, method, target, headers, keep_alive):
+    """
+    Get the HTTP/1.1 response bytes for a request: the query, serialization, and
+    compression (on a cache miss). Runs in the thread pool.
+    """
+    try:
+        status, response_headers, body = get_response(
+            api_state, method, target, headers
+        )
+    except Exception as err:
+        status, response_headers, body = (
+            500,
+            {},
+            json.dumps({"error": str(err)}).encode(),
+        )
+    return encode_response(status, response_headers, body, keep_alive)
+
+
+async def handle_connection(reader, writer, api_state, executor):
+    """
+    Serve the requests on one connection (keep-alive). The query, serialization, and
+    compression run in the thread pool so that the event loop only reads and writes
+    the sockets.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                request_head = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+            except asyncio.LimitOverrunError:
+                writer.write(encode_response(400, {}, b"{}", False))
+                break
+            request_lines = request_head.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = request_lines[0].split(" ")
+            except ValueError:
+                writer.write(encode_response(400, {}, b"{}", False))
+                break
+            headers = {}
+            for line in request_lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            keep_alive = (
+                headers.get("connection", "").lower() != "close"
+                and version == "HTTP/1.1"
+            )
+            response = await loop.run_in_executor(
+                executor,
+                get_response_bytes,
+                api_state,
+                method,
+                target,
+                headers,
+                keep_alive,
+            )
+            writer.write(response)
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+
+
+async def watch_segment_file(api_state, executor, refresh_seconds=REFRESH_SECONDS):
+    """
+    Reload the segments and clear the response cache when the pipeline publishes a
+    new version of the segment file.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(refresh_seconds)
+        try:
+            version = get_data_version(api_state["path_segments"])
+            if version == api_state["segment_index"]["version"]:
+                continue
+            segment_index = await loop.run_in_executor(
+                executor, load_segment_index, api_state["path_segments"]
+            )
+        except Exception as err:
+            # E.g. the file is being written; try again at the next check.
+            print(f"Could not reload {api_state['path_segments']}: {err}")
+            continue
+        api_state["segment_index"] = segment_index
+        cache_clear(api_state["cache"])
+        print(f"Loaded version {segment_index['version']} of the segments.")
+
+
+async def start_server(
+    api_state, host="127.0.0.1", port=8080, n_jobs=4, refresh_seconds=REFRESH_SECONDS
+):
+    """
+    Start the API server (and the segment file watcher when api_state has a
+    path_segments); returns the asyncio server.
+    """
+    executor = ThreadPoolExecutor(max_workers=n_jobs)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, api_state, executor),
+        host=host,
+        port=port,
+        limit=MAX_HEADER_BYTES,
+        backlog=1024,
+    )
+    if api_state["path_segments"] is not None:
+        api_state["watch_task"] = asyncio.get_running_loop().create_task(
+            watch_segment_file(api_state, executor, refresh_seconds)
+        )
+    return server
+
+
+async def serve_forever(api_state, host="127.0.0.1", port=8080, n_jobs=4):
+    server = await start_server(api_state, host, port, n_jobs)
+    print(
+        f"Serving {len(api_state['segment_index']['gdf'])} segments on "
+        f"http://{host}:{port}"
+    )
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    parser = argparse.ArgumentParser(description="Scored segment API.")
+    parser.add_argument(
+        "--path",
+        default=os.path.join(
+            path_processed_data, "if_si_detour_nat_imp_census_padt.gpkg"
+        ),
+        help="Scored segment layer.",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--n-jobs", type=int, default=4, help="Query threads.")
+    parser.add_argument(
+        "--cache-mb", type=float, default=64, help="Response cache size (MB)."
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        serve_forever(
+            new_api_state(
+                load_segment_index(args.path),
+                cache_max_bytes=int(args.cache_mb * 1024**2),
+                path_segments=args.path,
+            ),
+            host=args.host,
+            port=args.port,
+            n_jobs=args.n_jobs,
+        )
+    )
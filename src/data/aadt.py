@@ -8,6 +8,13 @@ import os
 import pandas as pd
 from src.utils import get_project_root
 from src.utils import read_shp
+from src.data.validation import validate_df
+
+# Missing LRS values are errors; missing geometry is reported.
+AADT_RULES = [
+    {"rule": "not_null", "cols": ["route_id", "begin_mp", "end_mp", "aadt_2018"]},
+    {"rule": "not_null", "cols": ["geometry"], "severity": "warning"},
+]
 
 
 def add_aadt_new_cols_fix_dtypes(aadt_gdf_):
@@ -66,28 +73,28 @@ def test_aadt_df(aadt_gdf_):
     ----------
     aadt_gdf_: gpd.GeoDataFrame()
         NCDOT 2018 aadt data layer. Typical the spatial boundaries are at interchanges.
+    Returns
+    -------
+    violations_df_: pd.DataFrame()
+        Violations of AADT_RULES from validate_df.
     Raises
     -------
     AssertionError
         If there is a missing value for either "route_id", "begin_mp", "end_mp",
         or "aadt_2018"
     """
-    assert (
-        aadt_gdf_[["route_id", "begin_mp", "end_mp", "aadt_2018"]].isna().sum().sum()
-        == 0
-    ), (
+    violations_df_ = validate_df(aadt_gdf_, AADT_RULES)
+    assert (violations_df_.severity != "error").all(), (
         'Need to remove rows with missing "route_id", "begin_mp", "end_mp", or '
         '"aadt_2018"'
     )
     print("LRS system is complete.")
-    try:
-        if aadt_gdf_[["geometry"]].isna().sum().sum() != 0:
-            raise Exception(
-                "NA in geometry column needs to be handled before converting "
-                "crs or joining with other dataset."
-            )
-    except Exception as inst:
-        print(inst)
+    if len(violations_df_) != 0:
+        print(
+            "NA in geometry column needs to be handled before converting "
+            "crs or joining with other dataset."
+        )
+    return violations_df_
 
 
 if __name__ == "__main__":
@@ -103,7 +110,7 @@ if __name__ == "__main__":
     aadt_gdf = read_shp(aadt_file)
     # Test if there is missing values for AADT data.
     # ************************************************************************************
-    test_aadt_df(aadt_gdf)
+    aadt_violations_df = test_aadt_df(aadt_gdf)
     # Add new columns on route class, number, county, qual, inventory to the AADT data.
     # ************************************************************************************
     aadt_df_add_col = add_aadt_new_cols_fix_dtypes(aadt_gdf)
@@ -8,11 +8,30 @@ import pandas as pd
 import geopandas as gpd
 from src.utils import get_project_root
 from src.utils import reorder_columns
+from src.utils import get_seg_ids
 import numpy as np
 from src.data.crash import get_severity_index
+from src.data.crash import get_severity_index_matrix
+from src.data.hilbert_order import write_hilbert_ordered
+from src.profiling import new_trace
+from src.profiling import profile_stage
+from src.profiling import write_trace
+from src.profiling import get_peak_rss_mb
+from src.diagnostics import new_diagnostics
+from src.diagnostics import record_many
+from src.diagnostics import get_diagnostics_summary
+from src.diagnostics import write_diagnostics
 
 
-def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
+def merge_aadt_crash(
+    aadt_gdf_,
+    crash_gdf_,
+    crash_num_years=5,
+    quiet=True,
+    extra_cnt_cols=(),
+    low_memory=False,
+    diagnostics=None,
+):
     """
     Function for merging AADT and Crash data.
     Parameters
@@ -25,6 +44,16 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
         Number of years for which crash data is reported. Generally it's 5 years.
     quiet: bool
         False, for debug mode.
+    extra_cnt_cols: tuple
+        Additional crash count columns (e.g. per-year counts "total_cnt_2015") that are
+        scaled by segment length and summed over the AADT intervals like the ka, bc,
+        pdo, and total counts.
+    low_memory: bool
+        True, to use merge_aadt_crash_low_memory, which gives the same output without
+        copying the route groups.
+    diagnostics: dict
+        Collector from src.diagnostics.new_diagnostics for the overlapping AADT
+        intervals and routes without crash data. None, to print only a summary.
     Returns
     -------
     aadt_crash_gdf_ : gpd.GeoDataFrame()
@@ -32,6 +61,18 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
     aadt_but_no_crash_route_set : set
         Set of route IDs with AADT data that doesn't have associated crash data.
     """
+    if low_memory:
+        return merge_aadt_crash_low_memory(
+            aadt_gdf_=aadt_gdf_,
+            crash_gdf_=crash_gdf_,
+            crash_num_years=crash_num_years,
+            quiet=quiet,
+            extra_cnt_cols=extra_cnt_cols,
+            diagnostics=diagnostics,
+        )
+    print_summary = diagnostics is None
+    if diagnostics is None:
+        diagnostics = new_diagnostics("merge_aadt_crash")
     # Group data by route #, county, route qual.
     aadt_grp = aadt_gdf_.groupby(["route_id"])
     crash_grp = crash_gdf_.groupby(["route_gis"])
@@ -46,16 +87,15 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
     for aadt_grp_key in aadt_grp_keys:
         aadt_grp_sub = aadt_grp.get_group(aadt_grp_key).copy()
         # Bin the crash start milepost and end milepost based on AADT.
-        aadt_bin_df_dict = get_aadt_bin(aadt_grp_sub_=aadt_grp_sub)
+        aadt_bin_df_dict = get_aadt_bin(
+            aadt_grp_sub_=aadt_grp_sub, diagnostics=diagnostics
+        )
         aadt_grp_sub_dict[aadt_grp_key] = aadt_bin_df_dict["aadt_grp_sub_1"]
         if not quiet:
-            print(
-                f"Now processing route {aadt_grp_key}; {aadt_grp_sub[['route_class','route_qual', 'route_no', 'route_county']].head(1)}"
-            )
+            print(f"Now processing route {aadt_grp_key}")
         try:
             crash_grp_sub = crash_grp.get_group(aadt_grp_key).copy()
-        except KeyError as err:
-            print(f"No Crash data for route {err.args}")
+        except KeyError:
             aadt_but_no_crash_route_list_.append(aadt_grp_key)
             # continue
         else:
@@ -80,10 +120,15 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
         if len(value) == 0:
             aadt_but_no_crash_route_list_.append(key)
     aadt_but_no_crash_route_set_ = set(aadt_but_no_crash_route_list_)
+    record_many(diagnostics, "no_crash_data", sorted(aadt_but_no_crash_route_set_))
+    if print_summary:
+        print(get_diagnostics_summary(diagnostics))
 
+    extra_cnt_cols = list(extra_cnt_cols)
     if len(crash_grp_sub_no_empty_df_set) == 0:
         aadt_crash_df_ = (
             aadt_gdf_1.assign(
+                **{col: np.nan for col in extra_cnt_cols},
                 aadt_interval_left=lambda df: pd.IntervalIndex(df.aadt_interval).left,
                 aadt_interval_right=lambda df: pd.IntervalIndex(df.aadt_interval).right,
                 st_end_diff_aadt=lambda df: df.st_end_diff,
@@ -102,6 +147,7 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
             )
             .filter(
                 items=[
+                    "seg_id",
                     "route_id",
                     "route_class",
                     "route_qual",
@@ -126,6 +172,7 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
                     "crash_rate_per_mile_per_year",
                     "geometry_aadt",
                 ]
+                + extra_cnt_cols
             )
             .sort_values(["route_id", "aadt_interval_left"])
         )
@@ -151,14 +198,17 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
                 "shape_len_mi",
                 "st_end_diff",
                 "geometry",
-            ],
+            ]
+            + extra_cnt_cols,
         ]
         .drop_duplicates(["route_gis", "aadt_interval", "st_mp_pt"])
         .sort_values(["route_gis", "st_mp_pt"])
     )
     # Change the crash frequency in a segment based on the AADT interval length and
     # position. Consider crashes to be uniform distributed along the length.
-    crash_gdf_adj_crash_by_len = scale_crash_by_seg_len(crash_gdf_no_duplicates)
+    crash_gdf_adj_crash_by_len = scale_crash_by_seg_len(
+        crash_gdf_no_duplicates, extra_cnt_cols=extra_cnt_cols
+    )
     # Aggregate crash fields based on AADT intervals.
     # dissolve() is the groupby implementation with spatial attributes (geometry column)
     crash_gdf_adj_crash_by_len_dissolve = crash_gdf_adj_crash_by_len.dissolve(
@@ -172,6 +222,7 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
             "end_mp_pt": "max",
             "st_end_diff": "sum",
             "seg_len_in_interval": "sum",
+            **{col: "sum" for col in extra_cnt_cols},
         },
     ).reset_index()
     # Compute severity index on the new crash data boundaries correponding to the AADT
@@ -198,6 +249,7 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
         )
         .filter(
             items=[
+                "seg_id",
                 "route_id",
                 "route_class",
                 "route_qual",
@@ -222,6 +274,7 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
                 "crash_rate_per_mile_per_year",
                 "geometry_aadt",
             ]
+            + extra_cnt_cols
         )
         .sort_values(["route_id", "aadt_interval_left"])
     )
@@ -232,13 +285,289 @@ def merge_aadt_crash(aadt_gdf_, crash_gdf_, crash_num_years=5, quiet=True):
     return aadt_crash_gdf_, aadt_but_no_crash_route_set_
 
 
-def get_aadt_bin(aadt_grp_sub_):
+def get_route_ranges(route_ids):
+    """
+    Get the row range of each route in route_ids sorted by route.
+    Returns
+    -------
+    dict
+        {route_id: (first row, last row + 1)}
+    """
+    if len(route_ids) == 0:
+        return {}
+    route_st = np.flatnonzero(np.concatenate([[True], route_ids[1:] != route_ids[:-1]]))
+    route_end = np.concatenate([route_st[1:], [len(route_ids)]])
+    return {
+        route_ids[st]: (st, end)
+        for st, end in zip(route_st.tolist(), route_end.tolist())
+    }
+
+
+def merge_aadt_crash_low_memory(
+    aadt_gdf_,
+    crash_gdf_,
+    crash_num_years=5,
+    quiet=True,
+    extra_cnt_cols=(),
+    diagnostics=None,
+):
+    """
+    Low memory version of merge_aadt_crash with the same output. Both tables are
+    sorted once by route and milepost, and each route is processed on index ranges of
+    numpy arrays of the needed columns; the route groups are not copied, the crash
+    geometries are not dissolved (only the AADT geometry is in the output), and only
+    the output columns are built. The overlapping AADT intervals, duplicate crash
+    sections, and crash length scaling are handled as in get_aadt_bin, bin_aadt_crash,
+    and scale_crash_by_seg_len.
+    Parameters
+    ----------
+    aadt_gdf_ : gpd.GeoDataFrame()
+        AADT data.
+    crash_gdf_: gpd.GeoDataFrame()
+        Crash data.
+    crash_num_years : int
+        Number of years for which crash data is reported.
+    quiet: bool
+        False, to print the peak memory of the process at the end.
+    extra_cnt_cols: tuple
+        Additional crash count columns.
+    diagnostics: dict
+        Collector for the overlapping AADT intervals and routes without crash data.
+    Returns
+    -------
+    aadt_crash_gdf_ : gpd.GeoDataFrame()
+        Merged AADT and Crash data.
+    aadt_but_no_crash_route_set : set
+        Set of route IDs with AADT data that doesn't have associated crash data.
+    """
+    print_summary = diagnostics is None
+    if diagnostics is None:
+        diagnostics = new_diagnostics("merge_aadt_crash")
+    cnt_cols = ["ka_cnt", "bc_cnt", "pdo_cnt", "total_cnt"] + list(extra_cnt_cols)
+    # Sort the AADT rows by route and start milepost (stable, like the groupby and
+    # sort_values in merge_aadt_crash).
+    aadt_route_codes, aadt_route_uniq = pd.factorize(aadt_gdf_.route_id, sort=True)
+    aadt_st_all = aadt_gdf_.st_mp_pt.values.astype(float)
+    aadt_order = np.lexsort((aadt_st_all, aadt_route_codes))
+    del aadt_route_codes
+    aadt_route = aadt_gdf_.route_id.values[aadt_order]
+    aadt_st = aadt_st_all[aadt_order]
+    aadt_end = aadt_gdf_.end_mp_pt.values.astype(float)[aadt_order]
+    del aadt_st_all
+    # Same for the crash sections. Only the first section with a given start milepost
+    # is kept; its AADT intervals are the intervals of all sections with that start
+    # (the merge on route_gis and st_mp_pt followed by drop_duplicates in
+    # merge_aadt_crash).
+    crash_route_codes, _ = pd.factorize(crash_gdf_.route_gis, sort=True)
+    crash_st_all = crash_gdf_.st_mp_pt.values.astype(float)
+    crash_order = np.lexsort((crash_st_all, crash_route_codes))
+    crash_route_codes = crash_route_codes[crash_order]
+    crash_st = crash_st_all[crash_order]
+    del crash_st_all
+    crash_end = crash_gdf_.end_mp_pt.values.astype(float)[crash_order]
+    is_first = np.ones(len(crash_st), dtype=bool)
+    is_first[1:] = (crash_route_codes[1:] != crash_route_codes[:-1]) | (
+        crash_st[1:] != crash_st[:-1]
+    )
+    first_idx = np.flatnonzero(is_first)
+    crash_overlap_end = np.maximum.reduceat(crash_end, first_idx)
+    del crash_route_codes
+    crash_order = crash_order[first_idx]
+    crash_st = crash_st[first_idx]
+    crash_end = crash_end[first_idx]
+    crash_route = crash_gdf_.route_gis.values[crash_order]
+    crash_st_end_diff = crash_gdf_.st_end_diff.values.astype(float)[crash_order]
+    crash_cnt = np.column_stack(
+        [crash_gdf_[col].values.astype(float)[crash_order] for col in cnt_cols]
+    )
+    del crash_order, is_first, first_idx
+
+    num_aadt = len(aadt_route)
+    # Sums over the crash sections in each AADT interval (counts, st_end_diff, and
+    # seg_len_in_interval), and the min start and max end of the sections.
+    aadt_sums = np.zeros((num_aadt, len(cnt_cols) + 2))
+    aadt_crash_st = np.full(num_aadt, np.inf)
+    aadt_crash_end = np.full(num_aadt, -np.inf)
+    has_crash = np.zeros(num_aadt, dtype=bool)
+    aadt_right = np.empty(num_aadt)
+    # First row of the route of each AADT row; gives the ordinal for seg_id.
+    aadt_route_st_idx = np.empty(num_aadt, dtype=np.int64)
+    crash_route_ranges = get_route_ranges(crash_route)
+    aadt_but_no_crash_route_list_ = list()
+    for route_id, (aadt_st_idx, aadt_end_idx) in get_route_ranges(aadt_route).items():
+        # AADT intervals with the overlapping interval ends corrected (get_aadt_bin).
+        interval_left = aadt_st[aadt_st_idx:aadt_end_idx]
+        interval_right = np.minimum(
+            aadt_end[aadt_st_idx:aadt_end_idx],
+            np.append(interval_left[1:], aadt_end[aadt_end_idx - 1]),
+        )
+        aadt_right[aadt_st_idx:aadt_end_idx] = interval_right
+        aadt_route_st_idx[aadt_st_idx:aadt_end_idx] = aadt_st_idx
+        is_overlapping = interval_right < aadt_end[aadt_st_idx:aadt_end_idx]
+        if is_overlapping.any():
+            record_many(
+                diagnostics,
+                "overlapping_aadt_interval",
+                [route_id] * is_overlapping.sum(),
+                interval_left[is_overlapping],
+                {
+                    "end_mp_pt": aadt_end[aadt_st_idx:aadt_end_idx][is_overlapping],
+                    "end_mp_pt_cor": interval_right[is_overlapping],
+                },
+            )
+        if route_id not in crash_route_ranges:
+            aadt_but_no_crash_route_list_.append(route_id)
+            continue
+        crash_st_idx, crash_end_idx = crash_route_ranges[route_id]
+        sec_st = crash_st[crash_st_idx:crash_end_idx]
+        sec_overlap_end = crash_overlap_end[crash_st_idx:crash_end_idx]
+        # Candidate intervals of each section: an interval ends at or before the start
+        # of the next interval, so intervals before lo and from hi on cannot overlap.
+        lo = np.searchsorted(interval_left[1:], sec_st, side="right")
+        hi = np.searchsorted(interval_left, sec_overlap_end, side="left")
+        num_cand = np.maximum(hi - lo, 0)
+        sec_idx = np.repeat(np.arange(len(sec_st)), num_cand)
+        int_idx = np.repeat(lo, num_cand) + (
+            np.arange(num_cand.sum())
+            - np.repeat(np.cumsum(num_cand) - num_cand, num_cand)
+        )
+        # Left closed intervals overlap when each starts before the other ends.
+        overlaps = (sec_st[sec_idx] < interval_right[int_idx]) & (
+            interval_left[int_idx] < sec_overlap_end[sec_idx]
+        )
+        sec_idx = sec_idx[overlaps] + crash_st_idx
+        int_idx = int_idx[overlaps]
+        left = interval_left[int_idx]
+        right = interval_right[int_idx]
+        st, end = crash_st[sec_idx], crash_end[sec_idx]
+        st_end_diff = crash_st_end_diff[sec_idx]
+        # Length of the crash section in the AADT interval (scale_crash_by_seg_len).
+        seg_len_in_interval = np.select(
+            [
+                (st < left) & (end <= right),
+                (st < left) & (end > right),
+                (st >= left) & (end <= right),
+                (st >= left) & (end > right),
+            ],
+            [
+                st_end_diff - (left - st),
+                right - left,
+                st_end_diff,
+                st_end_diff - (end - right),
+            ],
+            np.nan,
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pair_vals = np.column_stack(
+                [
+                    crash_cnt[sec_idx]
+                    * (seg_len_in_interval / st_end_diff)[:, np.newaxis],
+                    st_end_diff,
+                    seg_len_in_interval,
+                ]
+            )
+        # Missing values are skipped in the sums, like dissolve.
+        pair_vals[np.isnan(pair_vals)] = 0
+        row_idx = int_idx + aadt_st_idx
+        np.add.at(aadt_sums, row_idx, pair_vals)
+        np.minimum.at(aadt_crash_st, row_idx, st)
+        np.maximum.at(aadt_crash_end, row_idx, end)
+        has_crash[row_idx] = True
+        del sec_idx, int_idx, overlaps, pair_vals, row_idx
+    aadt_but_no_crash_route_set_ = set(aadt_but_no_crash_route_list_)
+    record_many(diagnostics, "no_crash_data", sorted(aadt_but_no_crash_route_set_))
+    if print_summary:
+        print(get_diagnostics_summary(diagnostics))
+    del crash_st, crash_end, crash_overlap_end, crash_st_end_diff, crash_cnt
+
+    # Build the output columns.
+    def no_crash_to_nan(values):
+        return np.where(has_crash, values, np.nan)
+
+    aadt_crash_cols = {
+        "seg_id": get_seg_ids(aadt_route, np.arange(num_aadt) - aadt_route_st_idx)
+    }
+    for col in [
+        "route_id",
+        "route_class",
+        "route_qual",
+        "route_inventory",
+        "route_county",
+        "route_no",
+    ]:
+        if col in aadt_gdf_.columns:
+            aadt_crash_cols[col] = aadt_gdf_[col].values[aadt_order]
+    aadt_crash_cols.update(
+        st_mp_pt_crash=no_crash_to_nan(aadt_crash_st),
+        end_mp_pt_crash=no_crash_to_nan(aadt_crash_end),
+        st_end_diff_crash=no_crash_to_nan(aadt_sums[:, len(cnt_cols)]),
+        aadt_interval_left=aadt_st,
+        aadt_interval_right=aadt_right,
+        st_end_diff_aadt=aadt_end - aadt_st,
+        seg_len_in_interval=no_crash_to_nan(aadt_sums[:, len(cnt_cols) + 1]),
+    )
+    for col in ["aadt_2018", "source"]:
+        if col in aadt_gdf_.columns:
+            aadt_crash_cols[col] = aadt_gdf_[col].values[aadt_order]
+    for col_idx, col in enumerate(cnt_cols):
+        aadt_crash_cols[col] = no_crash_to_nan(aadt_sums[:, col_idx])
+    del aadt_sums, aadt_crash_st, aadt_crash_end
+    aadt_crash_df_ = pd.DataFrame(aadt_crash_cols)
+    del aadt_crash_cols
+    aadt_crash_df_["severity_index"] = get_severity_index_matrix(aadt_crash_df_)[:, 0]
+    aadt_crash_df_["crash_rate_per_mile_per_year"] = (
+        aadt_crash_df_.total_cnt / aadt_crash_df_.seg_len_in_interval / crash_num_years
+    )
+    aadt_crash_df_["inc_fac"] = (
+        aadt_crash_df_.crash_rate_per_mile_per_year * aadt_crash_df_.aadt_2018 / 100000
+    )
+    aadt_crash_df_["geometry_aadt"] = aadt_gdf_.geometry.values[aadt_order]
+    out_cols = [
+        "seg_id",
+        "route_id",
+        "route_class",
+        "route_qual",
+        "route_inventory",
+        "route_county",
+        "route_no",
+        "st_mp_pt_crash",
+        "end_mp_pt_crash",
+        "st_end_diff_crash",
+        "aadt_interval_left",
+        "aadt_interval_right",
+        "st_end_diff_aadt",
+        "seg_len_in_interval",
+        "aadt_2018",
+        "source",
+        "ka_cnt",
+        "bc_cnt",
+        "pdo_cnt",
+        "total_cnt",
+        "inc_fac",
+        "severity_index",
+        "crash_rate_per_mile_per_year",
+        "geometry_aadt",
+    ] + list(extra_cnt_cols)
+    aadt_crash_gdf_ = gpd.GeoDataFrame(
+        aadt_crash_df_[[col for col in out_cols if col in aadt_crash_df_.columns]],
+        geometry="geometry_aadt",
+    )
+    aadt_crash_gdf_.crs = "EPSG:4326"
+    if not quiet:
+        print(f"Peak memory after the low memory merge: {get_peak_rss_mb()} MB")
+    return aadt_crash_gdf_, aadt_but_no_crash_route_set_
+
+
+def get_aadt_bin(aadt_grp_sub_, diagnostics=None):
     """
     Function to bin AADT data.
     Parameters
     ----------
     aadt_grp_sub_: gpd.GeoDataFrame()
         AADT data for one route in one county.
+    diagnostics: dict
+        Collector from src.diagnostics.new_diagnostics for the overlapping intervals.
+        None prints the overlapping intervals instead.
 
     Returns
     -------
@@ -248,7 +577,7 @@ def get_aadt_bin(aadt_grp_sub_):
     } : dict
         aadt_lrs_bins: aadt intervals for crash binning
         aadt_grp_sub_1: AADT data for one route in one county with corrected interval
-        boundaries and a column for defining interval.`
+        boundaries, a column for defining interval, and the int64 segment id (seg_id).`
     """
     # Create bins for grouping the data.
     # Find if the aadt data has intervals that overlap with each other. Remove the overlap
@@ -256,19 +585,33 @@ def get_aadt_bin(aadt_grp_sub_):
     # of 1st interval is after the start point of 2nd interval, use the start point of
     # 2nd interval as the end point of 1st interval.
     # Recompute interval length with corrected interval boundaries.
-    aadt_grp_sub_1 = aadt_grp_sub_.sort_values(["st_mp_pt"]).assign(
+    # Segment id: route id and the ordinal of the interval on the route.
+    aadt_grp_sub_1 = aadt_grp_sub_.sort_values(["st_mp_pt"], kind="mergesort").assign(
+        seg_id=lambda df: get_seg_ids(df.route_id, np.arange(len(df))),
         st_mp_pt_shift1=lambda df: df.st_mp_pt.shift(-1).fillna(df.end_mp_pt),
         overlapping_interval=lambda df: (df.st_mp_pt_shift1 - df.end_mp_pt).lt(0),
         end_mp_pt_cor=lambda df: df[["end_mp_pt", "st_mp_pt_shift1"]].min(axis=1),
         st_end_diff=lambda df: df.end_mp_pt - df.st_mp_pt,
     )
-    if aadt_grp_sub_1.overlapping_interval.any():
+    if diagnostics is None and aadt_grp_sub_1.overlapping_interval.any():
         print(
             f"Fixing issue with overlapping interval in "
             f"route {aadt_grp_sub_1[['route_class', 'route_qual', 'route_no', 'route_county']].head(1)}"
             f" for the following rows: \n"
             f"{aadt_grp_sub_1.loc[aadt_grp_sub_1.overlapping_interval, ['st_mp_pt', 'end_mp_pt', 'st_mp_pt_shift1', 'end_mp_pt_cor']]}"
         )
+    elif aadt_grp_sub_1.overlapping_interval.any():
+        overlapping_rows = aadt_grp_sub_1.loc[aadt_grp_sub_1.overlapping_interval]
+        record_many(
+            diagnostics,
+            "overlapping_aadt_interval",
+            overlapping_rows.route_id.values,
+            overlapping_rows.st_mp_pt.values,
+            {
+                "end_mp_pt": overlapping_rows.end_mp_pt.values,
+                "end_mp_pt_cor": overlapping_rows.end_mp_pt_cor.values,
+            },
+        )
 
     # Create interval index from aadt data that would be used to cut the crash data.
     aadt_lrs_bins = pd.IntervalIndex.from_arrays(
@@ -348,7 +691,7 @@ def bin_aadt_crash(aadt_lrs_bins, crash_grp_sub_):
     return crash_grp_sub_aadt_interval_long_
 
 
-def scale_crash_by_seg_len(crash_gdf_2_):
+def scale_crash_by_seg_len(crash_gdf_2_, extra_cnt_cols=()):
     """
     Consider the crashes to be uniformly distributed along the crash segment.
     Scale the crashes based on the length of the crash segment and position of
@@ -357,6 +700,8 @@ def scale_crash_by_seg_len(crash_gdf_2_):
     ----------
     crash_gdf_2_ : gpd.GeoDataFrame
         Crash data with AADT bins.
+    extra_cnt_cols: tuple
+        Additional crash count columns scaled like the ka, bc, pdo, and total counts.
     Returns
     -------
     crash_gdf_2_adj_crash_freq_by_len_ : crash_gdf_2_ with crash frequency adjusted based
@@ -405,6 +750,10 @@ def scale_crash_by_seg_len(crash_gdf_2_):
             bc_cnt=lambda df: df.ratio_len_in_interval * df.bc_cnt,
             pdo_cnt=lambda df: df.ratio_len_in_interval * df.pdo_cnt,
             total_cnt=lambda df: df.ratio_len_in_interval * df.total_cnt,
+            **{
+                col: (lambda df, col=col: df.ratio_len_in_interval * df[col])
+                for col in extra_cnt_cols
+            },
         )
         .drop(columns=["shape_len_mi"])
         .filter(
@@ -424,6 +773,7 @@ def scale_crash_by_seg_len(crash_gdf_2_):
                 "ratio_len_in_interval",
                 "geometry",
             ]
+            + list(extra_cnt_cols)
         )
     )
     return crash_gdf_2_adj_crash_freq_by_len_
@@ -445,8 +795,13 @@ if __name__ == "__main__":
     path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
     path_crash_si = os.path.join(path_interim_data, "nc_crash_si_2015_2019.gpkg")
     path_aadt_nc = os.path.join(path_interim_data, "ncdot_2018_aadt.gpkg")
-    crash_gdf = gpd.read_file(path_crash_si, driver="gpkg")
-    aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+    trace = new_trace("aadt_crash_merge")
+    with profile_stage(trace, "read_crash", paths_in=[path_crash_si]) as stage:
+        crash_gdf = gpd.read_file(path_crash_si, driver="gpkg")
+        stage["rows_out"] = len(crash_gdf)
+    with profile_stage(trace, "read_aadt", paths_in=[path_aadt_nc]) as stage:
+        aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+        stage["rows_out"] = len(aadt_gdf)
     aadt_gdf = aadt_gdf.query("route_class in [1, 2, 3]")
     crash_gdf = crash_gdf.query("route_class in [1, 2, 3]").sort_values(
         ["route_gis", "st_mp_pt"]
@@ -464,13 +819,39 @@ if __name__ == "__main__":
     #     crash_gdf_=crash_gdf,
     #     quiet=True
     # )
-    aadt_crash_gdf, aadt_but_no_crash_route_set = merge_aadt_crash(
-        aadt_gdf_=aadt_gdf, crash_gdf_=crash_gdf, quiet=True
-    )
-    # Ouput the gpkg file for aadt+crash data.
+    # Set use_low_memory_merge to True on machines with less memory; the output is the
+    # same (see engine_equivalence.py).
+    use_low_memory_merge = False
+    diagnostics = new_diagnostics("aadt_crash_merge")
+    with profile_stage(
+        trace, "merge_aadt_crash", rows_in=len(aadt_gdf) + len(crash_gdf)
+    ) as stage:
+        aadt_crash_gdf, aadt_but_no_crash_route_set = merge_aadt_crash(
+            aadt_gdf_=aadt_gdf,
+            crash_gdf_=crash_gdf,
+            quiet=True,
+            low_memory=use_low_memory_merge,
+            diagnostics=diagnostics,
+        )
+        stage["rows_out"] = len(aadt_crash_gdf)
+    # Ouput the gpkg file for aadt+crash data. Optionally store the rows in Hilbert
+    # curve order of the segments with bounding box statistics for each row group
+    # (aadt_crash_ncdot_row_groups.csv) for faster spatial filters.
     # ************************************************************************************
+    store_in_hilbert_order = False
     out_file_aadt_crash = os.path.join(path_interim_data, "aadt_crash_ncdot.gpkg")
-    aadt_crash_gdf.to_file(out_file_aadt_crash, driver="GPKG")
+    with profile_stage(
+        trace,
+        "write_aadt_crash",
+        rows_in=len(aadt_crash_gdf),
+        paths_out=[out_file_aadt_crash],
+    ):
+        if store_in_hilbert_order:
+            write_hilbert_ordered(
+                aadt_crash_gdf, out_file_aadt_crash, row_group_size=1000
+            )
+        else:
+            aadt_crash_gdf.to_file(out_file_aadt_crash, driver="GPKG")
     # Ouput the file showing routes with AADT but no crash data.
     # ************************************************************************************
     failed_merge_aadt_crash_dat = get_missing_aadt_gdf(
@@ -482,3 +863,9 @@ if __name__ == "__main__":
     failed_merge_crash_dat = get_missing_crash_gdf(
         crash_gdf, aadt_but_no_crash_route_set
     ).sort_values(["route_gis", "st_mp_pt"])
+    # Write the overlapping AADT intervals and routes without crash data to the
+    # diagnostics interim folder, and the profiling trace to the traces interim folder.
+    # ************************************************************************************
+    print(get_diagnostics_summary(diagnostics))
+    write_diagnostics(diagnostics)
+    write_trace(trace)
@@ -3,6 +3,8 @@ import os
 import pandas as pd
 import geopandas as gpd
 from src.utils import get_project_root
+from src.data.reference_layers import load_reference_layer
+from src.data.reference_layers import sjoin_reference
 from sklearn.preprocessing import minmax_scale
 
 if __name__ == "__main__":
@@ -12,38 +14,41 @@ if __name__ == "__main__":
     path_interim_sratch = os.path.join(path_interim_data, "scratch")
     path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
     path_to_census = os.path.join(path_to_raw, "CensusTract2010")
-    path_to_census_shapefile = os.path.join(path_to_census, "CensusTract2010.shp")
     path_growth_data = os.path.join(path_to_census, "Combined_FlowByCensusTract.csv")
     path_aadt_crash_si = os.path.join(path_interim_data, "aadt_crash_ncdot.gpkg")
     crash_aadt_fil_si_geom_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
     route_id_lrs_gdf = crash_aadt_fil_si_geom_gdf.filter(
-        items=["route_id", "aadt_interval_left", "aadt_interval_right", "geometry"]
+        items=[
+            "seg_id",
+            "route_id",
+            "aadt_interval_left",
+            "aadt_interval_right",
+            "geometry",
+        ]
     )
-    census_gpd = gpd.read_file(path_to_census_shapefile, driver="shp")
-    census_gpd = census_gpd.to_crs(epsg=4326)
+    # Census tracts are cached by the reference layer registry, so the shapefile
+    # read, re-projection, and spatial index are reused across runs.
+    census_gpd = load_reference_layer("census_tract_2010")["gdf"]
     growth_df = pd.read_csv(path_growth_data).assign(
         GEOID10=lambda df: df.GEOID10.astype(str)
     )
-    census_gpd_growth = census_gpd.merge(growth_df, on="GEOID10", how="left")
-    census_gpd_growth["test_tot_gr_24_yearly"] = (
+    growth_df["test_tot_gr_24_yearly"] = (
         (
-            (
-                census_gpd_growth["2040_Tot_Flow_24h"]
-                / census_gpd_growth["2015_Tot_Flow_24h"]
-            )
+            (growth_df["2040_Tot_Flow_24h"] / growth_df["2015_Tot_Flow_24h"])
             ** (1 / (2040 - 2015))
         )
         - 1
     ) * 100
-    census_gpd_growth["tot_gr_24_yearly"] = (
-        ((1 + (census_gpd_growth["24h_Tot_GR"] / 100)) ** (1 / (2040 - 2015))) - 1
+    growth_df["tot_gr_24_yearly"] = (
+        ((1 + (growth_df["24h_Tot_GR"] / 100)) ** (1 / (2040 - 2015))) - 1
     ) * 100
+    census_gpd_growth = census_gpd.merge(growth_df, on="GEOID10", how="left")
     census_gpd_growth.to_file(
         os.path.join(path_interim_sratch, "census_gpd_growth_polygons.shp")
     )
-    census_gpd_growth_lrs = gpd.sjoin(
-        route_id_lrs_gdf, census_gpd_growth, how="inner", op="intersects"
-    )
+    census_gpd_growth_lrs = sjoin_reference(
+        route_id_lrs_gdf, "census_tract_2010", how="inner", op="intersects"
+    ).merge(growth_df, on="GEOID10", how="left")
     census_gpd_growth_lrs["24h_Tot_GR"].describe()
     census_gpd_growth_lrs["tot_gr_24_yearly"].describe()
     census_gpd_growth_lrs = census_gpd_growth_lrs.sort_values(
@@ -67,7 +72,7 @@ if __name__ == "__main__":
 
     census_gpd_growth_lrs_grp = (
         census_gpd_growth_lrs.groupby(
-            ["route_id", "aadt_interval_left", "aadt_interval_right"]
+            ["seg_id", "route_id", "aadt_interval_left", "aadt_interval_right"]
         )
         .agg(
             tot_gr_24_yearly=("tot_gr_24_yearly", "mean"),
@@ -5,10 +5,23 @@ NC Routes, and secondary route in North Carolina.
 Created by: Apoorba Bibeka
 """
 import os
+import re
 import pandas as pd
 import geopandas as gpd
 from src.utils import get_project_root
 from src.utils import read_shp
+import numpy as np
+from src.data.validation import validate_df
+
+# Severity factor sets for K and A, B and C, and O and U crashes. Add a row to evaluate
+# another set, e.g. a local calibration.
+SI_FACTOR_SETS = pd.DataFrame(
+    {"ka_si_factor": [76.8], "bc_si_factor": [8.4], "ou_si_factor": [1]},
+    index=pd.Index(["ncdot"], name="factor_set"),
+)
+CRASH_RULES = [
+    {"rule": "county_from_route_id", "route_col": "route_gis", "county_col": "county"}
+]
 
 
 def fix_crash_dat_type(crash_df_):
@@ -76,10 +89,59 @@ def test_crash_dat(crash_df_fil_):
     crash_df_fil_: pd.DataFrame
         Filtered crash data to 1: interstate, 2: US Route, 3: NC Route,
         4: Secondary Route.
+    Returns
+    -------
+    violations_df_: pd.DataFrame()
+        Violations of CRASH_RULES from validate_df.
     """
+    violations_df_ = validate_df(crash_df_fil_, CRASH_RULES)
     assert (
-        crash_df_fil_.route_county == crash_df_fil_.county
-    ).all(), "County number in the data does not matches county number from route_gis."
+        len(violations_df_) == 0
+    ), "County number in the data does not matches county number from route_gis."
+    return violations_df_
+
+
+def get_severity_index_matrix(crash_df_fil_, si_factor_sets_=SI_FACTOR_SETS):
+    """
+    Compute the severity index for several sets of severity factors at once.
+    Parameters
+    ----------
+    crash_df_fil_: pd.DataFrame
+        Data with ka_cnt, bc_cnt, pdo_cnt, and total_cnt columns, e.g. crash sections
+        or crashes aggregated by county.
+    si_factor_sets_: pd.DataFrame
+        Severity factor sets (k x 3) with ka_si_factor, bc_si_factor, and
+        ou_si_factor columns.
+    Returns
+    -------
+    si_mat_: np.array
+        n x k severity index. The severity index is 1 when there are no crashes and
+        missing when total_cnt is missing.
+    """
+    crash_cnt = crash_df_fil_[["ka_cnt", "bc_cnt", "pdo_cnt"]].values.astype(float)
+    total_cnt = crash_df_fil_["total_cnt"].values.astype(float)[:, np.newaxis]
+    si_factor_mat = si_factor_sets_[
+        ["ka_si_factor", "bc_si_factor", "ou_si_factor"]
+    ].values.astype(float)
+    si_mat_ = np.divide(
+        crash_cnt @ si_factor_mat.T,
+        total_cnt,
+        out=np.ones((len(crash_cnt), len(si_factor_mat))),
+        where=total_cnt != 0,
+    )
+    return si_mat_
+
+
+def get_severity_index_df(crash_df_fil_, si_factor_sets_=SI_FACTOR_SETS):
+    """
+    Get the severity index for each severity factor set as severity_index_<set name>
+    columns.
+    """
+    return pd.DataFrame(
+        get_severity_index_matrix(crash_df_fil_, si_factor_sets_),
+        columns=[f"severity_index_{name}" for name in si_factor_sets_.index],
+        index=crash_df_fil_.index,
+    )
 
 
 def get_severity_index(
@@ -103,35 +165,44 @@ def get_severity_index(
     crash_df_fil_si_: pd.DataFrame
         crash_df_fil with column for severity index.
     """
+    si_factor_set = pd.DataFrame(
+        {
+            "ka_si_factor": [ka_si_factor],
+            "bc_si_factor": [bc_si_factor],
+            "ou_si_factor": [ou_si_factor],
+        }
+    )
     crash_df_fil_si_ = crash_df_fil_.assign(
-        severity_index=lambda df, ka_si=ka_si_factor, bc_si=bc_si_factor, ou_si=ou_si_factor: (
-            ka_si * df.ka_cnt + bc_si * df.bc_cnt + ou_si * df.pdo_cnt
-        )
-        / df.total_cnt
+        severity_index=get_severity_index_matrix(crash_df_fil_, si_factor_set)[:, 0]
     )
-    crash_df_fil_si_.loc[lambda df: df.total_cnt == 0, "severity_index"] = 1
-
     return crash_df_fil_si_
 
 
-if __name__ == "__main__":
-    # Set the paths to relevant files and folders.
-    # Load NCDOT 2015-2019 crash data.
-    # ************************************************************************************
-    path_to_prj_dir = get_project_root()
-    path_to_raw = os.path.join(path_to_prj_dir, "data", "raw")
-    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
-    crash_file = os.path.join(path_to_raw, "SectionScores_2015_2019")
+def get_crash_si_gdf(crash_file, max_highway_class=3):
+    """
+    Clean a "Section Safety Scores" shapefile: fix the data types, filter to the
+    highway classes, test the county numbers, add the severity index, and re-project
+    to EPSG:4326.
+    Parameters
+    ----------
+    crash_file: str
+        Section safety scores shapefile (folder).
+    max_highway_class: int
+        Keep 1: interstate, 2: US Route, 3: NC Route, 4: Secondary Route up to this
+        class.
+    Returns
+    -------
+    crash_df_fil_si_geom_gdf_: gpd.GeoDataFrame()
+        Cleaned crash sections with the severity index.
+    """
     crash_gdf = read_shp(file=crash_file)
     crash_gdf_geom_4326 = crash_gdf.to_crs(epsg=4326).geometry
     crash_df = pd.DataFrame(crash_gdf.drop(columns="geometry"))
     # Fix data types.
     # ************************************************************************************
     crash_df_add_col = fix_crash_dat_type(crash_df)
-    set(crash_df_add_col.route_no.unique())
     # Filter crash data to 1: interstate, 2: US Route, 3: NC Route, 4: Secondary Route.
     # ************************************************************************************
-    max_highway_class = 3
     crash_df_fil = crash_df_add_col.loc[lambda df: df.route_class <= max_highway_class]
     test_crash_dat(crash_df_fil)
     # Get severity index.
@@ -142,11 +213,59 @@ if __name__ == "__main__":
     crash_df_fil_si_geom = crash_df_fil_si.merge(
         crash_gdf_geom_4326, left_index=True, right_index=True, how="left"
     )
-    # Convert crash data to GeoDataFrame() and output to gpkg file.
-    # ************************************************************************************
-    crash_df_fil_si_geom_gdf = gpd.GeoDataFrame(
+    crash_df_fil_si_geom_gdf_ = gpd.GeoDataFrame(
         crash_df_fil_si_geom, geometry=crash_df_fil_si_geom.geometry,
     )
-    crash_df_fil_si_geom_gdf.crs = "EPSG:4326"
+    crash_df_fil_si_geom_gdf_.crs = "EPSG:4326"
+    return crash_df_fil_si_geom_gdf_
+
+
+def get_crash_year_files(path_to_raw):
+    """
+    Find the single year section crash count shapefiles, data/raw/SectionScores_<year>
+    (same schema as SectionScores_2015_2019, with the counts of one year).
+    Returns
+    -------
+    dict
+        {year: path}
+    """
+    crash_year_files = {}
+    for file in sorted(os.listdir(path_to_raw)):
+        year_match = re.fullmatch(r"SectionScores_(\d{4})", file)
+        if year_match is not None:
+            crash_year_files[int(year_match.group(1))] = os.path.join(path_to_raw, file)
+    return crash_year_files
+
+
+if __name__ == "__main__":
+    # Set the paths to relevant files and folders.
+    # Load and clean NCDOT 2015-2019 crash data.
+    # ************************************************************************************
+    path_to_prj_dir = get_project_root()
+    path_to_raw = os.path.join(path_to_prj_dir, "data", "raw")
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    crash_file = os.path.join(path_to_raw, "SectionScores_2015_2019")
+    crash_df_fil_si_geom_gdf = get_crash_si_gdf(crash_file, max_highway_class=3)
     out_file_crash_si = os.path.join(path_interim_data, "nc_crash_si_2015_2019.gpkg")
     crash_df_fil_si_geom_gdf.to_file(out_file_crash_si, driver="GPKG")
+    # Per-year section crash counts for the rolling windows in crash_windows.py.
+    # ************************************************************************************
+    crash_year_files = get_crash_year_files(path_to_raw)
+    if len(crash_year_files) > 0:
+        crash_year_gdf = pd.concat(
+            [
+                get_crash_si_gdf(crash_year_file, max_highway_class=3).assign(
+                    crash_year=crash_year
+                )
+                for crash_year, crash_year_file in crash_year_files.items()
+            ],
+            ignore_index=True,
+        )
+        crash_year_gdf.to_file(
+            os.path.join(path_interim_data, "nc_crash_si_by_year.gpkg"), driver="GPKG"
+        )
+    else:
+        print(
+            "No SectionScores_<year> folders in data/raw; nc_crash_si_by_year.gpkg "
+            "for crash_windows.py is not created."
+        )
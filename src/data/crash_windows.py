@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Compute the incident factor (IF), crash rate, and severity index for every rolling
+multi-year crash window (e.g., 2011-2015, 2012-2016, ..., 2015-2019) from per-year
+section crash counts. The per-year counts are merged to the AADT data once, and the
+window counts are differences of cumulative sums along the year axis.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils import get_project_root
+from src.data.crash import get_severity_index
+from src.data.aadt_crash_merge import merge_aadt_crash
+
+CNT_TYPES = ("ka", "bc", "pdo", "total")
+
+
+def get_year_cnt_cols(years, cnt_types=CNT_TYPES):
+    """
+    Get the per-year crash count column names, e.g. "total_cnt_2015".
+    """
+    return [f"{cnt_type}_cnt_{year}" for year in years for cnt_type in cnt_types]
+
+
+def pivot_crash_years(
+    crash_year_gdf_, years, section_cols=("route_gis", "st_mp_pt"), end_col="end_mp_pt"
+):
+    """
+    Convert per-year section crash counts (one row per section and year) to one row
+    per section with a column for each year and crash type.
+    Parameters
+    ----------
+    crash_year_gdf_: gpd.GeoDataFrame()
+        Crash data processed like crash.py with a "crash_year" column.
+    years: list
+        Years to keep.
+    section_cols: tuple
+        Columns that identify a crash section: route and start milepost, the keys
+        merge_aadt_crash de-duplicates the sections on.
+    end_col: str
+        End milepost column. Sections with the same start milepost and different
+        end mileposts in different years are one section ending at the max end.
+    Returns
+    -------
+    crash_wide_gdf_: gpd.GeoDataFrame()
+        One row per section with <type>_cnt_<year> columns. Sections without crashes
+        in a year get 0 crashes. ka_cnt, bc_cnt, pdo_cnt, and total_cnt are the sums
+        over years.
+    """
+    section_cols = list(section_cols)
+    cnt_cols = [f"{cnt_type}_cnt" for cnt_type in CNT_TYPES]
+    crash_year_gdf_ = crash_year_gdf_.loc[lambda df: df.crash_year.isin(years)]
+    crash_year_cnt = crash_year_gdf_.pivot_table(
+        index=section_cols,
+        columns="crash_year",
+        values=cnt_cols,
+        aggfunc="sum",
+        fill_value=0,
+    )
+    crash_year_cnt.columns = [
+        f"{cnt_col}_{year}" for cnt_col, year in crash_year_cnt.columns
+    ]
+    crash_year_cnt = crash_year_cnt.reindex(
+        columns=get_year_cnt_cols(years), fill_value=0
+    ).reset_index()
+    section_end = crash_year_gdf_.groupby(section_cols)[end_col].max().reset_index()
+    crash_wide_gdf_ = (
+        crash_year_gdf_.drop(columns=cnt_cols + ["crash_year", end_col])
+        .drop_duplicates(section_cols)
+        .merge(section_end, on=section_cols, how="inner")
+        .merge(crash_year_cnt, on=section_cols, how="inner")
+    )
+    for cnt_type in CNT_TYPES:
+        crash_wide_gdf_[f"{cnt_type}_cnt"] = crash_wide_gdf_[
+            get_year_cnt_cols(years, cnt_types=(cnt_type,))
+        ].sum(axis=1)
+    return crash_wide_gdf_
+
+
+def get_rolling_window_metrics(
+    aadt_crash_gdf_,
+    years,
+    window_len=5,
+    aadt_col="aadt_2018",
+    id_cols=("route_id", "aadt_interval_left", "aadt_interval_right"),
+):
+    """
+    Compute the crash counts, crash rate, IF, and severity index for all rolling
+    windows of window_len years.
+    Parameters
+    ----------
+    aadt_crash_gdf_: gpd.GeoDataFrame()
+        Output from merge_aadt_crash with extra_cnt_cols=get_year_cnt_cols(years).
+    years: list
+        Consecutive years in the per-year counts.
+    window_len: int
+        Number of years in a window.
+    aadt_col: str
+        AADT column used for the IF.
+    id_cols: tuple
+        Segment id columns kept in the output.
+    Returns
+    -------
+    crash_window_df_: pd.DataFrame()
+        One row per segment and window with id_cols, window ("2015-2019"),
+        window_start, window_end, ka_cnt, bc_cnt, pdo_cnt, total_cnt,
+        crash_rate_per_mile_per_year, inc_fac, and severity_index.
+    """
+    years = list(years)
+    num_windows = len(years) - window_len + 1
+    assert num_windows > 0, f"Need at least {window_len} years of crash data."
+    num_seg = len(aadt_crash_gdf_)
+    # seg x year x crash type counts.
+    year_cnt = aadt_crash_gdf_[get_year_cnt_cols(years)].values.astype(float)
+    year_cnt = year_cnt.reshape(num_seg, len(years), len(CNT_TYPES))
+    no_crash_data = np.isnan(year_cnt).all(axis=(1, 2))
+    cum_cnt = np.concatenate(
+        [
+            np.zeros((num_seg, 1, len(CNT_TYPES))),
+            np.nancumsum(year_cnt, axis=1),
+        ],
+        axis=1,
+    )
+    window_cnt = cum_cnt[:, window_len:] - cum_cnt[:, :-window_len]
+    # Segments without crash data keep missing counts as in merge_aadt_crash.
+    window_cnt[no_crash_data] = np.nan
+    window_start = np.array(years[:num_windows])
+    window_end = window_start + window_len - 1
+    crash_window_df_ = pd.DataFrame(
+        aadt_crash_gdf_[list(id_cols) + ["seg_len_in_interval", aadt_col]]
+    ).reset_index(drop=True)
+    crash_window_df_ = crash_window_df_.loc[
+        crash_window_df_.index.repeat(num_windows)
+    ].reset_index(drop=True)
+    crash_window_df_ = crash_window_df_.assign(
+        window_start=np.tile(window_start, num_seg),
+        window_end=np.tile(window_end, num_seg),
+        window=lambda df: df.window_start.astype(str) + "-" + df.window_end.astype(str),
+        **{
+            f"{cnt_type}_cnt": window_cnt[:, :, cnt_idx].ravel()
+            for cnt_idx, cnt_type in enumerate(CNT_TYPES)
+        },
+    ).assign(
+        crash_rate_per_mile_per_year=lambda df: (
+            df.total_cnt / df.seg_len_in_interval / window_len
+        ),
+        inc_fac=lambda df: df.crash_rate_per_mile_per_year * df[aadt_col] / 100000,
+    )
+    crash_window_df_ = get_severity_index(crash_window_df_)
+    return crash_window_df_
+
+
+if __name__ == "__main__":
+    # Set the paths to relevant files and folders.
+    # Load per-year crash data and aadt data.
+    # ************************************************************************************
+    path_to_prj_dir = get_project_root()
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    # Per-year section crash counts written by crash.py from the SectionScores_<year>
+    # raw folders.
+    path_crash_by_year = os.path.join(path_interim_data, "nc_crash_si_by_year.gpkg")
+    path_aadt_nc = os.path.join(path_interim_data, "ncdot_2018_aadt.gpkg")
+    path_crash_windows = os.path.join(path_processed_data, "crash_rolling_windows.csv")
+    crash_year_gdf = gpd.read_file(path_crash_by_year, driver="gpkg")
+    aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+    aadt_gdf = aadt_gdf.query("route_class in [1, 2, 3]")
+    crash_year_gdf = crash_year_gdf.query("route_class in [1, 2, 3]")
+    crash_years = list(
+        range(crash_year_gdf.crash_year.min(), crash_year_gdf.crash_year.max() + 1)
+    )
+    # Merge the per-year counts to the AADT data once and compute all windows.
+    # ************************************************************************************
+    crash_wide_gdf = pivot_crash_years(crash_year_gdf, crash_years).sort_values(
+        ["route_gis", "st_mp_pt"]
+    )
+    aadt_crash_year_gdf, _ = merge_aadt_crash(
+        aadt_gdf_=aadt_gdf,
+        crash_gdf_=crash_wide_gdf,
+        crash_num_years=len(crash_years),
+        quiet=True,
+        extra_cnt_cols=get_year_cnt_cols(crash_years),
+    )
+    crash_window_df = get_rolling_window_metrics(
+        aadt_crash_year_gdf, crash_years, window_len=5
+    )
+    crash_window_df.to_csv(path_crash_windows, index=False)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Dynamic segmentation of the linear referencing system (LRS) attribute layers. Each
+layer (AADT, crash sections, detour, ...) has its own milepost breakpoints on a route.
+The breakpoints of all layers are combined with a k-way merge sweep into homogeneous
+segments, and the layer attributes are transferred to the segments by length: rates
+and volumes (intensive attributes) are copied, and counts (extensive attributes) are
+scaled by the share of the layer interval in the segment. Routes are processed in
+parallel.
+Created by: Apoorba Bibeka
+"""
+import os
+import heapq
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor
+from src.utils import get_project_root
+
+
+def get_layer(
+    df_,
+    route_col="route_id",
+    st_col="st_mp_pt",
+    end_col="end_mp_pt",
+    intensive_cols=(),
+    extensive_cols=(),
+):
+    """
+    Define an interval layer for dynamic segmentation.
+    Parameters
+    ----------
+    df_: pd.DataFrame()
+        Interval data with a route id, start milepost, and end milepost.
+    route_col: str
+        Route id column.
+    st_col: str
+        Start milepost column.
+    end_col: str
+        End milepost column.
+    intensive_cols: tuple
+        Attributes copied to the segments, e.g. AADT, rates, or scores.
+    extensive_cols: tuple
+        Attributes scaled by the segment length / interval length, e.g. crash counts.
+    Returns
+    -------
+    dict
+        Layer with the per-route start, end, and attribute arrays. Intervals in a
+        route are sorted by start milepost.
+    """
+    intensive_cols = list(intensive_cols)
+    extensive_cols = list(extensive_cols)
+    layer_df = (
+        pd.DataFrame(
+            df_[[route_col, st_col, end_col] + intensive_cols + extensive_cols]
+        )
+        .assign(**{route_col: lambda df: df[route_col].astype(str)})
+        .loc[lambda df: df[end_col] > df[st_col]]
+        .sort_values([route_col, st_col])
+    )
+    routes = {}
+    for route_id, layer_route_df in layer_df.groupby(route_col, sort=False):
+        routes[route_id] = {
+            "st": layer_route_df[st_col].values.astype(float),
+            "end": layer_route_df[end_col].values.astype(float),
+            "values": layer_route_df[intensive_cols + extensive_cols].values.astype(
+                float
+            ),
+        }
+    return {
+        "intensive_cols": intensive_cols,
+        "extensive_cols": extensive_cols,
+        "routes": routes,
+    }
+
+
+def get_route_breakpoints(route_layers):
+    """
+    Merge the sorted breakpoints of all layers on a route with a k-way merge sweep.
+    Parameters
+    ----------
+    route_layers: list
+        {"st", "end", "values"} arrays of each layer on the route.
+    Returns
+    -------
+    np.array
+        Sorted unique breakpoints.
+    """
+    # The starts are sorted; the ends are sorted when the intervals of a layer do not
+    # overlap. Sort them anyway since a few layers have small overlaps.
+    sorted_breakpoints = []
+    for route_layer in route_layers:
+        sorted_breakpoints.append(route_layer["st"])
+        sorted_breakpoints.append(np.sort(route_layer["end"]))
+    breakpoints = []
+    for breakpoint in heapq.merge(*[arr.tolist() for arr in sorted_breakpoints]):
+        if not breakpoints or breakpoint > breakpoints[-1]:
+            breakpoints.append(breakpoint)
+    return np.array(breakpoints)
+
+
+def segment_route(route_id, route_layers, layer_cols):
+    """
+    Create the homogeneous segments of one route and transfer the layer attributes.
+    Parameters
+    ----------
+    route_id: str
+        Route id.
+    route_layers: list
+        {"st", "end", "values"} arrays of each layer on the route; None for layers
+        without data on the route.
+    layer_cols: list
+        (intensive_cols, extensive_cols) of each layer.
+    Returns
+    -------
+    pd.DataFrame()
+        One row per segment covered by at least one layer with route_id, seg_st_mp,
+        seg_end_mp, seg_len, and the layer attributes.
+    Notes
+    -----
+    Where intervals of a layer overlap, the segment gets the intensive attributes of
+    the covering interval that starts last (or, past its end, of the earlier interval
+    that extends furthest), and the sum of the length-weighted extensive attributes of
+    all covering intervals. Missing extensive attributes are counted as 0.
+    """
+    breakpoints = get_route_breakpoints(
+        [route_layer for route_layer in route_layers if route_layer is not None]
+    )
+    seg_st = breakpoints[:-1]
+    seg_end = breakpoints[1:]
+    seg_len = seg_end - seg_st
+    seg_covered = np.zeros(len(seg_st), dtype=bool)
+    seg_values = []
+    for route_layer, (intensive_cols, extensive_cols) in zip(route_layers, layer_cols):
+        num_intensive = len(intensive_cols)
+        layer_values = np.full(
+            (len(seg_st), num_intensive + len(extensive_cols)), np.nan
+        )
+        if route_layer is not None:
+            # Map each segment to the last layer interval starting at or before it.
+            interval_idx = np.searchsorted(route_layer["st"], seg_st, side="right") - 1
+            interval_idx_clip = np.maximum(interval_idx, 0)
+            # Overlapping intervals: where the last interval ends before the segment
+            # end, use the earlier interval that reaches furthest (running maximum of
+            # the ends).
+            interval_end = route_layer["end"]
+            interval_end_cummax = np.maximum.accumulate(interval_end)
+            cummax_idx = np.maximum.accumulate(
+                np.where(
+                    interval_end == interval_end_cummax, np.arange(len(interval_end)), 0
+                )
+            )
+            interval_idx_clip = np.where(
+                interval_end[interval_idx_clip] >= seg_end,
+                interval_idx_clip,
+                cummax_idx[interval_idx_clip],
+            )
+            in_interval = (interval_idx >= 0) & (
+                interval_end[interval_idx_clip] >= seg_end
+            )
+            seg_covered |= in_interval
+            layer_values[in_interval, :num_intensive] = route_layer["values"][
+                interval_idx_clip[in_interval], :num_intensive
+            ]
+            # Length-weighted transfer of the extensive attributes: sweep the
+            # per-mile densities of all intervals with a difference array over the
+            # breakpoints, so overlapping intervals add up.
+            st_idx = np.searchsorted(breakpoints, route_layer["st"])
+            end_idx = np.searchsorted(breakpoints, route_layer["end"])
+            density = (
+                np.nan_to_num(route_layer["values"][:, num_intensive:])
+                / (route_layer["end"] - route_layer["st"])[:, np.newaxis]
+            )
+            density_delta = np.zeros((len(breakpoints), density.shape[1]))
+            np.add.at(density_delta, st_idx, density)
+            np.add.at(density_delta, end_idx, -density)
+            layer_values[in_interval, num_intensive:] = (
+                np.cumsum(density_delta, axis=0)[:-1] * seg_len[:, np.newaxis]
+            )[in_interval]
+        seg_values.append(layer_values)
+    all_cols = [
+        col
+        for intensive_cols, extensive_cols in layer_cols
+        for col in intensive_cols + extensive_cols
+    ]
+    route_seg_df_ = pd.DataFrame(np.hstack(seg_values), columns=all_cols).assign(
+        route_id=route_id, seg_st_mp=seg_st, seg_end_mp=seg_end, seg_len=seg_len
+    )
+    route_seg_df_ = route_seg_df_.loc[seg_covered]
+    return route_seg_df_[["route_id", "seg_st_mp", "seg_end_mp", "seg_len"] + all_cols]
+
+
+def segment_routes(route_payloads, layer_cols):
+    """
+    Segment a batch of routes; one task of the process pool.
+    """
+    return pd.concat(
+        [
+            segment_route(route_id, route_layers, layer_cols)
+            for route_id, route_layers in route_payloads
+        ],
+        ignore_index=True,
+    )
+
+
+def get_dynamic_segments(layers, n_jobs=4, routes_per_task=200):
+    """
+    Create homogeneous segments from the interval layers on all routes.
+    Parameters
+    ----------
+    layers: list
+        Layers from get_layer. Attribute columns must be unique across layers.
+    n_jobs: int
+        Number of processes. 1 runs in the current process.
+    routes_per_task: int
+        Number of routes sent to a process at a time.
+    Returns
+    -------
+    dyn_seg_df_: pd.DataFrame()
+        One row per homogeneous segment with route_id, seg_st_mp, seg_end_mp,
+        seg_len, and the attributes of all layers. Attributes of a layer that does not
+        cover a segment are missing.
+    """
+    layer_cols = [
+        (layer["intensive_cols"], layer["extensive_cols"]) for layer in layers
+    ]
+    route_ids = sorted(set().union(*[layer["routes"].keys() for layer in layers]))
+    route_payloads = [
+        (route_id, [layer["routes"].get(route_id) for layer in layers])
+        for route_id in route_ids
+    ]
+    route_batches = [
+        route_payloads[batch_start : batch_start + routes_per_task]
+        for batch_start in range(0, len(route_payloads), routes_per_task)
+    ]
+    if n_jobs == 1:
+        dyn_seg_df_list = [
+            segment_routes(route_batch, layer_cols) for route_batch in route_batches
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            dyn_seg_df_list = list(
+                executor.map(
+                    segment_routes,
+                    route_batches,
+                    [layer_cols] * len(route_batches),
+                )
+            )
+    dyn_seg_df_ = pd.concat(dyn_seg_df_list, ignore_index=True)
+    return dyn_seg_df_
+
+
+if __name__ == "__main__":
+    # Set the paths to relevant files and folders.
+    # Load the AADT, crash, and detour layers.
+    # ************************************************************************************
+    path_to_prj_dir = get_project_root()
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_aadt_crash_si = os.path.join(path_interim_data, "aadt_crash_ncdot.gpkg")
+    path_crash_si = os.path.join(path_interim_data, "nc_crash_si_2015_2019.gpkg")
+    path_detour_data = os.path.join(
+        path_processed_data, "detour_testing", "detour_work_ASG.shp"
+    )
+    path_dyn_seg = os.path.join(path_interim_data, "dynamic_segments.csv")
+    aadt_crash_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
+    crash_gdf = gpd.read_file(path_crash_si, driver="gpkg").query(
+        "route_class in [1, 2, 3]"
+    )
+    detour_gdf = gpd.read_file(path_detour_data, driver="shp").loc[
+        lambda df: df["class"].astype(int) <= 3
+    ]
+    # AADT intervals have the overlap corrections from get_aadt_bin.
+    # ************************************************************************************
+    aadt_layer = get_layer(
+        aadt_crash_gdf,
+        st_col="aadt_interval_left",
+        end_col="aadt_interval_right",
+        intensive_cols=("aadt_2018",),
+    )
+    crash_layer = get_layer(
+        crash_gdf,
+        route_col="route_gis",
+        extensive_cols=("ka_cnt", "bc_cnt", "pdo_cnt", "total_cnt"),
+    )
+    detour_layer = get_layer(
+        detour_gdf,
+        route_col="RouteID",
+        st_col="BeginMp",
+        end_col="EndMp",
+        intensive_cols=("scr_det", "scr_d90", "scr_nd90"),
+    )
+    dyn_seg_df = get_dynamic_segments([aadt_layer, crash_layer, detour_layer], n_jobs=4)
+    dyn_seg_df.to_csv(path_dyn_seg, index=False)
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Check that faster variants (engines) of the AADT and crash merge give the same output
+as the reference merge_aadt_crash. The engines are run on the same real or synthetic
+inputs, the outputs are compared row by row with float tolerances, and the speedup,
+memory ratio, and mismatched routes are reported.
+Created by: Apoorba Bibeka
+"""
+import io
+import os
+import time
+import tracemalloc
+import contextlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString
+from src.utils import get_project_root
+from src.data.aadt_crash_merge import merge_aadt_crash
+
+# Engines take (aadt_gdf_, crash_gdf_) and return (aadt_crash_gdf_,
+# aadt_but_no_crash_route_set_) like merge_aadt_crash.
+ENGINES = {
+    "reference": lambda aadt_gdf_, crash_gdf_: merge_aadt_crash(
+        aadt_gdf_=aadt_gdf_, crash_gdf_=crash_gdf_, quiet=True
+    ),
+    "low_memory": lambda aadt_gdf_, crash_gdf_: merge_aadt_crash(
+        aadt_gdf_=aadt_gdf_, crash_gdf_=crash_gdf_, quiet=True, low_memory=True
+    ),
+}
+KEY_COLS = ("seg_id", "route_id", "aadt_interval_left", "aadt_interval_right")
+FLOAT_COLS = (
+    "ka_cnt",
+    "bc_cnt",
+    "pdo_cnt",
+    "total_cnt",
+    "seg_len_in_interval",
+    "crash_rate_per_mile_per_year",
+    "inc_fac",
+    "severity_index",
+)
+
+
+def register_engine(name, engine):
+    """
+    Add an engine to ENGINES.
+    """
+    ENGINES[name] = engine
+
+
+def make_synthetic_inputs(num_routes=50, seed=0):
+    """
+    Make synthetic AADT and crash data with the columns used by merge_aadt_crash.
+    The data has overlapping AADT intervals, crash sections that span several AADT
+    intervals, sections without crashes, and routes without crash data.
+    Parameters
+    ----------
+    num_routes: int
+        Number of routes.
+    seed: int
+        Random seed.
+    Returns
+    -------
+    {"aadt_gdf": aadt_gdf_, "crash_gdf": crash_gdf_}: dict
+    """
+    rng = np.random.default_rng(seed)
+    aadt_rows = []
+    crash_rows = []
+    for route_idx in range(num_routes):
+        route_class = route_idx % 3 + 1
+        route_county = route_idx % 100 + 1
+        route_no = route_idx + 1
+        route_id = f"{route_class}00{route_no:05d}{route_county:03d}"
+        route_attr = {
+            "route_class": route_class,
+            "route_qual": 0,
+            "route_inventory": 0,
+            "route_no": route_no,
+            "route_county": route_county,
+        }
+        route_len = np.round(rng.uniform(2, 20), 3)
+        aadt_bounds = np.unique(
+            np.round(np.concatenate([[0, route_len], rng.uniform(0, route_len, 6)]), 3)
+        )
+        for st_mp_pt, end_mp_pt in zip(aadt_bounds[:-1], aadt_bounds[1:]):
+            # Some AADT intervals overlap the next interval.
+            if rng.random() < 0.1 and end_mp_pt < route_len:
+                end_mp_pt = end_mp_pt + 0.05
+            aadt_rows.append(
+                {
+                    "route_id": route_id,
+                    **route_attr,
+                    "st_mp_pt": st_mp_pt,
+                    "end_mp_pt": end_mp_pt,
+                    "aadt_2018": float(rng.integers(1000, 80000)),
+                    "source": "synthetic",
+                    "geometry": LineString(
+                        [(route_idx, st_mp_pt), (route_idx, end_mp_pt)]
+                    ),
+                }
+            )
+        if route_idx % 10 == 9:
+            # Route with AADT but no crash data.
+            continue
+        crash_bounds = np.unique(
+            np.round(
+                np.concatenate([[0], rng.uniform(0, route_len, 8), [route_len]]), 3
+            )
+        )
+        for st_mp_pt, end_mp_pt in zip(crash_bounds[:-1], crash_bounds[1:]):
+            ka_cnt = rng.integers(0, 3)
+            bc_cnt = rng.integers(0, 10)
+            pdo_cnt = rng.integers(0, 40)
+            if rng.random() < 0.1:
+                ka_cnt = bc_cnt = pdo_cnt = 0
+            crash_rows.append(
+                {
+                    "route_gis": route_id,
+                    **route_attr,
+                    "st_mp_pt": st_mp_pt,
+                    "end_mp_pt": end_mp_pt,
+                    "ka_cnt": float(ka_cnt),
+                    "bc_cnt": float(bc_cnt),
+                    "pdo_cnt": float(pdo_cnt),
+                    "total_cnt": float(ka_cnt + bc_cnt + pdo_cnt),
+                    "shape_len_mi": end_mp_pt - st_mp_pt,
+                    "st_end_diff": end_mp_pt - st_mp_pt,
+                    "geometry": LineString(
+                        [(route_idx, st_mp_pt), (route_idx, end_mp_pt)]
+                    ),
+                }
+            )
+    aadt_gdf_ = gpd.GeoDataFrame(aadt_rows, geometry="geometry", crs="EPSG:4326")
+    crash_gdf_ = gpd.GeoDataFrame(crash_rows, geometry="geometry", crs="EPSG:4326")
+    return {"aadt_gdf": aadt_gdf_, "crash_gdf": crash_gdf_}
+
+
+def run_engine(engine, inputs, measure_memory=True):
+    """
+    Run an engine and measure the run time and the peak memory allocated by Python
+    (tracemalloc). The memory is measured in a second run so that tracemalloc does
+    not slow down the timed run. Printed output is discarded.
+    Returns
+    -------
+    dict
+        output, no_crash_routes, time_s, and peak_mem_mb (None when not measured).
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        time_st = time.perf_counter()
+        output, no_crash_routes = engine(
+            inputs["aadt_gdf"].copy(), inputs["crash_gdf"].copy()
+        )
+        time_s = time.perf_counter() - time_st
+        peak_mem_mb = None
+        if measure_memory:
+            aadt_gdf_copy = inputs["aadt_gdf"].copy()
+            crash_gdf_copy = inputs["crash_gdf"].copy()
+            tracemalloc.start()
+            engine(aadt_gdf_copy, crash_gdf_copy)
+            peak_mem_mb = tracemalloc.get_traced_memory()[1] / 1024**2
+            tracemalloc.stop()
+    return {
+        "output": output,
+        "no_crash_routes": set(no_crash_routes),
+        "time_s": time_s,
+        "peak_mem_mb": peak_mem_mb,
+    }
+
+
+def compare_outputs(
+    ref_df_, cand_df_, key_cols=KEY_COLS, float_cols=FLOAT_COLS, rtol=1e-6, atol=1e-9
+):
+    """
+    Compare two outputs row by row.
+    Parameters
+    ----------
+    ref_df_: pd.DataFrame()
+        Reference output.
+    cand_df_: pd.DataFrame()
+        Candidate output.
+    key_cols: tuple
+        Columns that identify a row. Float keys are rounded to 6 decimals.
+    float_cols: tuple
+        Columns compared with np.isclose(rtol, atol). Missing values match missing
+        values.
+    rtol, atol: float
+        Tolerances.
+    Returns
+    -------
+    mismatch_df_: pd.DataFrame()
+        key_cols, in_reference, in_candidate, and the names of the mismatched
+        columns for each row that is missing in one output or has a mismatched value.
+    """
+    key_cols = list(key_cols)
+    float_cols = [
+        col for col in float_cols if col in ref_df_.columns or col in cand_df_.columns
+    ]
+
+    def round_keys(df):
+        df = pd.DataFrame(df.reindex(columns=key_cols + float_cols))
+        for col in key_cols:
+            if pd.api.types.is_float_dtype(df[col]):
+                df[col] = df[col].round(6)
+        return df
+
+    comp_df = round_keys(ref_df_).merge(
+        round_keys(cand_df_),
+        on=key_cols,
+        how="outer",
+        suffixes=("_ref", "_cand"),
+        indicator=True,
+    )
+    mismatched_cols = pd.Series([""] * len(comp_df), index=comp_df.index)
+    for col in float_cols:
+        ref_val = comp_df[f"{col}_ref"].values.astype(float)
+        cand_val = comp_df[f"{col}_cand"].values.astype(float)
+        col_match = np.isclose(ref_val, cand_val, rtol=rtol, atol=atol) | (
+            np.isnan(ref_val) & np.isnan(cand_val)
+        )
+        mismatched_cols = mismatched_cols.where(col_match, mismatched_cols + col + ";")
+    mismatch_df_ = comp_df.assign(
+        in_reference=lambda df: df._merge != "right_only",
+        in_candidate=lambda df: df._merge != "left_only",
+        mismatched_cols=mismatched_cols.str.rstrip(";"),
+    ).loc[
+        lambda df: (~df.in_reference) | (~df.in_candidate) | (df.mismatched_cols != "")
+    ]
+    return mismatch_df_[key_cols + ["in_reference", "in_candidate", "mismatched_cols"]]
+
+
+def run_equivalence(
+    inputs, candidates=None, reference="reference", measure_memory=True, **kwargs
+):
+    """
+    Run the reference and candidate engines on the same inputs and compare them.
+    Parameters
+    ----------
+    inputs: dict
+        {"aadt_gdf": aadt_gdf, "crash_gdf": crash_gdf}
+    candidates: list
+        Names of the candidate engines in ENGINES. None runs all other engines.
+    reference: str
+        Name of the reference engine.
+    measure_memory: bool
+        Measure the peak memory of each engine.
+    kwargs
+        Passed to compare_outputs.
+    Returns
+    -------
+    {"report": report_df_, "mismatches": mismatches_}: dict
+        report: one row per candidate with the run times, speedup, peak memory,
+        memory ratio, row counts, number of mismatched rows, mismatched routes, and
+        whether the sets of routes without crash data match.
+        mismatches: {candidate: output from compare_outputs}.
+    """
+    if candidates is None:
+        candidates = [name for name in ENGINES if name != reference]
+    ref_run = run_engine(ENGINES[reference], inputs, measure_memory=measure_memory)
+    report_rows = []
+    mismatches_ = {}
+    for name in candidates:
+        cand_run = run_engine(ENGINES[name], inputs, measure_memory=measure_memory)
+        mismatch_df = compare_outputs(ref_run["output"], cand_run["output"], **kwargs)
+        mismatches_[name] = mismatch_df
+        report_rows.append(
+            {
+                "engine": name,
+                "reference_time_s": ref_run["time_s"],
+                "engine_time_s": cand_run["time_s"],
+                "speedup": ref_run["time_s"] / cand_run["time_s"],
+                "reference_peak_mem_mb": ref_run["peak_mem_mb"],
+                "engine_peak_mem_mb": cand_run["peak_mem_mb"],
+                "memory_ratio": (
+                    cand_run["peak_mem_mb"] / ref_run["peak_mem_mb"]
+                    if measure_memory
+                    else np.nan
+                ),
+                "reference_rows": len(ref_run["output"]),
+                "engine_rows": len(cand_run["output"]),
+                "mismatched_rows": len(mismatch_df),
+                "mismatched_routes": sorted(mismatch_df.route_id.unique()),
+                "no_crash_routes_match": (
+                    ref_run["no_crash_routes"] == cand_run["no_crash_routes"]
+                ),
+            }
+        )
+    report_df_ = pd.DataFrame(report_rows)
+    return {"report": report_df_, "mismatches": mismatches_}
+
+
+if __name__ == "__main__":
+    # Use the interim AADT and crash data for a few routes, or synthetic data.
+    # ************************************************************************************
+    use_real_data = False
+    if use_real_data:
+        path_to_prj_dir = get_project_root()
+        path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+        path_crash_si = os.path.join(path_interim_data, "nc_crash_si_2015_2019.gpkg")
+        path_aadt_nc = os.path.join(path_interim_data, "ncdot_2018_aadt.gpkg")
+        crash_gdf = gpd.read_file(path_crash_si, driver="gpkg")
+        aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+        equivalence_inputs = {
+            "aadt_gdf": aadt_gdf.query("route_no in [40, 95]"),
+            "crash_gdf": crash_gdf.query("route_no in [40, 95]").sort_values(
+                ["route_gis", "st_mp_pt"]
+            ),
+        }
+    else:
+        equivalence_inputs = make_synthetic_inputs(num_routes=50, seed=0)
+    equivalence = run_equivalence(equivalence_inputs)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(equivalence["report"])
@@ -5,6 +5,7 @@ from io import StringIO
 import pandas as pd
 import os
 from src.utils import get_project_root
+from src.data.reference_layers import load_reference_layer
 import geopandas as gpd
 import numpy as np
 
@@ -145,10 +146,7 @@ if __name__ == "__main__":
     path_to_prj_data = os.path.join(path_to_prj_dir, "data", "raw")
     path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
     path_aadt_nc = os.path.join(path_interim_data, "ncdot_2018_aadt.gpkg")
-    path_hpms_2018 = os.path.join(
-        path_to_prj_data, "hpms_northcarolina2018", "NorthCarolina_PR_2018.shp"
-    )
-    hpms_2018_nc = gpd.read_file(path_hpms_2018)
+    hpms_2018_nc = load_reference_layer("hpms_2018")["gdf"]
     aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
     aadt_gdf_fil = aadt_gdf.loc[lambda df: df.route_class.isin([1, 2, 3])]
     stc_df = get_strategic_trans_cor().assign(stc=True)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Store segment tables in Hilbert curve order of the segment centers, with bounding box
+statistics for each block of rows (row group). Spatial filters only read the row
+groups that intersect the query box, and row groups are spatially compact chunks for
+parallel spatial work.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+
+def get_hilbert_index(x, y, bounds, order=16):
+    """
+    Get the Hilbert curve index of points on a 2**order x 2**order grid.
+    Parameters
+    ----------
+    x: np.array
+        x coordinates.
+    y: np.array
+        y coordinates.
+    bounds: tuple
+        minx, miny, maxx, maxy of the grid.
+    order: int
+        Number of bits per axis. order <= 31.
+    Returns
+    -------
+    hilbert_idx: np.array
+        int64 Hilbert index for each point.
+    """
+    minx, miny, maxx, maxy = bounds
+    n = 2**order
+    width = max(maxx - minx, np.finfo(float).eps)
+    height = max(maxy - miny, np.finfo(float).eps)
+    xi = ((np.asarray(x) - minx) / width * (n - 1)).astype(np.int64).clip(0, n - 1)
+    yi = ((np.asarray(y) - miny) / height * (n - 1)).astype(np.int64).clip(0, n - 1)
+    hilbert_idx = np.zeros(len(xi), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        hilbert_idx += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # Rotate the quadrant so that the curve is continuous.
+        flip = (~ry) & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        xi, yi = np.where(~ry, yi, xi), np.where(~ry, xi, yi)
+        s //= 2
+    return hilbert_idx
+
+
+def sort_by_hilbert(gdf_, row_group_size=1000, order=16):
+    """
+    Sort gdf_ by the Hilbert index of the segment bounding box centers and assign row
+    groups.
+    Parameters
+    ----------
+    gdf_: gpd.GeoDataFrame()
+        Segment data, e.g. aadt_crash_ncdot.gpkg.
+    row_group_size: int
+        Number of rows in each row group.
+    order: int
+        Number of bits per axis for the Hilbert index.
+    Returns
+    -------
+    {"gdf": gdf_hilbert_, "row_group_stats": row_group_stats_}: dict
+        gdf: gdf_ in Hilbert order with "hilbert_idx" and "row_group" columns.
+        row_group_stats: row_start, row_stop, minx, miny, maxx, maxy for each row
+        group.
+    """
+    seg_bounds = gdf_.geometry.bounds
+    hilbert_idx = get_hilbert_index(
+        x=((seg_bounds.minx + seg_bounds.maxx) / 2).values,
+        y=((seg_bounds.miny + seg_bounds.maxy) / 2).values,
+        bounds=gdf_.total_bounds,
+        order=order,
+    )
+    sort_order = np.argsort(hilbert_idx, kind="stable")
+    gdf_hilbert_ = gdf_.iloc[sort_order].assign(
+        hilbert_idx=hilbert_idx[sort_order],
+        row_group=np.arange(len(gdf_)) // row_group_size,
+    )
+    row_group_stats_ = (
+        seg_bounds.iloc[sort_order]
+        .assign(
+            row_group=gdf_hilbert_.row_group.values,
+            row_num=np.arange(len(gdf_)),
+        )
+        .groupby("row_group")
+        .agg(
+            row_start=("row_num", "min"),
+            row_stop=("row_num", "max"),
+            minx=("minx", "min"),
+            miny=("miny", "min"),
+            maxx=("maxx", "max"),
+            maxy=("maxy", "max"),
+        )
+        .assign(row_stop=lambda df: df.row_stop + 1)
+        .reset_index()
+    )
+    return {"gdf": gdf_hilbert_, "row_group_stats": row_group_stats_}
+
+
+def get_row_group_stats_path(path_gpkg):
+    return f"{os.path.splitext(path_gpkg)[0]}_row_groups.csv"
+
+
+def write_hilbert_ordered(gdf_, path_gpkg, row_group_size=1000, order=16):
+    """
+    Write gdf_ in Hilbert order to a gpkg file and the row group bounding box
+    statistics to <file name>_row_groups.csv next to it.
+    Parameters
+    ----------
+    gdf_: gpd.GeoDataFrame()
+        Segment data.
+    path_gpkg: str
+        Output gpkg path.
+    row_group_size: int
+        Number of rows in each row group.
+    order: int
+        Number of bits per axis for the Hilbert index.
+    Returns
+    -------
+    row_group_stats_: pd.DataFrame()
+        Row group bounding box statistics.
+    """
+    hilbert_dict = sort_by_hilbert(gdf_, row_group_size=row_group_size, order=order)
+    hilbert_dict["gdf"].to_file(path_gpkg, driver="GPKG")
+    hilbert_dict["row_group_stats"].to_csv(
+        get_row_group_stats_path(path_gpkg), index=False
+    )
+    return hilbert_dict["row_group_stats"]
+
+
+def get_row_group_slices(row_group_stats_, bbox=None):
+    """
+    Get row slices for the row groups intersecting bbox. Adjacent row groups are
+    combined into one slice.
+    Parameters
+    ----------
+    row_group_stats_: pd.DataFrame()
+        Row group bounding box statistics.
+    bbox: tuple
+        minx, miny, maxx, maxy. None returns all row groups.
+    Returns
+    -------
+    list
+        List of slice objects.
+    """
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        row_group_stats_ = row_group_stats_.loc[
+            lambda df: (df.minx <= maxx)
+            & (df.maxx >= minx)
+            & (df.miny <= maxy)
+            & (df.maxy >= miny)
+        ]
+    row_slices = []
+    for row_start, row_stop in zip(
+        row_group_stats_.row_start, row_group_stats_.row_stop
+    ):
+        if row_slices and row_slices[-1].stop == row_start:
+            row_slices[-1] = slice(row_slices[-1].start, row_stop)
+        else:
+            row_slices.append(slice(row_start, row_stop))
+    return row_slices
+
+
+def read_hilbert_bbox(path_gpkg, bbox):
+    """
+    Read the segments intersecting bbox from a gpkg written by write_hilbert_ordered.
+    Only the row groups whose bounding box intersects bbox are read.
+    Parameters
+    ----------
+    path_gpkg: str
+        gpkg written by write_hilbert_ordered.
+    bbox: tuple
+        minx, miny, maxx, maxy.
+    Returns
+    -------
+    gpd.GeoDataFrame()
+        Segments whose bounding box intersects bbox.
+    """
+    row_group_stats_ = pd.read_csv(get_row_group_stats_path(path_gpkg))
+    row_slices = get_row_group_slices(row_group_stats_, bbox=bbox)
+    if len(row_slices) == 0:
+        return gpd.read_file(path_gpkg, rows=slice(0, 0))
+    gdf_bbox_ = pd.concat(
+        [gpd.read_file(path_gpkg, rows=row_slice) for row_slice in row_slices]
+    )
+    minx, miny, maxx, maxy = bbox
+    return gdf_bbox_.cx[minx:maxx, miny:maxy]
@@ -22,6 +22,7 @@ if __name__ == "__main__":
     crash_aadt_fil_si_geom_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
     route_id_lrs_gdf = crash_aadt_fil_si_geom_gdf.filter(
         items=[
+            "seg_id",
             "route_id",
             "aadt_interval_left",
             "aadt_interval_right",
@@ -91,7 +92,7 @@ if __name__ == "__main__":
     inc_fac_padt_gpd = pd.concat(inc_fac_padt_gpd_list, ignore_index=True)
     inc_fac_padt_gpd = (
         inc_fac_padt_gpd.groupby(
-            ["route_id", "aadt_interval_left", "aadt_interval_right"]
+            ["seg_id", "route_id", "aadt_interval_left", "aadt_interval_right"]
         )
         .agg(padt_rec=("padt_rec", "max"), geometry=("geometry", "first"),)
         .reset_index()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Registry for the static reference layers (county boundaries, census tracts, IMAP
+routes, HPMS network). Each layer is read and re-projected to EPSG:4326 once and
+cached in the interim data folder together with a fingerprint (modification time and
+size) and a hash of the source files, and a bounding box array that is memory-mapped
+on load. The source files are only hashed when the fingerprint changes. The cached
+layer itself is unpickled on load. The spatial index is built once per process and
+reused by all spatial joins.
+Created by: Apoorba Bibeka
+"""
+import os
+import json
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils import get_project_root
+
+path_to_prj_dir = get_project_root()
+path_to_raw = os.path.join(path_to_prj_dir, "data", "raw")
+path_reference_index = os.path.join(
+    path_to_prj_dir, "data", "interim", "reference_layers"
+)
+REFERENCE_LAYERS = {
+    "county_boundary": os.path.join(
+        path_to_raw, "CountyBoundary_SHP", "BoundaryCountyPolygon.shp"
+    ),
+    "census_tract_2010": os.path.join(
+        path_to_raw, "CensusTract2010", "CensusTract2010.shp"
+    ),
+    "imap_routes": os.path.join(
+        path_to_raw, "IMAP Routes", "Statewide_IMAP_Routes.shp"
+    ),
+    "hpms_2018": os.path.join(
+        path_to_raw, "hpms_northcarolina2018", "NorthCarolina_PR_2018.shp"
+    ),
+}
+
+
+def get_source_files(path_shp):
+    """
+    Get the shapefile and all its sidecar files (.dbf, .shx, .prj, ...) sorted by
+    name.
+    """
+    shp_dir, shp_file = os.path.split(path_shp)
+    shp_stem = os.path.splitext(shp_file)[0]
+    return sorted(
+        file for file in os.listdir(shp_dir) if os.path.splitext(file)[0] == shp_stem
+    )
+
+
+def get_source_fingerprint(path_shp):
+    """
+    Get a cheap fingerprint of the shapefile and its sidecar files: name,
+    modification time (ns), and size of each file.
+    """
+    shp_dir = os.path.dirname(path_shp)
+    fingerprint = []
+    for file in get_source_files(path_shp):
+        file_stat = os.stat(os.path.join(shp_dir, file))
+        fingerprint.append([file, file_stat.st_mtime_ns, file_stat.st_size])
+    return fingerprint
+
+
+def get_source_hash(path_shp):
+    """
+    Get a sha1 hash of the shapefile and all its sidecar files (.dbf, .shx, .prj, ...).
+    Parameters
+    ----------
+    path_shp: str
+        Path to the .shp file.
+    Returns
+    -------
+    str
+        Hex digest of the source files.
+    """
+    shp_dir = os.path.dirname(path_shp)
+    sha1 = hashlib.sha1()
+    for file in get_source_files(path_shp):
+        sha1.update(file.encode("utf-8"))
+        with open(os.path.join(shp_dir, file), "rb") as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b""):
+                sha1.update(block)
+    return sha1.hexdigest()
+
+
+def write_meta(name, meta):
+    with open(os.path.join(path_reference_index, name, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def build_reference_layer(name, source_hash=None, source_fingerprint=None):
+    """
+    Read a reference layer, re-project it to EPSG:4326, and cache it along with the
+    geometry bounds and the source fingerprint and hash.
+    Parameters
+    ----------
+    name: str
+        Key in REFERENCE_LAYERS.
+    source_hash: str
+        Hash of the source files. Computed if not provided.
+    source_fingerprint: list
+        Fingerprint of the source files. Computed if not provided.
+    """
+    path_shp = REFERENCE_LAYERS[name]
+    if source_fingerprint is None:
+        source_fingerprint = get_source_fingerprint(path_shp)
+    if source_hash is None:
+        source_hash = get_source_hash(path_shp)
+    path_layer_index = os.path.join(path_reference_index, name)
+    if not os.path.exists(path_layer_index):
+        os.makedirs(path_layer_index)
+    layer_gdf = gpd.read_file(path_shp).to_crs(epsg=4326)
+    layer_gdf.to_pickle(os.path.join(path_layer_index, "layer.pkl"))
+    np.save(
+        os.path.join(path_layer_index, "bounds.npy"),
+        layer_gdf.geometry.bounds.values.astype(np.float64),
+    )
+    write_meta(
+        name,
+        {
+            "name": name,
+            "source": path_shp,
+            "source_fingerprint": source_fingerprint,
+            "source_hash": source_hash,
+            "crs": "EPSG:4326",
+            "num_rows": len(layer_gdf),
+        },
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_reference_layer(name):
+    """
+    Load a reference layer from the cache. The cache is used as is when the
+    fingerprint (modification time and size) of the source files did not change.
+    Otherwise the source files are hashed and the cache is rebuilt if the hash
+    changed.
+    Parameters
+    ----------
+    name: str
+        Key in REFERENCE_LAYERS.
+    Returns
+    -------
+    {"gdf": layer_gdf, "bounds": bounds, "sindex": layer_gdf.sindex} : dict
+        gdf: reference layer in EPSG:4326, unpickled from the cache (not
+        memory-mapped). The same object is returned on every call, so it is only
+        loaded and its spatial index only built once per process.
+        bounds: memory-mapped (n, 4) array of minx, miny, maxx, maxy.
+        sindex: spatial index of gdf.
+    """
+    path_layer_index = os.path.join(path_reference_index, name)
+    path_meta = os.path.join(path_layer_index, "meta.json")
+    source_fingerprint = get_source_fingerprint(REFERENCE_LAYERS[name])
+    meta = {}
+    if os.path.exists(path_meta):
+        with open(path_meta) as f:
+            meta = json.load(f)
+    if meta.get("source_fingerprint") != source_fingerprint:
+        source_hash = get_source_hash(REFERENCE_LAYERS[name])
+        if meta.get("source_hash") != source_hash:
+            print(f"Building reference layer cache for {name}")
+            build_reference_layer(
+                name, source_hash=source_hash, source_fingerprint=source_fingerprint
+            )
+        else:
+            # Same content (e.g. the files were copied or touched).
+            write_meta(name, {**meta, "source_fingerprint": source_fingerprint})
+    layer_gdf = pd.read_pickle(os.path.join(path_layer_index, "layer.pkl"))
+    bounds = np.load(os.path.join(path_layer_index, "bounds.npy"), mmap_mode="r")
+    return {"gdf": layer_gdf, "bounds": bounds, "sindex": layer_gdf.sindex}
+
+
+def query_reference_bbox(name, bbox):
+    """
+    Get the rows of a reference layer whose bounds intersect a bounding box.
+    Parameters
+    ----------
+    name: str
+        Key in REFERENCE_LAYERS.
+    bbox: tuple
+        minx, miny, maxx, maxy in EPSG:4326.
+    Returns
+    -------
+    gpd.GeoDataFrame()
+        Rows of the reference layer intersecting bbox.
+    """
+    layer = load_reference_layer(name)
+    bounds = layer["bounds"]
+    minx, miny, maxx, maxy = bbox
+    mask = (
+        (bounds[:, 0] <= maxx)
+        & (bounds[:, 2] >= minx)
+        & (bounds[:, 1] <= maxy)
+        & (bounds[:, 3] >= miny)
+    )
+    return layer["gdf"].loc[mask]
+
+
+def sjoin_reference(left_gdf, name, how="inner", op="intersects", columns=None):
+    """
+    Spatial join left_gdf to a reference layer using the cached spatial index of the
+    reference layer.
+    Parameters
+    ----------
+    left_gdf: gpd.GeoDataFrame()
+        Data to join to the reference layer.
+    name: str
+        Key in REFERENCE_LAYERS.
+    how: str
+        "inner" or "left".
+    op: str
+        Spatial predicate passed to gpd.sjoin.
+    columns: list
+        Reference layer columns to keep. None keeps all columns.
+    Returns
+    -------
+    gpd.GeoDataFrame()
+        Joined data.
+    """
+    layer_gdf = load_reference_layer(name)["gdf"]
+    if left_gdf.crs != layer_gdf.crs:
+        left_gdf = left_gdf.to_crs(layer_gdf.crs)
+    joined_gdf = gpd.sjoin(left_gdf, layer_gdf, how=how, op=op)
+    if columns is not None:
+        drop_cols = [
+            col
+            for col in layer_gdf.columns.drop(layer_gdf.geometry.name)
+            if col not in columns and col not in left_gdf.columns
+        ]
+        joined_gdf = joined_gdf.drop(columns=drop_cols, errors="ignore")
+    return joined_gdf
+
+
+if __name__ == "__main__":
+    # Build or refresh the cache for all reference layers.
+    # ************************************************************************************
+    for layer_name in REFERENCE_LAYERS:
+        load_reference_layer(layer_name)
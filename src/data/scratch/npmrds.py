@@ -1,7 +1,26 @@
 # -*- coding: utf-8 -*-
 import os
+import numpy as np
 from src.utils import get_project_root
 from src.utils import read_shp
+from src.data.validation import validate_df
+
+NPMRDS_RULES = [
+    {
+        "rule": "not_null",
+        "cols": [
+            "county",
+            "tmc_linear",
+            "tmc",
+            "tmc_type",
+            "route_numb",
+            "route_qual",
+            "direction",
+            "geometry",
+            "aadt",
+        ],
+    }
+]
 
 
 def filter_npmrds_columns(npmrds_gdf_):
@@ -45,23 +64,8 @@ def filter_npmrds_columns(npmrds_gdf_):
 
 
 def test_missing_values(npmrds_gdf_):
-    npmrds_gdf_missing_val_ = npmrds_gdf_[
-        npmrds_gdf_[
-            [
-                "county",
-                "tmc_linear",
-                "tmc",
-                "tmc_type",
-                "route_numb",
-                "route_qual",
-                "direction",
-                "geometry",
-                "aadt",
-            ]
-        ]
-        .isna()
-        .any(axis=1)
-    ]
+    violations_df = validate_df(npmrds_gdf_, NPMRDS_RULES)
+    npmrds_gdf_missing_val_ = npmrds_gdf_.iloc[np.unique(violations_df.row.values)]
     missing_value = len(npmrds_gdf_missing_val_)
     try:
         assert missing_value == 0, (
@@ -2,13 +2,16 @@ import pandas as pd
 import geopandas as gpd
 import os
 from src.utils import get_project_root
+from src.data.reference_layers import load_reference_layer
+from src.features.composite_score import get_composite_scores
+from src.features.composite_score import DEFAULT_WEIGHT_SCENARIOS
+from src.visualization.compact_geojson import to_compact_geojson
+from src.visualization.compact_geojson import write_precompressed
 import plotly.io as pio
 import json
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import FastMarkerCluster
 import branca.colormap as cm
-from shapely.geometry import Point
-from folium.features import DivIcon
 import seaborn as sns
 import numpy as np
 
@@ -20,78 +23,143 @@ path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
 path_if_si_detour_nat_imp = os.path.join(
     path_processed_data, "if_si_detour_nat_imp.gpkg"
 )
-path_to_county = os.path.join(
-    path_to_raw, "CountyBoundary_SHP", "BoundaryCountyPolygon.shp",
-)
 path_to_nathan_inc_fac = os.path.join(path_to_raw, "nathan_inc_fac.xlsx")
-path_imap_routes = os.path.join(path_to_raw, "IMAP Routes", "Statewide_IMAP_Routes.shp")
 path_to_fig = os.path.join(path_to_prj_dir, "reports", "figures")
 path_to_fig_imap = os.path.join(path_to_fig, "imap_folium.html")
+path_to_scored_geojson = os.path.join(path_to_fig, "imap_scored_segments.geojson")
+path_to_imap_routes_geojson = os.path.join(path_to_fig, "imap_routes.geojson")
+# 5 decimal places is ~1 m in EPSG:4326.
+COORD_PRECISION = 5
 ########################################################################################################################
 # ADD Labels to the line segments
 #
 # mapobj = my_map
 # gdf = dat
 # popup_field_list = ["Route_ID","Begin_Poin","End_Point","IF","IF_Adj"]
-def add_points_AB_V3(mapobj, gdf, popup_field_list):
+def get_centroid_popup_arrays(gdf, popup_field_list, label_template="{field}: {value}"):
+    """
+    Get the centroid coordinates and the popup html for each row of gdf as arrays.
+    Parameters
+    ----------
+    gdf: gpd.GeoDataFrame()
+        geopandas dataframe having the attributes and line/ polygon coordinates.
+    popup_field_list: list
+        list of column names which need to displayed on the map.
+    label_template: str
+        Template used to render each field; "{field}" and "{value}" are replaced with
+        the column name and the column values.
+    Returns
+    -------
+    {"lat": lat, "lon": lon, "label": label}: dict
+        lat, lon: np.array of centroid coordinates.
+        label: np.array of html strings with the fields separated by a linebreak.
+    """
+    centroids = gdf.geometry.centroid
+    label_prefix, label_suffix = label_template.split("{value}")
+    label_cols = [
+        np.char.add(
+            np.char.add(
+                label_prefix.replace("{field}", field),
+                gdf[field].to_numpy().astype(str),
+            ),
+            label_suffix.replace("{field}", field),
+        )
+        for field in popup_field_list
+    ]
+    label = label_cols[0]
+    for label_col in label_cols[1:]:
+        label = np.char.add(np.char.add(label, "<br>"), label_col)
+    return {
+        "lat": centroids.y.values,
+        "lon": centroids.x.values,
+        "label": label,
+    }
+
+
+def get_point_feature_collection(gdf, popup_field_list, centroid_popup_arrays):
+    """
+    Build a GeoJSON FeatureCollection of segment centroids from columnar arrays.
+    Parameters
+    ----------
+    gdf: gpd.GeoDataFrame()
+        geopandas dataframe having the attributes.
+    popup_field_list: list
+        list of column names stored as feature properties.
+    centroid_popup_arrays: dict
+        Output from get_centroid_popup_arrays.
+    Returns
+    -------
+    geojson_: dict
+        FeatureCollection with one point feature per row in gdf.
+    """
+    # https://geoffboeing.com/2015/10/exporting-python-data-geojson/
+    properties = gdf[popup_field_list].astype(object).where(
+        gdf[popup_field_list].notna(), None
+    ).to_dict(orient="records")
+    geojson_ = {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": prop,
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            }
+            for lon, lat, prop in zip(
+                centroid_popup_arrays["lon"].tolist(),
+                centroid_popup_arrays["lat"].tolist(),
+                properties,
+            )
+        ],
+    }
+    return geojson_
+
+
+def add_points_AB_V3(mapobj, gdf, popup_field_list, path_markers_json=None):
     """
     mapobj: folium map object. Will be used for plotting
     gdf: geopandas dataframe having the attributes and line coordinates
     popup_field_list: list of column names which need to displayed on the map
+    path_markers_json: optional path to output the marker FeatureCollection
     """
     # Make Data Pretty
-    gdf.aadt_interval_left = gdf.aadt_interval_left.round(2)
-    gdf.aadt_interval_right = gdf.aadt_interval_right.round(2)
-    gdf.inc_fac = gdf.inc_fac.round(1)
-    # Need the centroid to create popup pins:
-    gdf["geometry"] = gdf.apply(
-        lambda z: Point(z.geometry.centroid.x, z.geometry.centroid.y), axis=1
+    gdf = gdf.assign(
+        aadt_interval_left=lambda df: df.aadt_interval_left.round(2),
+        aadt_interval_right=lambda df: df.aadt_interval_right.round(2),
+        inc_fac=lambda df: df.inc_fac.round(1),
     )
+    # Need the centroid to create popup pins:
+    centroid_popup_arrays = get_centroid_popup_arrays(gdf, popup_field_list)
     # Source: https://github.com/python-visualization/folium/pull/376
     # Source IMP:
     # https://github.com/python-visualization/folium/blob/master/examples/MarkerCluster.ipynb
-    # Create empty lists to contain the point coordinates and the point pop-up information
-    marker_cluster = MarkerCluster(name="IF Popup").add_to(mapobj)
-
-    # https://geoffboeing.com/2015/10/exporting-python-data-geojson/
-    # Create GeoJson for Features
-    geojson1 = {"type": "FeatureCollection", "features": []}
-    # Loop through each record in the GeoDataFrame
-    for i, row in gdf.iterrows():
-        # Create a string of HTML code used in the IFrame popup
-        # Join together the fields in "popup_field_list" with a linebreak between them
-        label = "<br>".join(
-            [field + ": " + str(row[field]) for field in popup_field_list]
+    # FastMarkerCluster creates the markers in the browser from one data array instead
+    # of one folium.Marker per segment.
+    # Change Popup Width to 150% to get all text inside the box
+    # https://python-visualization.github.io/folium/modules.html
+    # https://github.com/Leaflet/Leaflet.markercluster
+    marker_callback = """function (row) {
+        var icon = L.AwesomeMarkers.icon({icon: "ok-sign", markerColor: "green"});
+        var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+        marker.bindPopup(row[2], {maxWidth: 150});
+        return marker;
+    }"""
+    FastMarkerCluster(
+        data=list(
+            zip(
+                centroid_popup_arrays["lat"].tolist(),
+                centroid_popup_arrays["lon"].tolist(),
+                centroid_popup_arrays["label"].tolist(),
+            )
+        ),
+        callback=marker_callback,
+        name="IF Popup",
+    ).add_to(mapobj)
+    if path_markers_json is not None:
+        geojson1 = get_point_feature_collection(
+            gdf, popup_field_list, centroid_popup_arrays
         )
-        # Change Popup Width to 150% to get all text inside the box
-        # https://python-visualization.github.io/folium/modules.html
-        # https://github.com/Leaflet/Leaflet.markercluster
-        folium.Marker(
-            location=[row.geometry.y, row.geometry.x],
-            popup=folium.Popup(html=label, parse_html=False, max_width="150"),
-            icon=folium.Icon(color="green", icon="ok-sign"),
-        ).add_to(marker_cluster)
-
-        # https://geoffboeing.com/2015/10/exporting-python-data-geojson/
-        feature = {
-            "type": "Feature",
-            "properties": {},
-            "geometry": {"type": "Point", "coordinates": []},
-        }
-        feature["geometry"]["coordinates"] = [row.geometry.y, row.geometry.x]
-        for prop in popup_field_list:
-            feature["properties"][prop] = row[prop]
-        geojson1["features"].append(feature)
-    # PathMarkers = os.path.join(
-    #     os.path.expanduser("~"),
-    #     "OneDrive - Kittelson & Associates, Inc",
-    #     "Documents",
-    #     "IMAP_DashBoard",
-    #     "Data",
-    #     "FoliumMarkerCluster.json",
-    # )
-    # with open(PathMarkers, "w", encoding="utf-8") as f:
-    #     json.dump(geojson1, f, ensure_ascii=False, indent=4)
+        with open(path_markers_json, "w", encoding="utf-8") as f:
+            json.dump(geojson1, f, ensure_ascii=False)
     return mapobj
 
 
@@ -99,24 +167,30 @@ def add_points_AB_V3(mapobj, gdf, popup_field_list):
 
 
 def AddTextCounties(mapobj, gdf, popup_field_list):
-    gdf["geometry"] = gdf.apply(
-        lambda z: Point(z.geometry.centroid.x, z.geometry.centroid.y), axis=1
+    centroid_popup_arrays = get_centroid_popup_arrays(
+        gdf, popup_field_list, label_template="{value}"
     )
-    marker_cluster = MarkerCluster(name="County Names").add_to(mapobj)
-    # Loop through each record in the GeoDataFrame
-    for i, row in gdf.iterrows():
-        # Create a string of HTML code used in the IFrame popup
-        # Join together the fields in "popup_field_list" with a linebreak between them
-        label = "<br>".join([str(row[field]) for field in popup_field_list])
-        # Change Popup Width to 150% to get all text inside the box
-        # https://python-visualization.github.io/folium/modules.html
-        # https://github.com/python-visualization/folium/issues/970
-        folium.Marker(
-            location=[row.geometry.y, row.geometry.x],
-            icon=DivIcon(
-                html=f"""<div style="font-family: courier new;font size ="18"; color: 'black'">{"{}".format(label)}</div>"""
-            ),
-        ).add_to(marker_cluster)
+    # Join together the fields in "popup_field_list" with a linebreak between them
+    # https://github.com/python-visualization/folium/issues/970
+    text_callback = """function (row) {
+        var icon = L.divIcon({
+            html: '<div style="font-family: courier new; color: black">'
+                + row[2] + '</div>',
+            className: "",
+        });
+        return L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    }"""
+    FastMarkerCluster(
+        data=list(
+            zip(
+                centroid_popup_arrays["lat"].tolist(),
+                centroid_popup_arrays["lon"].tolist(),
+                centroid_popup_arrays["label"].tolist(),
+            )
+        ),
+        callback=text_callback,
+        name="County Names",
+    ).add_to(mapobj)
     return mapobj
 
 
@@ -133,26 +207,38 @@ def FoliumMapAB(
     caption_="Adjusted Incident Factor",
     name_="IF Heatmap",
     add_color_map=False,
+    precision=COORD_PRECISION,
+    breaks=None,
 ):
     """
     mapobj = folium map object
     dat = Geopandas dataframe used for plotting
     ColBins = # of color bins needed
+    precision = # of decimal places kept for the coordinates
+    breaks = color bin bounds, e.g. get_optimal_breaks(dat[colorFac], ColBins)[ColBins]
+        ["breaks"]. None uses the fixed bins from 0 to 100.
     """
     # Get dat into GeoPandas DataFrame
     dat = gpd.GeoDataFrame(dat, crs={"init": "epsg:4326"})
-    datJson = dat.to_json()  #
+    # Only the coloring field is needed in the line layer; the popups carry the rest.
+    datJson = to_compact_geojson(dat, precision=precision, properties=[colorFac])
     ###############################
     # datJson has "id" node which is the index for the "dat".
     # BUT it is string so convert your
     # index to strings.
     # Create a key value pair for color coding lines:
     dat_dict = dat.set_index(dat.index.astype("str"))[colorFac].sort_index()
-    Min1 = 0
-    Max1 = 100
+    if breaks is None:
+        Min1 = 0
+        Max1 = 100
+        l1 = np.linspace(7, Max1, ColBins).astype("int").tolist()
+        l1 = [Min1] + l1
+    else:
+        ColBins = len(breaks) - 1
+        l1 = list(breaks)
+        Min1 = l1[0]
+        Max1 = l1[-1]
     GrYlRe_Pal = ["green"] + sns.color_palette("YlOrRd", ColBins - 1)
-    l1 = np.linspace(7, Max1, ColBins).astype("int").tolist()
-    l1 = [Min1] + l1
     colormap = cm.StepColormap(
         GrYlRe_Pal, vmin=Min1, vmax=Max1, index=l1, caption=caption_,
     )
@@ -180,11 +266,9 @@ if __name__ == "__main__":
     if_process_df = if_process_df.rename(
         columns={"crash_rate_per_mile_per_year": "crash_per_mile_per_year"}
     )
-    if_process_df["adj_inc_fac"] = (
-        if_process_df.inc_fac
-        * (1 + if_process_df.si_fac * 0.25)
-        * ((1 + if_process_df.detour_fac * 0.25))
-    )
+    if_process_df["adj_inc_fac"] = get_composite_scores(
+        if_process_df, DEFAULT_WEIGHT_SCENARIOS.loc[["plot_if_default"]]
+    )[:, 0]
     if_process_df.crash_per_mile_per_year = if_process_df.crash_per_mile_per_year.round(
         2
     )
@@ -192,9 +276,8 @@ if __name__ == "__main__":
     if_process_df.si_fac = if_process_df.si_fac.round(2)
     if_process_df.detour_fac = if_process_df.detour_fac.round(2)
 
-    county_df = gpd.read_file(path_to_county, driver="shp")
-    county_df = county_df.to_crs(epsg=4326)
-    imap_gdf = gpd.read_file(path_imap_routes)
+    county_df = load_reference_layer("county_boundary")["gdf"]
+    imap_gdf = load_reference_layer("imap_routes")["gdf"]
     county_df_fil = (
         county_df.filter(items=["FIPS", "CountyName", "SapCountyI", "geometry"])
         .rename(
@@ -238,7 +321,9 @@ if __name__ == "__main__":
         ],
     )
     folium.GeoJson(
-        county_df_fil,
+        to_compact_geojson(
+            county_df_fil, precision=COORD_PRECISION, properties=["county_nm"]
+        ),
         name="County Boundaries",
         style_function=lambda feature: {"color": "black", "fill": False, "weight": 1},
     ).add_to(my_map)
@@ -246,7 +331,7 @@ if __name__ == "__main__":
     # http://plnkr.co/edit/KyHOkjytDJf1QjCO0Nyh?p=preview
     # https://leafletjs.com/reference-1.5.0.html#path-dasharray
     my_map = AddTextCounties(my_map, county_df_fil, ["county_nm"])
-    imap_json = imap_gdf.to_json()
+    imap_json = to_compact_geojson(imap_gdf, precision=COORD_PRECISION, properties=[])
     folium.GeoJson(
         imap_json,
         name="IMAP Routes",
@@ -259,3 +344,31 @@ if __name__ == "__main__":
     ).add_to(my_map)
     folium.LayerControl(collapsed=True).add_to(my_map)
     my_map.save(path_to_fig_imap)
+    # Write gzip and brotli sidecars for the map and the standalone layers so a
+    # static file server can send them as is.
+    # ************************************************************************************
+    with open(path_to_fig_imap, encoding="utf-8") as f:
+        write_precompressed(f.read(), path_to_fig_imap)
+    write_precompressed(
+        to_compact_geojson(
+            if_process_df,
+            precision=COORD_PRECISION,
+            properties=[
+                "route_id",
+                "route_class",
+                "route_no",
+                "route_county",
+                "aadt_interval_left",
+                "aadt_interval_right",
+                "inc_fac",
+                "adj_inc_fac",
+                "si_fac",
+                "detour_fac",
+                "nat_imp_fac",
+                "growth_fac",
+                "seasonal_fac",
+            ],
+        ),
+        path_to_scored_geojson,
+    )
+    write_precompressed(imap_json, path_to_imap_routes_geojson)
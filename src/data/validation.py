@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Rule based validation of the LRS layers (AADT, crash, NPMRDS). A rule set is a list of
+rule dicts, e.g.
+{"rule": "not_null", "cols": ["route_id", "st_mp_pt"], "severity": "error"}
+All rules are evaluated on each chunk of a table, so a table streamed in chunks (e.g.
+read_file_chunks) is validated in one scan. The violations are collected in a columnar
+table with one row per violation: row, rule, col, value, and severity.
+Rules:
+    not_null: missing values in cols.
+    county_from_route_id: county number in route_col (characters 9-11) does not match
+        county_col.
+    mp_order: end milepost (end_col) before the start milepost (st_col).
+    no_overlap: interval starts before the end of an earlier interval on the same route.
+        The check carries the maximum end of each route across chunks; the rows of a
+        route need to be in start milepost order across chunks.
+    valid_geometry: missing, empty, or invalid geometry in geometry_col.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils import get_project_root
+
+VIOLATION_COLS = ["row", "rule", "col", "value", "severity"]
+
+
+def get_violations(row, rule, col, value, severity):
+    """
+    Columnar violations of one rule in one chunk.
+    """
+    return {
+        "row": np.asarray(row, dtype=np.int64),
+        "rule": np.full(len(row), rule, dtype=object),
+        "col": np.full(len(row), col, dtype=object),
+        "value": np.asarray(pd.Series(value, dtype=object).astype(str), dtype=object),
+        "severity": np.full(len(row), severity, dtype=object),
+    }
+
+
+def check_not_null(chunk_df_, rule, row_offset, state):
+    violations = []
+    for col in rule["cols"]:
+        is_null = chunk_df_[col].isna().values
+        violations.append(
+            get_violations(
+                row=row_offset + np.flatnonzero(is_null),
+                rule="not_null",
+                col=col,
+                value=chunk_df_[col].values[is_null],
+                severity=rule.get("severity", "error"),
+            )
+        )
+    return violations
+
+
+def check_county_from_route_id(chunk_df_, rule, row_offset, state):
+    route_col = rule.get("route_col", "route_id")
+    county_col = rule.get("county_col", "county")
+    route_county = pd.to_numeric(
+        chunk_df_[route_col].astype(str).str.split(".").str[0].str[8:11],
+        errors="coerce",
+    ).values
+    county = pd.to_numeric(chunk_df_[county_col], errors="coerce").values
+    is_mismatch = route_county != county
+    return [
+        get_violations(
+            row=row_offset + np.flatnonzero(is_mismatch),
+            rule="county_from_route_id",
+            col=county_col,
+            value=chunk_df_[route_col].values[is_mismatch],
+            severity=rule.get("severity", "error"),
+        )
+    ]
+
+
+def check_mp_order(chunk_df_, rule, row_offset, state):
+    st_col = rule.get("st_col", "st_mp_pt")
+    end_col = rule.get("end_col", "end_mp_pt")
+    st_mp = chunk_df_[st_col].values.astype(float)
+    end_mp = chunk_df_[end_col].values.astype(float)
+    is_reversed = end_mp < st_mp
+    return [
+        get_violations(
+            row=row_offset + np.flatnonzero(is_reversed),
+            rule="mp_order",
+            col=end_col,
+            value=end_mp[is_reversed],
+            severity=rule.get("severity", "error"),
+        )
+    ]
+
+
+def check_no_overlap(chunk_df_, rule, row_offset, state):
+    route_col = rule.get("route_col", "route_id")
+    st_col = rule.get("st_col", "st_mp_pt")
+    end_col = rule.get("end_col", "end_mp_pt")
+    # Maximum end milepost of each route in the earlier chunks.
+    route_max_end = state.setdefault("no_overlap", {}).setdefault(
+        (route_col, st_col, end_col), {}
+    )
+    route_codes, route_uniq = pd.factorize(chunk_df_[route_col])
+    st_mp = chunk_df_[st_col].values.astype(float)
+    end_mp = chunk_df_[end_col].values.astype(float)
+    # Rows without a route (code -1) are skipped.
+    sort_order = np.lexsort((st_mp, route_codes))
+    sort_order = sort_order[route_codes[sort_order] >= 0]
+    route_sorted = route_codes[sort_order]
+    end_sorted = pd.Series(end_mp[sort_order])
+    # Maximum end of the earlier intervals of the route in this chunk ...
+    prev_max_end = (
+        end_sorted.groupby(route_sorted).cummax().groupby(route_sorted).shift().values
+    )
+    # ... and in the earlier chunks.
+    carried_max_end = np.array(
+        [route_max_end.get(route, -np.inf) for route in route_uniq], dtype=float
+    )
+    prev_max_end = np.fmax(prev_max_end, carried_max_end[route_sorted])
+    is_overlap = np.zeros(len(chunk_df_), dtype=bool)
+    is_overlap[sort_order] = st_mp[sort_order] < prev_max_end
+    chunk_max_end = end_sorted.groupby(route_sorted).max()
+    for route_code, max_end in chunk_max_end.items():
+        route = route_uniq[route_code]
+        route_max_end[route] = max(route_max_end.get(route, -np.inf), max_end)
+    return [
+        get_violations(
+            row=row_offset + np.flatnonzero(is_overlap),
+            rule="no_overlap",
+            col=st_col,
+            value=st_mp[is_overlap],
+            severity=rule.get("severity", "warning"),
+        )
+    ]
+
+
+def check_valid_geometry(chunk_df_, rule, row_offset, state):
+    geometry_col = rule.get("geometry_col", "geometry")
+    geometry = gpd.GeoSeries(chunk_df_[geometry_col])
+    is_null = geometry.isna().values
+    is_invalid = is_null.copy()
+    is_invalid[~is_null] = (
+        geometry[~is_null].is_empty.values | ~geometry[~is_null].is_valid.values
+    )
+    return [
+        get_violations(
+            row=row_offset + np.flatnonzero(is_invalid),
+            rule="valid_geometry",
+            col=geometry_col,
+            value=np.where(is_null[is_invalid], "missing", "empty or invalid"),
+            severity=rule.get("severity", "error"),
+        )
+    ]
+
+
+RULE_CHECKS = {
+    "not_null": check_not_null,
+    "county_from_route_id": check_county_from_route_id,
+    "mp_order": check_mp_order,
+    "no_overlap": check_no_overlap,
+    "valid_geometry": check_valid_geometry,
+}
+
+
+def validate_chunks(chunks, rules):
+    """
+    Validate a table streamed in chunks.
+    Parameters
+    ----------
+    chunks: iterable
+        DataFrames or GeoDataFrames with consecutive rows of the table.
+    rules: list
+        Rule dicts; "rule" is a key of RULE_CHECKS and the other keys are the options
+        of the rule.
+    Returns
+    -------
+    violations_df_: pd.DataFrame()
+        One row per violation with the row position in the table, rule, column,
+        offending value (as text), and severity, sorted by row.
+    """
+    violations = []
+    state = {}
+    row_offset = 0
+    for chunk_df in chunks:
+        for rule in rules:
+            violations.extend(
+                RULE_CHECKS[rule["rule"]](chunk_df, rule, row_offset, state)
+            )
+        row_offset += len(chunk_df)
+    if len(violations) == 0:
+        return pd.DataFrame(columns=VIOLATION_COLS)
+    violations_df_ = pd.DataFrame(
+        {
+            col: np.concatenate([violation[col] for violation in violations])
+            for col in VIOLATION_COLS
+        }
+    )
+    # Same order for any chunk size: by row, then in the order of the rules.
+    violations_df_ = violations_df_.sort_values("row", kind="mergesort").reset_index(
+        drop=True
+    )
+    return violations_df_
+
+
+def validate_df(df_, rules, chunk_size=None):
+    """
+    Validate a table in memory, optionally in chunks of chunk_size rows.
+    """
+    if chunk_size is None:
+        return validate_chunks([df_], rules)
+    return validate_chunks(
+        (
+            df_.iloc[chunk_st : chunk_st + chunk_size]
+            for chunk_st in range(0, len(df_), chunk_size)
+        ),
+        rules,
+    )
+
+
+def read_file_chunks(path, chunk_size=100000, **kwargs):
+    """
+    Read a gpkg or shapefile in chunks of chunk_size rows.
+    """
+    # Imported here so that the rule checks do not need fiona.
+    import fiona
+
+    with fiona.open(path) as src:
+        num_rows = len(src)
+    for chunk_st in range(0, num_rows, chunk_size):
+        yield gpd.read_file(path, rows=slice(chunk_st, chunk_st + chunk_size), **kwargs)
+
+
+def get_violation_summary(violations_df_):
+    """
+    Count the violations by rule, column, and severity.
+    """
+    return (
+        violations_df_.groupby(["rule", "col", "severity"])
+        .size()
+        .rename("num_violations")
+        .reset_index()
+    )
+
+
+if __name__ == "__main__":
+    # Validate the cleaned AADT and crash layers in chunks and write the violations.
+    # ************************************************************************************
+    path_to_prj_dir = get_project_root()
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    lrs_rules = {
+        "ncdot_2018_aadt": [
+            {"rule": "not_null", "cols": ["route_id", "st_mp_pt", "end_mp_pt"]},
+            {"rule": "mp_order"},
+            {"rule": "no_overlap", "route_col": "route_id"},
+            {"rule": "valid_geometry"},
+        ],
+        "nc_crash_si_2015_2019": [
+            {"rule": "not_null", "cols": ["route_gis", "st_mp_pt", "end_mp_pt"]},
+            {"rule": "county_from_route_id", "route_col": "route_gis"},
+            {"rule": "mp_order"},
+            {"rule": "no_overlap", "route_col": "route_gis"},
+            {"rule": "valid_geometry"},
+        ],
+    }
+    for layer_name, rules in lrs_rules.items():
+        violations_df = validate_chunks(
+            read_file_chunks(
+                os.path.join(path_interim_data, f"{layer_name}.gpkg"),
+                chunk_size=100000,
+                driver="gpkg",
+            ),
+            rules,
+        )
+        print(f"{layer_name}:\n{get_violation_summary(violations_df)}")
+        violations_df.to_csv(
+            os.path.join(path_interim_data, f"{layer_name}_violations.csv"), index=False
+        )
@@ -0,0 +1,110 @@
+"""
+Collect data anomalies found by the pipeline (e.g. overlapping AADT intervals, routes
+without crash data) as rows of route, milepost, kind, and values, with a counter per
+kind, and write them once at the end of the run instead of printing them in the loops.
+Created by: Apoorba Bibeka
+"""
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from src.utils import get_project_root
+
+DIAGNOSTIC_COLS = ["route_id", "milepost", "kind", "values"]
+
+
+def new_diagnostics(run_name):
+    """
+    Create an empty diagnostics collector for a run.
+    """
+    return {
+        "run_name": run_name,
+        "rows": {col: [] for col in DIAGNOSTIC_COLS},
+        "counts": {},
+    }
+
+
+def record_many(diagnostics, kind, route_ids, mileposts=None, values=None):
+    """
+    Record anomalies of one kind.
+    Parameters
+    ----------
+    diagnostics: dict
+        Collector from new_diagnostics.
+    kind: str
+        Kind of anomaly, e.g. "overlapping_aadt_interval".
+    route_ids: array-like
+        Route of each anomaly.
+    mileposts: array-like
+        Milepost of each anomaly; None for route level anomalies.
+    values: dict
+        {name: array-like} values to keep with each anomaly, e.g. the interval ends.
+        Stored as "name=value" text.
+    """
+    route_ids = list(route_ids)
+    num_rows = len(route_ids)
+    if num_rows == 0:
+        return
+    if mileposts is None:
+        mileposts = np.full(num_rows, np.nan)
+    if values is None:
+        values_text = [""] * num_rows
+    else:
+        values_text = [
+            ";".join(f"{name}={val}" for name, val in zip(values.keys(), row_values))
+            for row_values in zip(*values.values())
+        ]
+    rows = diagnostics["rows"]
+    rows["route_id"].extend(route_ids)
+    rows["milepost"].extend(mileposts)
+    rows["kind"].extend([kind] * num_rows)
+    rows["values"].extend(values_text)
+    diagnostics["counts"][kind] = diagnostics["counts"].get(kind, 0) + num_rows
+
+
+def record(diagnostics, kind, route_id, milepost=np.nan, values=None):
+    """
+    Record one anomaly.
+    """
+    record_many(
+        diagnostics,
+        kind,
+        [route_id],
+        [milepost],
+        None if values is None else {name: [val] for name, val in values.items()},
+    )
+
+
+def get_diagnostics_df(diagnostics):
+    return pd.DataFrame(diagnostics["rows"], columns=DIAGNOSTIC_COLS)
+
+
+def get_diagnostics_summary(diagnostics):
+    """
+    One line with the number of anomalies of each kind.
+    """
+    if len(diagnostics["counts"]) == 0:
+        return f"{diagnostics['run_name']}: no anomalies."
+    counts_text = ", ".join(
+        f"{kind}: {count}" for kind, count in diagnostics["counts"].items()
+    )
+    return f"{diagnostics['run_name']}: {counts_text}."
+
+
+def write_diagnostics(diagnostics, path_diagnostics=None):
+    """
+    Write the anomalies to path_diagnostics (default: a time-stamped csv in the
+    diagnostics interim folder) and return the path.
+    """
+    if path_diagnostics is None:
+        path_diagnostics_dir = os.path.join(
+            get_project_root(), "data", "interim", "diagnostics"
+        )
+        if not os.path.isdir(path_diagnostics_dir):
+            os.makedirs(path_diagnostics_dir)
+        time_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        path_diagnostics = os.path.join(
+            path_diagnostics_dir, f"{diagnostics['run_name']}_{time_stamp}.csv"
+        )
+    get_diagnostics_df(diagnostics).to_csv(path_diagnostics, index=False)
+    return path_diagnostics
@@ -0,0 +1,358 @@
+"""
+Materialized aggregate cube of the scored segments by county, division, route class,
+route number, route qualifier, national importance category, and IMAP coverage. The
+cube keeps additive measures (segment and crash counts, lengths, AADT, IF, and SI
+sums) for every combination of the dimensions (all 128 roll-ups), so the dashboard
+roll-ups and the county x route_no x route_class QAQC aggregates
+(get_if_by_county_qaqc.py) are lookups. Mean AADT, crash rate, and county level IF
+and SI are derived from the sums on lookup. When segments change, only the cells of
+the changed segments are updated.
+Created by: Apoorba Bibeka
+"""
+import os
+import itertools
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils import get_project_root
+from src.data.crash import get_severity_index
+from src.data.reference_layers import load_reference_layer
+
+CUBE_DIMS = [
+    "county",
+    "division",
+    "route_class",
+    "route_no",
+    "route_qual",
+    "nat_imp_cat",
+    "imap_coverage",
+]
+# Numeric codes in the scored segments; kept as integer text in the cube.
+CODE_DIMS = ["route_no", "route_qual"]
+SUM_COLS = [
+    "ka_cnt",
+    "bc_cnt",
+    "pdo_cnt",
+    "total_cnt",
+    "seg_len_in_interval",
+    "st_end_diff_aadt",
+    "imap_covered_len_mi",
+]
+# Columns averaged over the segments (sum and count of the non-missing values).
+MEAN_COLS = ["aadt_2018", "inc_fac", "si_fac"]
+MEASURE_COLS = (
+    ["num_seg"]
+    + SUM_COLS
+    + [f"{col}_sum" for col in MEAN_COLS]
+    + [f"{col}_num" for col in MEAN_COLS]
+)
+# Upper bound of the "partial" IMAP coverage category; segments above it are "full".
+FULL_COVERAGE_FRAC = 0.99
+
+
+def get_county_division(path_nathan_inc_fac):
+    """
+    Get the NCDOT division of each county (county_nm, division) from the county
+    level IF sheet used in get_if_by_county_qaqc.py.
+    """
+    return (
+        pd.read_excel(path_nathan_inc_fac)
+        .assign(
+            county_nm=lambda df: df.County.str.upper().str.strip(),
+            division=lambda df: df.Division.astype(str).str.strip(),
+        )
+        .filter(items=["county_nm", "division"])
+        .drop_duplicates("county_nm")
+    )
+
+
+def get_segment_cells(seg_df_, county_df_=None, county_division_=None):
+    """
+    Get the cube dimensions and the additive measures of each segment.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame
+        Scored segments with seg_id, route_county, route_class, route_no,
+        route_qual, nat_imp_cat, the SUM_COLS and MEAN_COLS, and imap_covered_frac
+        (imap_coverage.gpkg).
+    county_df_: pd.DataFrame
+        County names (county_nm) by sap_county_id. Needed for the division.
+    county_division_: pd.DataFrame
+        Division (division) by county_nm, e.g. from get_county_division.
+    Returns
+    -------
+    seg_cells_: pd.DataFrame
+        CUBE_DIMS and MEASURE_COLS indexed by seg_id. Missing dimensions are
+        "unknown".
+    """
+    seg_cells_ = pd.DataFrame(seg_df_.drop(columns="geometry", errors="ignore"))
+    if county_df_ is not None and county_division_ is not None:
+        seg_cells_ = seg_cells_.merge(
+            county_df_.filter(items=["sap_county_id", "county_nm"]).merge(
+                county_division_, on="county_nm", how="left"
+            ),
+            left_on="route_county",
+            right_on="sap_county_id",
+            how="left",
+        )
+    else:
+        seg_cells_ = seg_cells_.assign(division=np.nan)
+    imap_covered_frac = seg_cells_.imap_covered_frac.values.astype(float)
+    seg_cells_ = seg_cells_.assign(
+        county=lambda df: pd.to_numeric(df.route_county, errors="coerce")
+        .astype("Int64")
+        .astype(str),
+        imap_coverage=np.select(
+            [
+                imap_covered_frac > FULL_COVERAGE_FRAC,
+                imap_covered_frac > 0,
+                imap_covered_frac == 0,
+            ],
+            ["full", "partial", "none"],
+            "unknown",
+        ),
+        num_seg=1,
+    )
+    for col in CODE_DIMS:
+        seg_cells_[col] = (
+            pd.to_numeric(seg_cells_[col], errors="coerce").astype("Int64").astype(str)
+        )
+    for col in CUBE_DIMS:
+        seg_cells_[col] = (
+            seg_cells_[col]
+            .astype(object)
+            .where(seg_cells_[col].notna() & (seg_cells_[col] != "<NA>"), "unknown")
+            .astype(str)
+        )
+    for col in SUM_COLS:
+        seg_cells_[col] = seg_cells_[col].astype(float).fillna(0)
+    for col in MEAN_COLS:
+        seg_cells_[f"{col}_sum"] = seg_cells_[col].astype(float).fillna(0)
+        seg_cells_[f"{col}_num"] = seg_cells_[col].notna().astype(int)
+    seg_cells_ = seg_cells_.set_index("seg_id").filter(items=CUBE_DIMS + MEASURE_COLS)
+    return seg_cells_
+
+
+def aggregate_cells(seg_cells_, by):
+    """
+    Sum the measures of seg_cells_ by the dimensions in by. The roll-up over all the
+    dimensions (by empty) has one "statewide" row.
+    """
+    if len(by) == 0:
+        cells = seg_cells_[MEASURE_COLS].sum().to_frame().T
+        cells.index = pd.Index(["statewide"], name="statewide")
+        return cells
+    return seg_cells_.groupby(list(by))[MEASURE_COLS].sum()
+
+
+def get_rollup_keys(dims=CUBE_DIMS):
+    """
+    All the combinations of dims (in the order of dims).
+    """
+    return [
+        rollup_key
+        for num_dims in range(len(dims) + 1)
+        for rollup_key in itertools.combinations(dims, num_dims)
+    ]
+
+
+def build_cube(seg_cells_):
+    """
+    Build the cube from the segment cells (get_segment_cells).
+    Returns
+    -------
+    cube_: dict
+        seg_cells: segment cells indexed by seg_id (used for the incremental
+        updates).
+        rollups: {dims tuple: measures summed by the dims}.
+    """
+    base_cells = aggregate_cells(seg_cells_, CUBE_DIMS)
+    rollups = {tuple(CUBE_DIMS): base_cells}
+    # The coarser roll-ups are summed from the base cells instead of the segments.
+    base_cells_flat = base_cells.reset_index()
+    for rollup_key in get_rollup_keys():
+        if rollup_key not in rollups:
+            rollups[rollup_key] = aggregate_cells(base_cells_flat, rollup_key)
+    return {"seg_cells": seg_cells_.copy(), "rollups": rollups}
+
+
+def add_cell_delta(rollup_df_, delta_df_):
+    """
+    Add delta_df_ to the matching cells of rollup_df_ (new cells are appended) and
+    drop the changed cells that no longer have segments.
+    """
+    is_existing = delta_df_.index.isin(rollup_df_.index)
+    existing_index = delta_df_.index[is_existing]
+    rollup_df_.loc[existing_index, MEASURE_COLS] = (
+        rollup_df_.loc[existing_index, MEASURE_COLS].values
+        + delta_df_.loc[is_existing, MEASURE_COLS].values
+    )
+    rollup_df_ = pd.concat([rollup_df_, delta_df_.loc[~is_existing]])
+    is_empty = rollup_df_.loc[delta_df_.index, "num_seg"] <= 0
+    return rollup_df_.drop(index=is_empty.index[is_empty.values])
+
+
+def update_cube(cube_, changed_seg_cells_=None, deleted_seg_ids=()):
+    """
+    Update the cube in place for new or changed segments and deleted segments. Only
+    the cells of the changed segments are touched.
+    Parameters
+    ----------
+    cube_: dict
+        Output from build_cube.
+    changed_seg_cells_: pd.DataFrame
+        New values of the new or changed segments (get_segment_cells).
+    deleted_seg_ids: array-like
+        seg_id of the deleted segments.
+    """
+    if changed_seg_cells_ is None:
+        changed_seg_cells_ = cube_["seg_cells"].iloc[:0]
+    seg_cells = cube_["seg_cells"]
+    old_seg_ids = seg_cells.index.intersection(
+        changed_seg_cells_.index.union(pd.Index(deleted_seg_ids))
+    )
+    old_seg_cells = seg_cells.loc[old_seg_ids]
+    # Old contribution with negative measures plus the new contribution.
+    delta_cells = pd.concat(
+        [
+            old_seg_cells.assign(**{col: -old_seg_cells[col] for col in MEASURE_COLS}),
+            changed_seg_cells_,
+        ]
+    )
+    if len(delta_cells) == 0:
+        return cube_
+    for rollup_key, rollup_df in cube_["rollups"].items():
+        cube_["rollups"][rollup_key] = add_cell_delta(
+            rollup_df, aggregate_cells(delta_cells, rollup_key)
+        )
+    cube_["seg_cells"] = pd.concat(
+        [seg_cells.drop(index=old_seg_ids), changed_seg_cells_]
+    )
+    return cube_
+
+
+def get_rollup(cube_, by=(), where=None, crash_num_years=5):
+    """
+    Look up the measures by the dimensions in by and add the derived columns.
+    Parameters
+    ----------
+    cube_: dict
+        Output from build_cube.
+    by: tuple
+        Dimensions in CUBE_DIMS. () gives the statewide total.
+    where: dict
+        {dimension: value} to keep only the cells with the value, e.g.
+        {"route_qual": "0"}. The cells are selected from the roll-up by the
+        dimensions in by and where.
+    crash_num_years: int
+        Number of years of crash data.
+    Returns
+    -------
+    rollup_df_: pd.DataFrame
+        Measures and the mean aadt_2018, inc_fac, and si_fac, the crash rate per mile
+        per year, the IMAP covered fraction, and the county level IF and SI (as in
+        get_if_by_county_qaqc.py) for each cell, indexed by the dimensions in by (in
+        the order of by).
+    """
+    where = {} if where is None else where
+    unknown_dims = (set(by) | set(where)) - set(CUBE_DIMS)
+    if unknown_dims:
+        raise ValueError(f"Unknown dimensions: {sorted(unknown_dims)}")
+    rollup_key = tuple(dim for dim in CUBE_DIMS if dim in by or dim in where)
+    rollup_df_ = cube_["rollups"][rollup_key].copy()
+    if len(where) > 0:
+        is_selected = np.ones(len(rollup_df_), dtype=bool)
+        for dim, value in where.items():
+            is_selected &= rollup_df_.index.get_level_values(dim) == str(value)
+        rollup_df_ = rollup_df_.loc[is_selected]
+        by_key = tuple(dim for dim in rollup_key if dim in by)
+        if len(by_key) == 0:
+            rollup_df_.index = pd.Index(
+                ["statewide"] * len(rollup_df_), name="statewide"
+            )
+        elif len(by_key) < len(rollup_key):
+            rollup_df_ = rollup_df_.reset_index(
+                level=[dim for dim in rollup_key if dim not in by_key], drop=True
+            )
+    if len(by) > 1:
+        rollup_df_ = rollup_df_.reorder_levels(list(by))
+    for col in MEAN_COLS:
+        rollup_df_[col] = rollup_df_[f"{col}_sum"] / rollup_df_[f"{col}_num"].replace(
+            0, np.nan
+        )
+    rollup_df_ = rollup_df_.assign(
+        total_cnt_per_year=lambda df: df.total_cnt / crash_num_years,
+        crash_rate_per_mile_per_year=lambda df: (
+            df.total_cnt / df.seg_len_in_interval.replace(0, np.nan) / crash_num_years
+        ),
+        inc_fac_county_lev=lambda df: df.crash_rate_per_mile_per_year
+        * df.aadt_2018
+        / 100000,
+        imap_covered_frac=lambda df: df.imap_covered_len_mi
+        / df.st_end_diff_aadt.replace(0, np.nan),
+    )
+    rollup_df_.loc[:, "si_county_lev"] = get_severity_index(
+        rollup_df_
+    ).severity_index.values
+    return rollup_df_
+
+
+def write_cube(cube_, path_cube):
+    pd.to_pickle(cube_, path_cube)
+
+
+def read_cube(path_cube):
+    return pd.read_pickle(path_cube)
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_to_raw = os.path.join(path_to_prj_dir, "data", "raw")
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_imap_coverage = os.path.join(path_processed_data, "imap_coverage.gpkg")
+    path_to_nathan_inc_fac = os.path.join(path_to_raw, "nathan_inc_fac.xlsx")
+    path_cube = os.path.join(path_processed_data, "aggregate_cube.pkl")
+    path_cube_by_county = os.path.join(path_processed_data, "aggregate_by_county.csv")
+    update_only = os.path.exists(path_cube)
+    # Segment cells from the scored segments with IMAP coverage (imap_coverage.py).
+    # ************************************************************************************
+    county_df = load_reference_layer("county_boundary")["gdf"]
+    county_df_fil = (
+        county_df.filter(items=["CountyName", "SapCountyI"])
+        .rename(columns={"CountyName": "county_nm", "SapCountyI": "sap_county_id"})
+        .assign(
+            sap_county_id=lambda df: df.sap_county_id.astype(int),
+            county_nm=lambda df: df.county_nm.str.upper().str.strip(),
+        )
+    )
+    seg_cells = get_segment_cells(
+        gpd.read_file(path_imap_coverage, driver="gpkg"),
+        county_df_=county_df_fil,
+        county_division_=get_county_division(path_to_nathan_inc_fac),
+    )
+    # Update the cells of the changed segments or build the cube the first time.
+    # ************************************************************************************
+    if update_only:
+        cube = read_cube(path_cube)
+        prev_seg_cells = cube["seg_cells"]
+        common_seg_ids = seg_cells.index.intersection(prev_seg_cells.index)
+        is_changed = (
+            seg_cells.loc[common_seg_ids]
+            .ne(prev_seg_cells.loc[common_seg_ids, seg_cells.columns])
+            .any(axis=1)
+        )
+        changed_seg_ids = common_seg_ids[is_changed.values].union(
+            seg_cells.index.difference(prev_seg_cells.index)
+        )
+        deleted_seg_ids = prev_seg_cells.index.difference(seg_cells.index)
+        print(
+            f"Updating {len(changed_seg_ids)} changed and {len(deleted_seg_ids)} "
+            f"deleted segments."
+        )
+        update_cube(cube, seg_cells.loc[changed_seg_ids], deleted_seg_ids)
+    else:
+        cube = build_cube(seg_cells)
+    write_cube(cube, path_cube)
+    get_rollup(cube, by=("county",)).reset_index().to_csv(
+        path_cube_by_county, index=False
+    )
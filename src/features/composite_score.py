@@ -0,0 +1,169 @@
+"""
+Compute the adjusted incident factor (composite score) for many weight scenarios at
+once. The composite score for a scenario with weights w is
+inc_fac * (1 + w_si * si_fac) * (1 + w_detour * detour_fac) * ... over the factors in
+FACTOR_COLS. The plot_if.py score is the scenario with w_si = w_detour = 0.25.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from src.utils import get_project_root
+
+FACTOR_COLS = ["si_fac", "detour_fac", "nat_imp_fac", "growth_fac", "seasonal_fac"]
+DEFAULT_WEIGHT_SCENARIOS = pd.DataFrame(
+    {
+        "si_fac": [0.25],
+        "detour_fac": [0.25],
+        "nat_imp_fac": [0],
+        "growth_fac": [0],
+        "seasonal_fac": [0],
+    },
+    index=pd.Index(["plot_if_default"], name="scenario"),
+)
+
+
+def read_weight_scenarios(path_weight_scenarios, factor_cols=FACTOR_COLS):
+    """
+    Read weight scenarios from a csv file with a "scenario" column and one column per
+    factor. Factors missing in the file get a weight of 0.
+    Parameters
+    ----------
+    path_weight_scenarios: str
+        Path to the csv file.
+    factor_cols: list
+        Factor columns.
+    Returns
+    -------
+    pd.DataFrame()
+        Weight scenarios (k x f) indexed by scenario name.
+    """
+    weight_scenarios_ = pd.read_csv(path_weight_scenarios).set_index("scenario")
+    return weight_scenarios_.reindex(columns=factor_cols).fillna(0)
+
+
+def get_composite_scores(
+    seg_df_,
+    weight_scenarios_=DEFAULT_WEIGHT_SCENARIOS,
+    base_col="inc_fac",
+    factor_cols=FACTOR_COLS,
+    fill_factor_na=None,
+):
+    """
+    Compute the composite score of all segments for all weight scenarios.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame()
+        Segments with base_col and factor_cols, e.g.
+        if_si_detour_nat_imp_census_padt.gpkg.
+    weight_scenarios_: pd.DataFrame()
+        Weight scenarios (k x f) indexed by scenario name with factor_cols columns.
+    base_col: str
+        Base incident factor column. Missing values are counted as 0 (as in
+        plot_if.py).
+    factor_cols: list
+        Factor columns.
+    fill_factor_na: float
+        Value used for missing factors. None keeps them missing, so segments with a
+        missing factor get a missing score in the scenarios that use the factor.
+    Returns
+    -------
+    scores_: np.array
+        n x k composite scores.
+    """
+    base = seg_df_[base_col].fillna(0).values.astype(float)
+    factors = seg_df_[factor_cols].values.astype(float)
+    if fill_factor_na is not None:
+        factors = np.where(np.isnan(factors), fill_factor_na, factors)
+    weights = weight_scenarios_.reindex(columns=factor_cols).fillna(0).values
+    scores_ = np.repeat(base[:, np.newaxis], len(weights), axis=1)
+    # Loop over the (few) factors and broadcast over segments x scenarios so that the
+    # memory stays at n x k.
+    for factor_idx in range(len(factor_cols)):
+        factor_term = 1 + np.multiply.outer(
+            factors[:, factor_idx], weights[:, factor_idx]
+        )
+        # A factor with 0 weight does not affect the score, even if it is missing.
+        factor_term[:, weights[:, factor_idx] == 0] = 1
+        scores_ *= factor_term
+    return scores_
+
+
+def get_score_ranks(scores_):
+    """
+    Rank segments in each scenario. Rank 1 is the highest score; missing scores are
+    ranked last.
+    Parameters
+    ----------
+    scores_: np.array
+        n x k composite scores.
+    Returns
+    -------
+    ranks_: np.array
+        n x k integer ranks.
+    """
+    sort_order = np.argsort(-scores_, axis=0, kind="stable")
+    ranks_ = np.empty(scores_.shape, dtype=np.int64)
+    np.put_along_axis(
+        ranks_, sort_order, np.arange(1, len(scores_) + 1)[:, np.newaxis], axis=0
+    )
+    return ranks_
+
+
+def get_composite_score_df(
+    seg_df_,
+    weight_scenarios_=DEFAULT_WEIGHT_SCENARIOS,
+    id_cols=("route_id", "aadt_interval_left", "aadt_interval_right"),
+    **kwargs,
+):
+    """
+    Get a DataFrame with the composite score and rank of each segment for each weight
+    scenario.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame()
+        Segments with inc_fac and the factor columns.
+    weight_scenarios_: pd.DataFrame()
+        Weight scenarios (k x f) indexed by scenario name.
+    id_cols: tuple
+        Segment id columns kept in the output.
+    kwargs
+        Passed to get_composite_scores.
+    Returns
+    -------
+    pd.DataFrame()
+        id_cols with score_<scenario> and rank_<scenario> columns.
+    """
+    scores = get_composite_scores(seg_df_, weight_scenarios_, **kwargs)
+    ranks = get_score_ranks(scores)
+    scenarios = list(weight_scenarios_.index)
+    return pd.concat(
+        [
+            pd.DataFrame(seg_df_[list(id_cols)]).reset_index(drop=True),
+            pd.DataFrame(scores, columns=[f"score_{name}" for name in scenarios]),
+            pd.DataFrame(ranks, columns=[f"rank_{name}" for name in scenarios]),
+        ],
+        axis=1,
+    )
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_external_data = os.path.join(path_to_prj_dir, "data", "external")
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_if_si_detour_nat_imp_census_padt = os.path.join(
+        path_processed_data, "if_si_detour_nat_imp_census_padt.gpkg"
+    )
+    path_weight_scenarios = os.path.join(path_external_data, "weight_scenarios.csv")
+    path_composite_scores = os.path.join(path_processed_data, "composite_scores.csv")
+    scored_seg_gdf = gpd.read_file(path_if_si_detour_nat_imp_census_padt, driver="gpkg")
+    # Weight scenarios proposed by the steering committee; one row per scenario.
+    # ************************************************************************************
+    if os.path.exists(path_weight_scenarios):
+        weight_scenarios = read_weight_scenarios(path_weight_scenarios)
+    else:
+        print(f"{path_weight_scenarios} not found. Using the plot_if.py weights.")
+        weight_scenarios = DEFAULT_WEIGHT_SCENARIOS
+    composite_score_df = get_composite_score_df(scored_seg_gdf, weight_scenarios)
+    composite_score_df.to_csv(path_composite_scores, index=False)
@@ -0,0 +1,231 @@
+"""
+Empirical Bayes (EB) crash frequency for the merged AADT and crash segments. A
+negative binomial safety performance function (SPF),
+predicted crashes = exp(b0 + b1 * ln(AADT)) * segment length * years,
+is calibrated for each route class, and the observed crashes on each segment are
+combined with the SPF prediction using the EB weight 1 / (1 + k * predicted crashes),
+where k is the overdispersion. Short segments with few crashes are pulled toward the
+SPF, which reduces the noise in the crash rate and the incident factor (IF).
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor
+from src.utils import get_project_root
+
+
+def get_no_aadt_effect_spf(crash_cnt, seg_len, num_years=5):
+    """
+    SPF with the mean crash rate and no AADT effect (b1 = 0); used when the SPF cannot
+    be fit. The overdispersion is from the Pearson moments. The coefficients are
+    missing when there are no segments.
+    """
+    exposure = seg_len * num_years
+    if len(crash_cnt) == 0 or exposure.sum() <= 0:
+        return {"coef": [np.nan, 0.0], "dispersion": np.nan}
+    b0 = np.log(max(crash_cnt.sum(), 1e-6) / exposure.sum())
+    mu = np.exp(b0) * exposure
+    dispersion = max(((crash_cnt - mu) ** 2 - mu).sum() / (mu**2).sum(), 0)
+    return {"coef": [float(b0), 0.0], "dispersion": float(dispersion)}
+
+
+def fit_nb_spf(
+    crash_cnt, aadt, seg_len, num_years=5, max_iter=50, tol=1e-8, min_seg=10
+):
+    """
+    Fit the negative binomial SPF ln(mu) = b0 + b1 * ln(AADT) + ln(length * years) by
+    iteratively reweighted least squares. The overdispersion k is updated from the
+    Pearson moments after each iteration. Groups with fewer than min_seg segments or
+    a single AADT value, or a singular fit, get the SPF with no AADT effect
+    (get_no_aadt_effect_spf) and converged False.
+    Parameters
+    ----------
+    crash_cnt: np.array
+        Observed crashes on each segment over num_years.
+    aadt: np.array
+        AADT on each segment.
+    seg_len: np.array
+        Segment length in miles.
+    num_years: int
+        Number of years of crash data.
+    max_iter: int
+        Maximum number of iterations.
+    tol: float
+        Convergence tolerance on the coefficients.
+    min_seg: int
+        Minimum number of segments (with AADT and length) to fit the SPF.
+    Returns
+    -------
+    dict
+        coef: [b0, b1]; dispersion: overdispersion k; num_seg: number of segments used
+        in the fit; converged: bool.
+    """
+    crash_cnt = np.asarray(crash_cnt, dtype=float)
+    aadt = np.asarray(aadt, dtype=float)
+    seg_len = np.asarray(seg_len, dtype=float)
+    use = np.isfinite(crash_cnt) & (aadt > 0) & (seg_len > 0)
+    crash_cnt, aadt, seg_len = crash_cnt[use], aadt[use], seg_len[use]
+    if len(aadt) < min_seg or np.unique(aadt).size < 2:
+        return {
+            **get_no_aadt_effect_spf(crash_cnt, seg_len, num_years),
+            "num_seg": int(use.sum()),
+            "converged": False,
+        }
+    x_mat = np.column_stack([np.ones(len(aadt)), np.log(aadt)])
+    offset = np.log(seg_len * num_years)
+    # Start from the mean crash rate with no AADT effect.
+    coef = np.array([np.log(max(crash_cnt.sum(), 1e-6) / np.exp(offset).sum()), 0])
+    dispersion = 0
+    converged = False
+    for _ in range(max_iter):
+        mu = np.exp(x_mat @ coef + offset)
+        working_resp = x_mat @ coef + (crash_cnt - mu) / mu
+        working_wt = mu / (1 + dispersion * mu)
+        x_mat_wt = x_mat * working_wt[:, np.newaxis]
+        try:
+            coef_new = np.linalg.solve(x_mat_wt.T @ x_mat, x_mat_wt.T @ working_resp)
+        except np.linalg.LinAlgError:
+            return {
+                **get_no_aadt_effect_spf(crash_cnt, seg_len, num_years),
+                "num_seg": int(use.sum()),
+                "converged": False,
+            }
+        mu = np.exp(x_mat @ coef_new + offset)
+        dispersion = max(((crash_cnt - mu) ** 2 - mu).sum() / (mu**2).sum(), 0)
+        if np.abs(coef_new - coef).max() < tol:
+            coef = coef_new
+            converged = True
+            break
+        coef = coef_new
+    return {
+        "coef": coef.tolist(),
+        "dispersion": float(dispersion),
+        "num_seg": int(use.sum()),
+        "converged": converged,
+    }
+
+
+def calibrate_spf_by_group(
+    seg_df_,
+    group_col="route_class",
+    cnt_col="total_cnt",
+    aadt_col="aadt_2018",
+    len_col="seg_len_in_interval",
+    num_years=5,
+    n_jobs=4,
+):
+    """
+    Calibrate an SPF for each group (e.g. route class) in parallel.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame()
+        Merged AADT and crash data, e.g. aadt_crash_ncdot.gpkg.
+    group_col: str
+        Column with the SPF groups.
+    cnt_col: str
+        Observed crash count column.
+    aadt_col: str
+        AADT column.
+    len_col: str
+        Segment length column.
+    num_years: int
+        Number of years of crash data.
+    n_jobs: int
+        Number of threads. The matrix products release the GIL.
+    Returns
+    -------
+    dict
+        {group: SPF from fit_nb_spf}
+    """
+    seg_grp = {name: grp for name, grp in seg_df_.groupby(group_col) if len(grp) > 0}
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        spf_futures = {
+            name: executor.submit(
+                fit_nb_spf,
+                grp[cnt_col].values,
+                grp[aadt_col].values,
+                grp[len_col].values,
+                num_years,
+            )
+            for name, grp in seg_grp.items()
+        }
+    return {name: future.result() for name, future in spf_futures.items()}
+
+
+def get_eb_estimates(
+    seg_df_,
+    spf_by_group,
+    group_col="route_class",
+    cnt_col="total_cnt",
+    aadt_col="aadt_2018",
+    len_col="seg_len_in_interval",
+    num_years=5,
+):
+    """
+    Compute the SPF prediction and the EB expected crashes for all segments.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame()
+        Merged AADT and crash data.
+    spf_by_group: dict
+        Output from calibrate_spf_by_group.
+    group_col, cnt_col, aadt_col, len_col: str
+        Same as in calibrate_spf_by_group.
+    num_years: int
+        Number of years of crash data.
+    Returns
+    -------
+    seg_df_eb_: pd.DataFrame()
+        seg_df_ with spf_pred_cnt, eb_weight, eb_total_cnt, eb_crash_rate, and
+        eb_inc_fac. EB columns are missing for segments without crash data or without
+        an SPF for their group.
+    """
+    groups = seg_df_[group_col]
+    b0 = groups.map({name: spf["coef"][0] for name, spf in spf_by_group.items()})
+    b1 = groups.map({name: spf["coef"][1] for name, spf in spf_by_group.items()})
+    dispersion = groups.map(
+        {name: spf["dispersion"] for name, spf in spf_by_group.items()}
+    )
+    aadt = seg_df_[aadt_col].values.astype(float)
+    seg_len = seg_df_[len_col].values.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        spf_pred_cnt = (
+            np.exp(b0.values + b1.values * np.log(aadt)) * seg_len * num_years
+        )
+        eb_weight = 1 / (1 + dispersion.values * spf_pred_cnt)
+    seg_df_eb_ = seg_df_.assign(
+        spf_pred_cnt=spf_pred_cnt,
+        eb_weight=eb_weight,
+        eb_total_cnt=lambda df: (
+            df.eb_weight * df.spf_pred_cnt + (1 - df.eb_weight) * df[cnt_col]
+        ),
+        eb_crash_rate=lambda df: df.eb_total_cnt / df[len_col] / num_years,
+        eb_inc_fac=lambda df: df.eb_crash_rate * df[aadt_col] / 100000,
+    )
+    return seg_df_eb_
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    path_aadt_crash_si = os.path.join(path_interim_data, "aadt_crash_ncdot.gpkg")
+    path_spf = os.path.join(path_interim_data, "spf_by_route_class.csv")
+    aadt_crash_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
+    spf_by_route_class = calibrate_spf_by_group(
+        aadt_crash_gdf, group_col="route_class", num_years=5
+    )
+    pd.DataFrame(
+        [
+            {
+                "route_class": name,
+                "b0": spf["coef"][0],
+                "b1": spf["coef"][1],
+                "dispersion": spf["dispersion"],
+                "num_seg": spf["num_seg"],
+                "converged": spf["converged"],
+            }
+            for name, spf in spf_by_route_class.items()
+        ]
+    ).to_csv(path_spf, index=False)
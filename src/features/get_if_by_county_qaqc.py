@@ -3,7 +3,9 @@ import geopandas as gpd
 import os
 import re
 from src.utils import get_project_root
-from src.data.crash import get_severity_index
+from src.data.reference_layers import load_reference_layer
+from src.features.aggregate_cube import read_cube
+from src.features.aggregate_cube import get_rollup
 import plotly.express as px
 import plotly.io as pio
 from plotly.subplots import make_subplots
@@ -13,21 +15,17 @@ pio.renderers.default = "browser"
 path_to_prj_dir = get_project_root()
 path_to_raw = os.path.join(path_to_prj_dir, "data", "raw")
 path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
-path_if_si_detour_nat_imp = os.path.join(path_processed_data,
-                                         "if_si_detour_nat_imp.gpkg")
-path_to_county = os.path.join(
-    path_to_raw,
-    "CountyBoundary_SHP",
-    "BoundaryCountyPolygon.shp",
-)
+path_cube = os.path.join(path_processed_data, "aggregate_cube.pkl")
 path_to_nathan_inc_fac = os.path.join(
     path_to_raw,
     "nathan_inc_fac.xlsx"
 )
 
 if __name__ == "__main__":
-    if_process_df = gpd.read_file(path_if_si_detour_nat_imp, driver="gpkg")
-    county_df = gpd.read_file(path_to_county, driver="shp")
+    # County x route_no x route_class aggregates are looked up from the cube built by
+    # aggregate_cube.py.
+    cube = read_cube(path_cube)
+    county_df = load_reference_layer("county_boundary")["gdf"]
     county_df_fil = (
         county_df
         .filter(items=["FIPS", "CountyName", "SapCountyI"])
@@ -39,46 +37,26 @@ if __name__ == "__main__":
             )
         )
 
-    if_process_df_county = if_process_df.merge(
-        county_df_fil,
-        left_on="route_county",
-        right_on="sap_county_id",
-        how="left"
-    )
-
     if_process_df_county_agg = (
-        if_process_df_county
-        .loc[lambda df: df.route_qual==0]
-        .groupby(["county_nm", "route_no", "route_class"])
-        .agg(
-            route_inventory=("route_inventory", "first"),
-            route_county=("route_county", "first"),
-            route_id=("route_id", "first"),
-            ka_cnt=("ka_cnt", sum),
-            bc_cnt=("bc_cnt", sum),
-            pdo_cnt=("pdo_cnt", sum),
-            total_cnt=("total_cnt", sum),
-            aadt_2018=("aadt_2018", "mean"),
-            seg_len_in_interval=("seg_len_in_interval", sum),
-            st_end_diff_aadt=("st_end_diff_aadt", sum),
-            inc_fac=("inc_fac", "mean"),
-            si_fac=("si_fac", "mean"),
+        get_rollup(
+            cube,
+            by=("county", "route_no", "route_class"),
+            where={"route_qual": 0},
         )
         .reset_index()
+        .loc[lambda df: (df.county != "unknown") & (df.route_no != "unknown")]
         .assign(
-            total_cnt_per_year=lambda df: df.total_cnt / 5,
-            crash_rate_per_mile_per_year=lambda df: (
-                    df.total_cnt / df.seg_len_in_interval / 5
-            ),
-            inc_fac_county_lev=lambda df:
-                    df.crash_rate_per_mile_per_year * df.aadt_2018 / 100000,
+            route_county=lambda df: df.county.astype(int),
+            route_no=lambda df: df.route_no.astype(int),
+        )
+        .merge(
+            county_df_fil,
+            left_on="route_county",
+            right_on="sap_county_id",
+            how="left"
         )
     )
 
-    if_process_df_county_agg.loc[:, "si_county_lev"] = get_severity_index(
-        if_process_df_county_agg).severity_index
-
-
     nathan_inc_fac = pd.read_excel(path_to_nathan_inc_fac)
     pat=re.compile(r"(I|NC|US)-(\d{2,3}).*")
     nathan_inc_fac[["route_class", "route_no"]] = (
@@ -6,9 +6,13 @@ import pandas as pd
 import geopandas as gpd
 import os
 from src.utils import get_project_root
-import sklearn
 import numpy as np
 from sklearn.preprocessing import minmax_scale
+from src.features.empirical_bayes import calibrate_spf_by_group
+from src.features.empirical_bayes import get_eb_estimates
+from src.profiling import new_trace
+from src.profiling import profile_stage
+from src.profiling import write_trace
 
 if __name__ == "__main__":
     # Set the paths to relevant files and folders.
@@ -24,7 +28,12 @@ if __name__ == "__main__":
         path_interim_data, "aadt_but_no_crash_route_set.csv"
     )
     path_to_fig = os.path.join(path_to_prj_dir, "reports", "figures")
-    crash_aadt_fil_si_geom_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
+    trace = new_trace("if_si_calc")
+    with profile_stage(
+        trace, "read_aadt_crash", paths_in=[path_aadt_crash_si]
+    ) as stage:
+        crash_aadt_fil_si_geom_gdf = gpd.read_file(path_aadt_crash_si, driver="gpkg")
+        stage["rows_out"] = len(crash_aadt_fil_si_geom_gdf)
     crash_aadt_fil_si_geom_gdf = (
         crash_aadt_fil_si_geom_gdf
         .sort_values(by=["route_id", "aadt_interval_left"])
@@ -44,32 +53,58 @@ if __name__ == "__main__":
     crash_aadt_fil_si_geom_gdf.groupby("route_class").severity_index.quantile(.95)
     crash_df_fil_si_geom_gdf_no_nan.severity_index.quantile(.90)
     crash_df_fil_si_geom_gdf_no_nan.inc_fac.describe()
-    quantile_90th = crash_aadt_fil_si_geom_gdf.severity_index.quantile(.90)
+    with profile_stage(
+        trace, "scale_severity_index", rows_in=len(crash_aadt_fil_si_geom_gdf)
+    ) as stage:
+        quantile_90th = crash_aadt_fil_si_geom_gdf.severity_index.quantile(.90)
 
-    crash_aadt_fil_si_geom_gdf_scaled_si = crash_aadt_fil_si_geom_gdf.assign(
-        severity_index=lambda df: df.severity_index.fillna(1),
-        severity_index_q90=quantile_90th,
-        severity_index_need_scaling=lambda df: np.select(
-            [
-                df.severity_index.isna(),
-                df.severity_index <= quantile_90th,
-                df.severity_index > quantile_90th],
-            [np.nan, True, False]
-        ),
-        severity_index_scaled=lambda df: (
-            df.groupby("severity_index_need_scaling")
-            .severity_index
-            .transform(lambda x: minmax_scale(x, (0, 1)))),
-    )
+        crash_aadt_fil_si_geom_gdf_scaled_si = crash_aadt_fil_si_geom_gdf.assign(
+            severity_index=lambda df: df.severity_index.fillna(1),
+            severity_index_q90=quantile_90th,
+            severity_index_need_scaling=lambda df: np.select(
+                [
+                    df.severity_index.isna(),
+                    df.severity_index <= quantile_90th,
+                    df.severity_index > quantile_90th],
+                [np.nan, True, False]
+            ),
+            severity_index_scaled=lambda df: (
+                df.groupby("severity_index_need_scaling")
+                .severity_index
+                .transform(lambda x: minmax_scale(x, (0, 1)))),
+        )
 
-    crash_aadt_fil_si_geom_gdf_scaled_si.loc[
-        lambda x: ~ x.severity_index_need_scaling.astype(bool),
-        "severity_index_scaled"
-        ] = 1
-    crash_aadt_fil_si_geom_gdf_scaled_si.to_file(path_inc_fac_si, driver="GPKG")
+        crash_aadt_fil_si_geom_gdf_scaled_si.loc[
+            lambda x: ~ x.severity_index_need_scaling.astype(bool),
+            "severity_index_scaled"
+            ] = 1
+        stage["rows_out"] = len(crash_aadt_fil_si_geom_gdf_scaled_si)
+    # Empirical Bayes crash frequency, crash rate, and IF. The SPF is calibrated for
+    # each route class on the segments with crash data.
+    with profile_stage(
+        trace, "empirical_bayes", rows_in=len(crash_aadt_fil_si_geom_gdf_scaled_si)
+    ) as stage:
+        spf_by_route_class = calibrate_spf_by_group(
+            crash_aadt_fil_si_geom_gdf_scaled_si, group_col="route_class", num_years=5
+        )
+        crash_aadt_fil_si_geom_gdf_scaled_si = get_eb_estimates(
+            crash_aadt_fil_si_geom_gdf_scaled_si,
+            spf_by_route_class,
+            group_col="route_class",
+            num_years=5,
+        )
+        stage["rows_out"] = len(crash_aadt_fil_si_geom_gdf_scaled_si)
+    with profile_stage(
+        trace,
+        "write_inc_fac_si",
+        rows_in=len(crash_aadt_fil_si_geom_gdf_scaled_si),
+        paths_out=[path_inc_fac_si],
+    ):
+        crash_aadt_fil_si_geom_gdf_scaled_si.to_file(path_inc_fac_si, driver="GPKG")
 
     path_missing_crash = os.path.join(path_processed_data, "missing_crashes")
     if not os.path.isdir(path_missing_crash):
         os.mkdir(path_missing_crash)
     path_missing_crash_shp = os.path.join(path_missing_crash, "missing_crash.shp")
     crash_df_fil_si_geom_gdf_nan.to_file(path_missing_crash_shp)
+    write_trace(trace)
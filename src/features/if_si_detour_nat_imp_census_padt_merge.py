@@ -3,6 +3,11 @@ import geopandas as gpd
 import os
 import numpy as np
 from src.utils import get_project_root
+from src.utils import lookup_seg_ids
+from src.utils import merge_join_sorted
+from src.profiling import new_trace
+from src.profiling import profile_stage
+from src.profiling import write_trace
 
 path_to_prj_dir = get_project_root()
 path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
@@ -24,35 +29,63 @@ if not os.path.exists(path_interim_sratch):
     os.mkdir(path_interim_sratch)
 
 if __name__ == "__main__":
-    inc_fac_si_gdf = gpd.read_file(path_inc_fac_si, driver="gpkg")
-    detour_df = gpd.read_file(path_detour_data, driver="shp")
-    nhs_stc_routes = pd.read_csv(path_nhs_stc_routes)
-    padt_df = gpd.read_file(path_padt, driver="gpkg")
-    census_growth_df = gpd.read_file(path_census_growth, driver="gpkg")
+    # Read the inputs one after another; the fiona reads hold the GIL, so reading them
+    # in threads was not faster.
+    trace = new_trace("if_si_detour_nat_imp_census_padt_merge")
+    with profile_stage(
+        trace,
+        "read_final_merge_inputs",
+        paths_in=[
+            path_inc_fac_si,
+            path_detour_data,
+            path_nhs_stc_routes,
+            path_padt,
+            path_census_growth,
+        ],
+    ) as stage:
+        inc_fac_si_gdf = gpd.read_file(path_inc_fac_si, driver="gpkg")
+        detour_df = gpd.read_file(path_detour_data, driver="shp")
+        nhs_stc_routes = pd.read_csv(path_nhs_stc_routes)
+        padt_df = gpd.read_file(path_padt, driver="gpkg")
+        census_growth_df = gpd.read_file(path_census_growth, driver="gpkg")
+        stage["rows_out"] = sum(
+            len(df)
+            for df in [
+                inc_fac_si_gdf, detour_df, nhs_stc_routes, padt_df, census_growth_df
+            ]
+        )
+    # The detour scores are keyed by route and begin milepost; find their seg_id once.
+    # The padt and census growth factors carry the seg_id from aadt_crash_merge.py.
+    # Where several detour records map to one segment, keep the one with the highest
+    # detour score (ties broken by route and begin milepost).
     detour_df_fil = (
         detour_df
         .loc[lambda df: df["class"].astype(int) <= 3]
-        .filter(items=["RouteID", "BeginMp", "scr_det", "scr_d90", "scr_nd90"])
-        .rename(columns={"RouteID": "route_id", "BeginMp": "aadt_interval_left"})
+        .assign(seg_id=lambda df: lookup_seg_ids(inc_fac_si_gdf, df.RouteID, df.BeginMp))
+        .loc[lambda df: df.seg_id >= 0]
+        .sort_values(
+            ["seg_id", "scr_det", "RouteID", "BeginMp"],
+            ascending=[True, False, True, True],
+            kind="mergesort",
+        )
+        .drop_duplicates("seg_id")
+        .filter(items=["seg_id", "scr_det", "scr_d90", "scr_nd90"])
     )
-    padt_df_fil = padt_df.filter(items=["route_id", "aadt_interval_left", "padt_rec", "seasonal_fac"])
-    census_growth_df_fil = census_growth_df.filter(items=["route_id", "aadt_interval_left",
+    padt_df_fil = padt_df.filter(items=["seg_id", "padt_rec", "seasonal_fac"])
+    census_growth_df_fil = census_growth_df.filter(items=["seg_id",
                                                           "tot_gr_24_yearly",
                                                           "tot_grw_rt_24",
                                                           "GEOID10",
                                                           "tot_flow_2015_24",
                                                           "tot_flow_2040_24",
                                                           "growth_fac"])
-    if_si_detour_df = (
-        inc_fac_si_gdf
-        .merge(
-            right=detour_df_fil,
-            on=["route_id", "aadt_interval_left"],
-            how="left"
-        )
+    # Join the segment level factors in one pass on the int64 seg_id.
+    if_si_detour_census_padt_df = merge_join_sorted(
+        inc_fac_si_gdf, [detour_df_fil, census_growth_df_fil, padt_df_fil], on="seg_id"
     )
-    if_si_detour_nat_imp_df = (
-        if_si_detour_df
+    # The national importance is by route.
+    if_si_detour_nat_imp_census_padt_df = (
+        if_si_detour_census_padt_df
         .merge(
             right=nhs_stc_routes.assign(route_id=lambda df: df.route_id.astype(str)),
             on=["route_id"],
@@ -60,7 +93,7 @@ if __name__ == "__main__":
         )
     )
     if_si_detour_nat_imp_fil_df = (
-        if_si_detour_nat_imp_df
+        if_si_detour_nat_imp_census_padt_df
         .assign(display_in_imap_tool=lambda df: np.select(
                 [
                     df.route_class.isin(["Interstate", "US Route"])
@@ -76,28 +109,11 @@ if __name__ == "__main__":
         )
     )
 
-    if_si_detour_nat_imp_census_df = (
-        if_si_detour_nat_imp_df
-        .merge(
-            right=census_growth_df_fil.assign(route_id=lambda df: df.route_id.astype(str)),
-            on=["route_id", "aadt_interval_left"],
-            how="left"
-        )
-    )
-
-    if_si_detour_nat_imp_census_padt_df = (
-        if_si_detour_nat_imp_census_df
-        .merge(
-            right=padt_df_fil.assign(route_id=lambda df: df.route_id.astype(str)),
-            on=["route_id", "aadt_interval_left"],
-            how="left"
-        )
-    )
-
     if_si_detour_nat_imp_census_padt_df_fil =(
         if_si_detour_nat_imp_census_padt_df
         .filter(
             items=[
+                'seg_id',
                 'route_id',
                 'route_class',
                 'route_qual',
@@ -148,7 +164,9 @@ if __name__ == "__main__":
     if_si_detour_nat_imp_census_padt_df_fil.to_file(os.path.join(path_interim_sratch,
                                                      "if_si_detour_nat_imp_census_padt.shp"))
 
+    write_trace(trace)
+
     test = if_si_detour_nat_imp_fil_df.loc[if_si_detour_nat_imp_fil_df.scr_det.isna()]
-    test2 = if_si_detour_df.loc[if_si_detour_df.route_class.isna()]
+    test2 = if_si_detour_census_padt_df.loc[if_si_detour_census_padt_df.route_class.isna()]
 
 
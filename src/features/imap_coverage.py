@@ -0,0 +1,189 @@
+"""
+Compute the IMAP patrol coverage of the scored segments. Buffer the IMAP route parts
+once, find the segment and buffer pairs through the spatial index, and compute the
+covered length fraction and the uncovered incident factor (IF) mass for each segment,
+statewide, and by county.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.ops import unary_union
+from src.utils import get_project_root
+from src.data.reference_layers import query_reference_bbox
+
+# NAD83 / North Carolina (ftUS). Used for buffering and length computation.
+CRS_NC_FT = "EPSG:2264"
+FT_PER_MILE = 5280
+
+
+def get_imap_buffer(imap_gdf_, buffer_ft=100, crs_proj=CRS_NC_FT):
+    """
+    Buffer each IMAP route part. The buffers are not dissolved, so the spatial index
+    keeps small bounding boxes; buffers of adjacent or crossing routes overlap.
+    Parameters
+    ----------
+    imap_gdf_: gpd.GeoDataFrame()
+        IMAP routes.
+    buffer_ft: float
+        Buffer distance in feet on each side of the IMAP routes.
+    crs_proj: str
+        Projected crs (units of feet) used for buffering.
+    Returns
+    -------
+    imap_buffer_gdf_: gpd.GeoDataFrame()
+        One buffer polygon per IMAP route part in crs_proj.
+    """
+    imap_parts = (
+        gpd.GeoDataFrame(geometry=imap_gdf_.geometry, crs=imap_gdf_.crs)
+        .loc[lambda df: df.geometry.notna() & ~df.geometry.is_empty]
+        .explode()
+        .to_crs(crs_proj)
+    )
+    imap_buffer_gdf_ = gpd.GeoDataFrame(
+        geometry=imap_parts.buffer(buffer_ft).reset_index(drop=True), crs=crs_proj
+    )
+    return imap_buffer_gdf_
+
+
+def get_imap_coverage(seg_gdf_, imap_buffer_gdf_, crs_proj=CRS_NC_FT):
+    """
+    Compute the IMAP covered length and covered length fraction for each segment.
+    Parameters
+    ----------
+    seg_gdf_: gpd.GeoDataFrame()
+        Scored segments with "inc_fac", "aadt_interval_left", and
+        "aadt_interval_right".
+    imap_buffer_gdf_: gpd.GeoDataFrame()
+        Output from get_imap_buffer.
+    crs_proj: str
+        crs of imap_buffer_gdf_.
+    Returns
+    -------
+    seg_gdf_coverage_: gpd.GeoDataFrame()
+        seg_gdf_ with columns for the covered length fraction (imap_covered_frac),
+        covered length in miles (imap_covered_len_mi), and IF mass (IF x miles) on
+        the segment (if_mass) and outside IMAP coverage (uncovered_if_mass). Missing
+        IF is counted as 0.
+    """
+    seg_gdf_coverage_ = seg_gdf_.reset_index(drop=True)
+    seg_geom_proj = seg_gdf_coverage_.geometry.to_crs(crs_proj)
+    # Candidate pairs from the spatial index of the buffer polygons.
+    seg_buffer_pairs = gpd.sjoin(
+        gpd.GeoDataFrame(geometry=seg_geom_proj, crs=crs_proj),
+        imap_buffer_gdf_,
+        how="inner",
+    )
+    covered_len_ft = np.zeros(len(seg_gdf_coverage_))
+    num_pairs = seg_buffer_pairs.index.value_counts()
+    # Segments in a single buffer: intersect the segment with the buffer.
+    single_pairs = seg_buffer_pairs.loc[
+        seg_buffer_pairs.index.isin(num_pairs.index[num_pairs == 1])
+    ]
+    covered_len_ft[single_pairs.index.values] = (
+        gpd.GeoSeries(seg_geom_proj.loc[single_pairs.index].values, crs=crs_proj)
+        .intersection(
+            gpd.GeoSeries(
+                imap_buffer_gdf_.geometry.loc[single_pairs.index_right].values,
+                crs=crs_proj,
+            )
+        )
+        .length.values
+    )
+    # Segments in overlapping buffers: intersect the segment with the union of its
+    # buffers so that the overlaps are not counted twice.
+    multi_buffer_idx = (
+        seg_buffer_pairs.loc[
+            seg_buffer_pairs.index.isin(num_pairs.index[num_pairs > 1]),
+            "index_right",
+        ]
+        .groupby(level=0)
+        .agg(list)
+    )
+    for seg_idx, buffer_idx in multi_buffer_idx.items():
+        covered_len_ft[seg_idx] = (
+            seg_geom_proj.loc[seg_idx]
+            .intersection(unary_union(imap_buffer_gdf_.geometry.loc[buffer_idx].values))
+            .length
+        )
+    seg_len_ft = seg_geom_proj.length.values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        imap_covered_frac = np.where(
+            seg_len_ft > 0, np.clip(covered_len_ft / seg_len_ft, 0, 1), np.nan
+        )
+    seg_gdf_coverage_ = seg_gdf_coverage_.assign(
+        imap_covered_frac=imap_covered_frac,
+        imap_covered_len_mi=covered_len_ft / FT_PER_MILE,
+        seg_len_mi=lambda df: df.aadt_interval_right - df.aadt_interval_left,
+        if_mass=lambda df: df.inc_fac.fillna(0) * df.seg_len_mi,
+        uncovered_if_mass=lambda df: df.if_mass * (1 - df.imap_covered_frac),
+    )
+    return seg_gdf_coverage_
+
+
+def get_coverage_summary(seg_gdf_coverage_, by=("route_county",)):
+    """
+    Summarize IMAP coverage by a set of columns with a statewide total row.
+    Parameters
+    ----------
+    seg_gdf_coverage_: gpd.GeoDataFrame()
+        Output from get_imap_coverage.
+    by: tuple
+        Columns to group by.
+    Returns
+    -------
+    coverage_summary_: pd.DataFrame()
+        Segment miles, covered miles, covered fraction, IF mass, and uncovered IF
+        mass by group. The statewide row has "statewide" in the group columns.
+    """
+    by = list(by)
+    agg_cols = ["seg_len_mi", "imap_covered_frac", "if_mass", "uncovered_if_mass"]
+    coverage_df = pd.DataFrame(seg_gdf_coverage_[by + agg_cols]).assign(
+        covered_seg_len_mi=lambda df: df.seg_len_mi * df.imap_covered_frac
+    )
+    coverage_summary_ = coverage_df.groupby(by).agg(
+        seg_len_mi=("seg_len_mi", "sum"),
+        covered_seg_len_mi=("covered_seg_len_mi", "sum"),
+        if_mass=("if_mass", "sum"),
+        uncovered_if_mass=("uncovered_if_mass", "sum"),
+    )
+    statewide = coverage_summary_.sum().to_frame().T
+    statewide.index = pd.MultiIndex.from_tuples(
+        [tuple(["statewide"] * len(by))], names=by
+    )
+    if len(by) == 1:
+        statewide.index = statewide.index.get_level_values(0)
+    coverage_summary_ = (
+        pd.concat([coverage_summary_, statewide])
+        .assign(
+            imap_covered_frac=lambda df: df.covered_seg_len_mi / df.seg_len_mi,
+            uncovered_if_mass_frac=lambda df: df.uncovered_if_mass / df.if_mass,
+        )
+        .reset_index()
+    )
+    return coverage_summary_
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_if_si_detour_nat_imp_census_padt = os.path.join(
+        path_processed_data, "if_si_detour_nat_imp_census_padt.gpkg"
+    )
+    path_imap_coverage = os.path.join(path_processed_data, "imap_coverage.gpkg")
+    path_imap_coverage_county = os.path.join(
+        path_processed_data, "imap_coverage_by_county.csv"
+    )
+    scored_seg_gdf = gpd.read_file(path_if_si_detour_nat_imp_census_padt, driver="gpkg")
+    # Only the IMAP routes whose bounds intersect the scored segments are buffered.
+    imap_gdf = query_reference_bbox("imap_routes", tuple(scored_seg_gdf.total_bounds))
+    # Buffer the IMAP routes once and compute the coverage of each scored segment.
+    # ************************************************************************************
+    imap_buffer_gdf = get_imap_buffer(imap_gdf, buffer_ft=100)
+    scored_seg_coverage_gdf = get_imap_coverage(scored_seg_gdf, imap_buffer_gdf)
+    imap_coverage_county = get_coverage_summary(
+        scored_seg_coverage_gdf, by=("route_county",)
+    )
+    scored_seg_coverage_gdf.to_file(path_imap_coverage, driver="GPKG")
+    imap_coverage_county.to_csv(path_imap_coverage_county, index=False)
@@ -0,0 +1,334 @@
+"""
+Sliding window network screening along the route mileposts. For each route, build the
+cumulative crash counts from the crash sections (crashes are uniformly distributed
+along each crash section) and the cumulative AADT x length from the AADT intervals as
+piecewise linear functions of the milepost. The crashes, length, and AADT in every
+window are the differences of the cumulative functions at the window end and start,
+so all windows are evaluated with two searchsorted passes.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from concurrent.futures import ProcessPoolExecutor
+from src.utils import get_project_root
+from src.data.crash import get_severity_index
+
+CNT_COLS = ["ka_cnt", "bc_cnt", "pdo_cnt", "total_cnt"]
+
+
+def get_cumulative(st_mp, end_mp, values):
+    """
+    Build the cumulative functions of interval values that are uniformly distributed
+    along each interval. Overlapping intervals are summed with a difference array.
+    Parameters
+    ----------
+    st_mp: np.array
+        Start mileposts of the intervals.
+    end_mp: np.array
+        End mileposts of the intervals.
+    values: np.array
+        (len(st_mp) x k) values of the intervals. Values of zero length intervals are
+        point masses at the start milepost.
+    Returns
+    -------
+    {"milepost": milepost, "cum": cum}: dict
+        milepost: non-decreasing mileposts; each breakpoint is repeated for the
+        cumulative values before and after the point masses.
+        cum: (len(milepost) x (k + 1)) cumulative values and the cumulative length
+        covered by at least one interval at each milepost.
+    """
+    breakpoints = np.unique(np.concatenate([st_mp, end_mp]))
+    st_idx = np.searchsorted(breakpoints, st_mp)
+    end_idx = np.searchsorted(breakpoints, end_mp)
+    interval_len = end_mp - st_mp
+    has_len = interval_len > 0
+    num_cols = values.shape[1]
+    # Difference arrays of the value densities and the number of covering intervals.
+    density_delta = np.zeros((len(breakpoints), num_cols))
+    np.add.at(
+        density_delta, st_idx[has_len], values[has_len] / interval_len[has_len, None]
+    )
+    np.add.at(
+        density_delta, end_idx[has_len], -values[has_len] / interval_len[has_len, None]
+    )
+    cover_delta = np.zeros(len(breakpoints))
+    np.add.at(cover_delta, st_idx[has_len], 1)
+    np.add.at(cover_delta, end_idx[has_len], -1)
+    point_mass = np.zeros((len(breakpoints), num_cols + 1))
+    np.add.at(point_mass[:, :num_cols], st_idx[~has_len], values[~has_len])
+    step_len = np.diff(breakpoints)[:, np.newaxis]
+    step_sums = np.hstack(
+        [
+            np.cumsum(density_delta, axis=0)[:-1] * step_len,
+            (np.cumsum(cover_delta)[:-1, np.newaxis] > 0.5) * step_len,
+        ]
+    )
+    cum_after = np.cumsum(point_mass, axis=0)
+    cum_after[1:] += np.cumsum(step_sums, axis=0)
+    cum_before = cum_after - point_mass
+    milepost = np.repeat(breakpoints, 2)
+    cum = np.stack([cum_before, cum_after], axis=1).reshape(-1, num_cols + 1)
+    return {"milepost": milepost, "cum": cum}
+
+
+def get_crash_cumulative(crash_route_df_):
+    """
+    Cumulative ka, bc, pdo, and total crashes, and length with crash data of one
+    route from the crash sections. Duplicate sections (same start and end milepost)
+    are counted once, as in merge_aadt_crash.
+    """
+    crash_route_df_ = crash_route_df_.drop_duplicates(["st_mp_pt", "end_mp_pt"])
+    return get_cumulative(
+        crash_route_df_.st_mp_pt.values.astype(float),
+        crash_route_df_.end_mp_pt.values.astype(float),
+        crash_route_df_[CNT_COLS].fillna(0).values.astype(float),
+    )
+
+
+def get_exposure_cumulative(aadt_route_df_):
+    """
+    Cumulative AADT x length and length with AADT data of one route from the AADT
+    intervals. Overlapping intervals are cut at the start of the next interval, as in
+    get_aadt_bin.
+    """
+    aadt_route_df_ = aadt_route_df_.loc[lambda df: df.aadt_2018.notna()].sort_values(
+        "st_mp_pt", kind="mergesort"
+    )
+    st_mp = aadt_route_df_.st_mp_pt.values.astype(float)
+    end_mp = aadt_route_df_.end_mp_pt.values.astype(float)
+    end_mp = np.maximum(np.minimum(end_mp, np.append(st_mp[1:], np.inf)), st_mp)
+    return get_cumulative(
+        st_mp,
+        end_mp,
+        ((end_mp - st_mp) * aadt_route_df_.aadt_2018.values.astype(float))[
+            :, np.newaxis
+        ],
+    )
+
+
+def eval_cumulative(milepost, cum, x):
+    """
+    Evaluate the piecewise linear cumulative functions at the mileposts x with one
+    searchsorted pass.
+    """
+    if len(milepost) == 0:
+        return np.zeros((len(x), cum.shape[1]))
+    x = np.clip(x, milepost[0], milepost[-1])
+    right_idx = np.clip(
+        np.searchsorted(milepost, x, side="right"), 1, len(milepost) - 1
+    )
+    left_idx = right_idx - 1
+    step_len = milepost[right_idx] - milepost[left_idx]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        frac = np.where(step_len > 0, (x - milepost[left_idx]) / step_len, 1)
+    return cum[left_idx] + frac[:, np.newaxis] * (cum[right_idx] - cum[left_idx])
+
+
+def get_window_sums(cum_fun, window_st, window_end):
+    """
+    Sums of the cumulative functions over the windows.
+    """
+    return eval_cumulative(cum_fun["milepost"], cum_fun["cum"], window_end) - (
+        eval_cumulative(cum_fun["milepost"], cum_fun["cum"], window_st)
+    )
+
+
+def screen_route(route_id, crash_route_df_, aadt_route_df_, window_len=0.5, step=0.1):
+    """
+    Compute the crash counts, length with crash data, and length weighted AADT of all
+    windows on one route.
+    Parameters
+    ----------
+    route_id: str
+        Route id.
+    crash_route_df_: pd.DataFrame()
+        Crash sections of the route.
+    aadt_route_df_: pd.DataFrame()
+        AADT intervals of the route. The windows span the AADT intervals.
+    window_len: float
+        Window length in miles.
+    step: float
+        Distance between window starts in miles.
+    Returns
+    -------
+    pd.DataFrame()
+        One row per window.
+    """
+    route_st = aadt_route_df_.st_mp_pt.min()
+    route_end = aadt_route_df_.end_mp_pt.max()
+    route_len = route_end - route_st
+    num_windows = int(np.floor(max(route_len - window_len, 0) / step + 1e-9)) + 1
+    window_st = route_st + step * np.arange(num_windows)
+    window_end = np.minimum(window_st + window_len, route_end)
+    crash_sums = get_window_sums(
+        get_crash_cumulative(crash_route_df_), window_st, window_end
+    )
+    exposure_sums = get_window_sums(
+        get_exposure_cumulative(aadt_route_df_), window_st, window_end
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aadt = exposure_sums[:, 0] / exposure_sums[:, 1]
+    window_df = pd.DataFrame(crash_sums[:, : len(CNT_COLS)], columns=CNT_COLS)
+    return window_df.assign(
+        route_id=route_id,
+        window_st_mp=window_st,
+        window_end_mp=window_end,
+        covered_len=crash_sums[:, len(CNT_COLS)],
+        aadt_2018=aadt,
+    )
+
+
+def screen_routes(route_payloads, window_len, step):
+    """
+    Screen a batch of routes; one task of the process pool.
+    """
+    return pd.concat(
+        [
+            screen_route(route_id, crash_route_df, aadt_route_df, window_len, step)
+            for route_id, crash_route_df, aadt_route_df in route_payloads
+        ],
+        ignore_index=True,
+    )
+
+
+def get_screening_windows(
+    crash_df_,
+    aadt_df_,
+    window_len=0.5,
+    step=0.1,
+    num_years=5,
+    min_covered_frac=0.5,
+    n_jobs=4,
+    routes_per_task=200,
+):
+    """
+    Compute the crash metrics of the sliding windows on all routes.
+    Parameters
+    ----------
+    crash_df_: pd.DataFrame()
+        Crash sections with route_gis, st_mp_pt, end_mp_pt, and the crash counts, e.g.
+        nc_crash_si_2015_2019.gpkg.
+    aadt_df_: pd.DataFrame()
+        AADT intervals with route_id, st_mp_pt, end_mp_pt, and aadt_2018, e.g.
+        ncdot_2018_aadt.gpkg.
+    window_len: float
+        Window length in miles.
+    step: float
+        Distance between window starts in miles.
+    num_years: int
+        Number of years of crash data.
+    min_covered_frac: float
+        Windows with crash data on less than this fraction of the window length are
+        dropped.
+    n_jobs: int
+        Number of processes. 1 runs in the current process.
+    routes_per_task: int
+        Number of routes sent to a process at a time.
+    Returns
+    -------
+    window_df_: pd.DataFrame()
+        route_id, window_st_mp, window_end_mp, covered_len, crash counts, aadt_2018
+        (length weighted), crash_rate_per_mile_per_year, inc_fac, and severity_index
+        for each window. Routes with AADT but no crash data are not screened.
+    """
+    crash_grps = dict(
+        list(
+            pd.DataFrame(crash_df_[["route_gis", "st_mp_pt", "end_mp_pt"] + CNT_COLS])
+            .assign(route_gis=lambda df: df.route_gis.astype(str))
+            .groupby("route_gis")
+        )
+    )
+    aadt_grps = (
+        pd.DataFrame(aadt_df_[["route_id", "st_mp_pt", "end_mp_pt", "aadt_2018"]])
+        .assign(route_id=lambda df: df.route_id.astype(str))
+        .groupby("route_id")
+    )
+    route_payloads = [
+        (route_id, crash_grps[route_id], aadt_route_df)
+        for route_id, aadt_route_df in aadt_grps
+        if route_id in crash_grps
+    ]
+    route_batches = [
+        route_payloads[batch_start : batch_start + routes_per_task]
+        for batch_start in range(0, len(route_payloads), routes_per_task)
+    ]
+    if n_jobs == 1:
+        window_df_list = [
+            screen_routes(route_batch, window_len, step)
+            for route_batch in route_batches
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            window_df_list = list(
+                executor.map(
+                    screen_routes,
+                    route_batches,
+                    [window_len] * len(route_batches),
+                    [step] * len(route_batches),
+                )
+            )
+    window_df_ = (
+        pd.concat(window_df_list, ignore_index=True)
+        .loc[lambda df: df.covered_len >= min_covered_frac * window_len]
+        .assign(
+            crash_rate_per_mile_per_year=lambda df: (
+                df.total_cnt / df.covered_len / num_years
+            ),
+            inc_fac=lambda df: df.crash_rate_per_mile_per_year * df.aadt_2018 / 100000,
+        )
+    )
+    window_df_ = get_severity_index(window_df_)
+    return window_df_
+
+
+def get_top_windows(window_df_, top_n=100, rank_col="inc_fac", max_per_route=1):
+    """
+    Get the top windows statewide.
+    Parameters
+    ----------
+    window_df_: pd.DataFrame()
+        Output from get_screening_windows.
+    top_n: int
+        Number of windows.
+    rank_col: str
+        Column used to rank the windows, e.g. inc_fac or crash_rate_per_mile_per_year.
+    max_per_route: int
+        Maximum number of windows from one route; overlapping windows around the same
+        hotspot otherwise fill the list. None keeps all windows.
+    Returns
+    -------
+    pd.DataFrame()
+        Top windows with a statewide rank.
+    """
+    top_window_df_ = window_df_.sort_values(rank_col, ascending=False)
+    if max_per_route is not None:
+        top_window_df_ = top_window_df_.groupby("route_id", sort=False).head(
+            max_per_route
+        )
+    return (
+        top_window_df_.head(top_n)
+        .reset_index(drop=True)
+        .assign(rank=lambda df: np.arange(1, len(df) + 1))
+    )
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_interim_data = os.path.join(path_to_prj_dir, "data", "interim")
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_crash_si = os.path.join(path_interim_data, "nc_crash_si_2015_2019.gpkg")
+    path_aadt_nc = os.path.join(path_interim_data, "ncdot_2018_aadt.gpkg")
+    path_top_windows = os.path.join(path_processed_data, "screening_top_windows.csv")
+    crash_gdf = gpd.read_file(path_crash_si, driver="gpkg")
+    aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+    # Screen 0.5 mile windows every 0.1 mile on all routes.
+    # ************************************************************************************
+    screening_window_df = get_screening_windows(
+        crash_gdf, aadt_gdf, window_len=0.5, step=0.1, num_years=5, n_jobs=4
+    )
+    top_window_df = get_top_windows(
+        screening_window_df, top_n=100, rank_col="inc_fac", max_per_route=1
+    )
+    top_window_df.to_csv(path_top_windows, index=False)
@@ -0,0 +1,227 @@
+"""
+Weight sensitivity sweep for the composite score. Sample thousands of weight vectors
+for the factors in the final merge output, rank the segments under each sample, and
+summarize how often each segment is in the top N and the quantiles of its rank. The
+samples are processed in parallel chunks and the results are accumulated in counters,
+so the memory does not grow with the number of samples.
+Created by: Apoorba Bibeka
+"""
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.utils import get_project_root
+from src.features.composite_score import FACTOR_COLS
+from src.features.composite_score import get_composite_scores
+from src.features.composite_score import get_score_ranks
+
+DEFAULT_WEIGHT_RANGES = {factor: (0, 0.5) for factor in FACTOR_COLS}
+
+
+def sample_weight_scenarios(n_samples, weight_ranges=None, seed=None):
+    """
+    Sample weight vectors uniformly within a range for each factor.
+    Parameters
+    ----------
+    n_samples: int
+        Number of weight vectors.
+    weight_ranges: dict
+        {factor: (low, high)}. Defaults to DEFAULT_WEIGHT_RANGES.
+    seed: int or np.random.SeedSequence
+        Seed for the random number generator.
+    Returns
+    -------
+    pd.DataFrame()
+        n_samples x f weights.
+    """
+    if weight_ranges is None:
+        weight_ranges = DEFAULT_WEIGHT_RANGES
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            factor: rng.uniform(low, high, n_samples)
+            for factor, (low, high) in weight_ranges.items()
+        }
+    )
+
+
+def get_rank_bin_edges(num_seg, n_rank_bins=32):
+    """
+    Get log-spaced rank bin edges so that the rank resolution is finer near the top.
+    Parameters
+    ----------
+    num_seg: int
+        Number of segments.
+    n_rank_bins: int
+        Maximum number of rank bins.
+    Returns
+    -------
+    np.array
+        Increasing bin edges from 1 to num_seg + 1.
+    """
+    return np.unique(
+        np.round(np.geomspace(1, num_seg + 1, n_rank_bins + 1)).astype(np.int64)
+    )
+
+
+def get_chunk_rank_stats(
+    score_df_, n_samples, seed, weight_ranges, top_n, rank_bin_edges, fill_factor_na
+):
+    """
+    Rank the segments for one chunk of sampled weight vectors.
+    Returns
+    -------
+    {"top_n_cnt": top_n_cnt, "rank_hist": rank_hist} : dict
+        top_n_cnt: number of samples each segment is in the top N.
+        rank_hist: (num_seg x num_bins) count of samples by rank bin.
+    """
+    weight_scenarios_ = sample_weight_scenarios(n_samples, weight_ranges, seed)
+    ranks = get_score_ranks(
+        get_composite_scores(
+            score_df_,
+            weight_scenarios_,
+            factor_cols=list(weight_ranges),
+            fill_factor_na=fill_factor_na,
+        )
+    )
+    num_seg = len(ranks)
+    num_bins = len(rank_bin_edges) - 1
+    rank_bin = np.searchsorted(rank_bin_edges, ranks, side="right") - 1
+    seg_idx = np.arange(num_seg)[:, np.newaxis]
+    rank_hist = np.bincount(
+        (seg_idx * num_bins + rank_bin).ravel(), minlength=num_seg * num_bins
+    ).reshape(num_seg, num_bins)
+    return {
+        "top_n_cnt": (ranks <= top_n).sum(axis=1),
+        "rank_hist": rank_hist.astype(np.int32),
+    }
+
+
+def get_rank_quantiles(rank_hist, rank_bin_edges, quantile):
+    """
+    Get a rank quantile for each segment from the rank histogram. Ranks are assumed
+    to be uniform over the integer ranks in a bin, so bins with one rank are exact.
+    """
+    cum_cnt = np.cumsum(rank_hist, axis=1)
+    target = quantile * cum_cnt[:, -1]
+    bin_idx = (cum_cnt < target[:, np.newaxis]).sum(axis=1)
+    bin_idx = np.minimum(bin_idx, rank_hist.shape[1] - 1)
+    seg_idx = np.arange(len(rank_hist))
+    cnt_before = np.where(bin_idx > 0, cum_cnt[seg_idx, bin_idx - 1], 0)
+    cnt_in_bin = np.maximum(rank_hist[seg_idx, bin_idx], 1)
+    bin_left = rank_bin_edges[bin_idx]
+    bin_width = rank_bin_edges[bin_idx + 1] - bin_left
+    return bin_left + (target - cnt_before) / cnt_in_bin * (bin_width - 1)
+
+
+def run_weight_sweep(
+    seg_df_,
+    n_samples=5000,
+    chunk_size=250,
+    top_n=100,
+    weight_ranges=None,
+    quantiles=(0.05, 0.5, 0.95),
+    n_rank_bins=32,
+    n_jobs=4,
+    seed=0,
+    fill_factor_na=0,
+    id_cols=("route_id", "aadt_interval_left", "aadt_interval_right"),
+):
+    """
+    Run the weight sensitivity sweep.
+    Parameters
+    ----------
+    seg_df_: pd.DataFrame()
+        Segments with inc_fac and the factor columns, e.g.
+        if_si_detour_nat_imp_census_padt.gpkg.
+    n_samples: int
+        Number of weight vectors.
+    chunk_size: int
+        Number of weight vectors per chunk.
+    top_n: int
+        Size of the top list, e.g. the number of segments in the IMAP expansion list.
+    weight_ranges: dict
+        {factor: (low, high)}. Defaults to DEFAULT_WEIGHT_RANGES.
+    quantiles: tuple
+        Rank quantiles to report.
+    n_rank_bins: int
+        Number of log-spaced rank bins used for the rank quantiles.
+    n_jobs: int
+        Number of threads. NumPy sorting and arithmetic release the GIL.
+    seed: int
+        Seed for the weight samples.
+    fill_factor_na: float
+        Value used for missing factors; 0 means no adjustment.
+    id_cols: tuple
+        Segment id columns kept in the output.
+    Returns
+    -------
+    weight_sensitivity_df_: pd.DataFrame()
+        id_cols, top_n_freq (fraction of samples in the top N), and rank_q<quantile>
+        for each segment.
+    """
+    if weight_ranges is None:
+        weight_ranges = DEFAULT_WEIGHT_RANGES
+    score_df_ = pd.DataFrame(seg_df_[["inc_fac"] + list(weight_ranges)]).reset_index(
+        drop=True
+    )
+    num_seg = len(score_df_)
+    rank_bin_edges = get_rank_bin_edges(num_seg, n_rank_bins)
+    chunk_sizes = [
+        min(chunk_size, n_samples - chunk_start)
+        for chunk_start in range(0, n_samples, chunk_size)
+    ]
+    chunk_seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    top_n_cnt = np.zeros(num_seg, dtype=np.int64)
+    rank_hist = np.zeros((num_seg, len(rank_bin_edges) - 1), dtype=np.int64)
+    # Keep at most n_jobs chunks in flight so that memory stays constant.
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending = set()
+        chunk_iter = iter(zip(chunk_sizes, chunk_seeds))
+        while True:
+            for chunk_n_samples, chunk_seed in chunk_iter:
+                pending.add(
+                    executor.submit(
+                        get_chunk_rank_stats,
+                        score_df_,
+                        chunk_n_samples,
+                        chunk_seed,
+                        weight_ranges,
+                        top_n,
+                        rank_bin_edges,
+                        fill_factor_na,
+                    )
+                )
+                if len(pending) >= n_jobs:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk_stats = future.result()
+                top_n_cnt += chunk_stats["top_n_cnt"]
+                rank_hist += chunk_stats["rank_hist"]
+    weight_sensitivity_df_ = pd.DataFrame(seg_df_[list(id_cols)]).reset_index(drop=True)
+    weight_sensitivity_df_["top_n_freq"] = top_n_cnt / n_samples
+    for quantile in quantiles:
+        weight_sensitivity_df_[f"rank_q{int(round(quantile * 100)):02d}"] = (
+            get_rank_quantiles(rank_hist, rank_bin_edges, quantile)
+        )
+    return weight_sensitivity_df_.sort_values("top_n_freq", ascending=False)
+
+
+if __name__ == "__main__":
+    path_to_prj_dir = get_project_root()
+    path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
+    path_if_si_detour_nat_imp_census_padt = os.path.join(
+        path_processed_data, "if_si_detour_nat_imp_census_padt.gpkg"
+    )
+    path_weight_sensitivity = os.path.join(
+        path_processed_data, "weight_sensitivity.csv"
+    )
+    scored_seg_gdf = gpd.read_file(path_if_si_detour_nat_imp_census_padt, driver="gpkg")
+    weight_sensitivity_df = run_weight_sweep(
+        scored_seg_gdf, n_samples=5000, chunk_size=250, top_n=100, n_jobs=4
+    )
+    weight_sensitivity_df.to_csv(path_weight_sensitivity, index=False)
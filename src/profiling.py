@@ -0,0 +1,345 @@
+"""
+Lightweight profiling for the pipeline stages. Wrap a stage (read, merge, spatial join,
+scaling, write) in profile_stage to record the wall time, CPU time, peak and change in
+resident memory (and the peak traced memory with trace_memory), rows in and out, and
+bytes read and written, and write one JSON trace per run with the peak resident memory
+of the process.
+Compare two traces from the command line to find the stages that regressed:
+python -m src.profiling compare <old trace> <new trace>
+Created by: Apoorba Bibeka
+"""
+import os
+import sys
+import json
+import time
+import threading
+import argparse
+import platform
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+import pandas as pd
+from src.utils import get_project_root
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+# Floor of the stage memory in compare_traces so that small stages do not flag noise.
+MIN_STAGE_MEM_MB = 16
+# Interval between the resident memory samples taken during a stage.
+RSS_SAMPLE_SECONDS = 0.05
+
+
+def new_trace(run_name, trace_memory=False):
+    """
+    Create an empty trace for a run.
+    Parameters
+    ----------
+    run_name: str
+        Name of the run.
+    trace_memory: bool
+        Record the peak memory allocated in each stage with tracemalloc. Slows down
+        the stages.
+    """
+    return {
+        "run_name": run_name,
+        "trace_memory": trace_memory,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "stages": [],
+    }
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident memory of the process in MB; None when not available.
+    """
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux.
+    if sys.platform == "darwin":
+        return peak_rss / 1024**2
+    return peak_rss / 1024
+
+
+def get_current_rss_mb():
+    """
+    Current resident memory of the process in MB (Linux); None when not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            num_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return num_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def reset_traced_peak():
+    """
+    Start tracemalloc if needed and reset its peak; returns the traced memory at the
+    reset.
+    """
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+    # Before Python 3.9: clearing the traces also resets the peak.
+    tracemalloc.clear_traces()
+    return 0
+
+
+def sample_peak_rss(stop_event, peak_rss, interval_s=RSS_SAMPLE_SECONDS):
+    """
+    Sample the current resident memory every interval_s seconds until stop_event is
+    set and keep the maximum in peak_rss["mb"]. Runs in a daemon thread during a
+    stage; memory allocated and freed between two samples is missed.
+    """
+    while not stop_event.wait(interval_s):
+        rss = get_current_rss_mb()
+        if rss is not None and rss > peak_rss["mb"]:
+            peak_rss["mb"] = rss
+
+
+def get_num_bytes(paths):
+    """
+    Total size of the files in paths. A shapefile path includes its sidecar files
+    and a folder includes all files in it. Missing paths are skipped.
+    """
+    num_bytes = 0
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, _, file_names in os.walk(path):
+                num_bytes += sum(
+                    os.path.getsize(os.path.join(dir_path, file_name))
+                    for file_name in file_names
+                )
+        elif path.lower().endswith(".shp"):
+            path_stem = os.path.splitext(path)[0]
+            path_dir = os.path.dirname(path) or "."
+            num_bytes += sum(
+                os.path.getsize(os.path.join(path_dir, file_name))
+                for file_name in os.listdir(path_dir)
+                if os.path.splitext(os.path.join(path_dir, file_name))[0] == path_stem
+            )
+        elif os.path.exists(path):
+            num_bytes += os.path.getsize(path)
+    return num_bytes
+
+
+@contextmanager
+def profile_stage(trace, stage_name, rows_in=None, paths_in=(), paths_out=()):
+    """
+    Profile a stage and append its record to trace["stages"].
+    Parameters
+    ----------
+    trace: dict
+        Trace from new_trace.
+    stage_name: str
+        Stage name, e.g. "read_aadt" or "merge_aadt_crash".
+    rows_in: int
+        Number of input rows.
+    paths_in: tuple
+        Files read by the stage.
+    paths_out: tuple
+        Files written by the stage. The sizes are taken after the stage.
+    Yields
+    ------
+    stage: dict
+        Stage record. Set stage["rows_out"] inside the with block.
+    Example
+    -------
+    with profile_stage(trace, "read_aadt", paths_in=[path_aadt_nc]) as stage:
+        aadt_gdf = gpd.read_file(path_aadt_nc, driver="gpkg")
+        stage["rows_out"] = len(aadt_gdf)
+    """
+    stage = {"stage": stage_name, "rows_in": rows_in, "rows_out": None}
+    trace_memory = trace.get("trace_memory", False)
+    if trace_memory:
+        traced_st = reset_traced_peak()
+    rss_st = get_current_rss_mb()
+    peak_rss = {"mb": rss_st}
+    stop_event = threading.Event()
+    if rss_st is not None:
+        sampler = threading.Thread(
+            target=sample_peak_rss, args=(stop_event, peak_rss), daemon=True
+        )
+        sampler.start()
+    wall_st = time.perf_counter()
+    cpu_st = time.process_time()
+    try:
+        yield stage
+    finally:
+        stop_event.set()
+        if rss_st is not None:
+            sampler.join()
+        rss_end = get_current_rss_mb()
+        stage.update(
+            wall_time_s=time.perf_counter() - wall_st,
+            cpu_time_s=time.process_time() - cpu_st,
+            # Sampled peak of the resident memory during the stage and the memory kept
+            # by the stage; ru_maxrss is the peak of the whole process and is recorded
+            # once for the run in write_trace.
+            peak_rss_mb=None if rss_st is None else max(peak_rss["mb"], rss_end),
+            peak_rss_delta_mb=(
+                None if rss_st is None else max(peak_rss["mb"], rss_end) - rss_st
+            ),
+            rss_delta_mb=None if rss_st is None else rss_end - rss_st,
+            traced_peak_mb=(
+                (tracemalloc.get_traced_memory()[1] - traced_st) / 1024**2
+                if trace_memory
+                else None
+            ),
+            bytes_read=get_num_bytes(paths_in),
+            bytes_written=get_num_bytes(paths_out),
+        )
+        trace["stages"].append(stage)
+
+
+def get_trace_path(run_name, path_trace_dir=None):
+    """
+    Get a time-stamped trace path in the traces interim folder.
+    """
+    if path_trace_dir is None:
+        path_trace_dir = os.path.join(get_project_root(), "data", "interim", "traces")
+    if not os.path.isdir(path_trace_dir):
+        os.makedirs(path_trace_dir)
+    time_stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(path_trace_dir, f"{run_name}_{time_stamp}.json")
+
+
+def write_trace(trace, path_trace=None):
+    """
+    Write the trace to path_trace (default: get_trace_path) and return the path.
+    """
+    if path_trace is None:
+        path_trace = get_trace_path(trace["run_name"])
+    trace["total_wall_time_s"] = sum(stage["wall_time_s"] for stage in trace["stages"])
+    trace["peak_rss_mb"] = get_peak_rss_mb()
+    with open(path_trace, "w") as f:
+        json.dump(trace, f, indent=2)
+    return path_trace
+
+
+def read_trace(path_trace):
+    with open(path_trace) as f:
+        return json.load(f)
+
+
+def compare_traces(trace_old, trace_new, regression_ratio=1.2):
+    """
+    Compare two traces stage by stage.
+    Parameters
+    ----------
+    trace_old: dict
+        Baseline trace.
+    trace_new: dict
+        New trace.
+    regression_ratio: float
+        A stage is flagged when its wall time, CPU time, or memory grows by more than
+        this ratio. The stage memory is the traced peak when both traces have it, else
+        the sampled peak increase of the resident memory when both traces have it,
+        else the change in resident memory, with a floor of MIN_STAGE_MEM_MB.
+    Returns
+    -------
+    trace_diff_: pd.DataFrame()
+        Old and new values, new / old ratios, and a regressed flag for each stage.
+        Repeated stage names are matched in order of occurrence (occurrence column).
+        Stages only in one trace have missing values for the other.
+    """
+    metrics = [
+        "wall_time_s",
+        "cpu_time_s",
+        "rss_delta_mb",
+        "peak_rss_delta_mb",
+        "traced_peak_mb",
+        "rows_in",
+        "rows_out",
+        "bytes_read",
+        "bytes_written",
+    ]
+    stages_old, stages_new = [
+        pd.DataFrame(trace["stages"], columns=["stage"] + metrics)
+        .assign(occurrence=lambda df: df.groupby("stage").cumcount())
+        .set_index(["stage", "occurrence"])
+        for trace in [trace_old, trace_new]
+    ]
+    trace_diff_ = stages_old.join(
+        stages_new, how="outer", lsuffix="_old", rsuffix="_new"
+    )
+    for suffix in ["old", "new"]:
+        stage_mem_mb = trace_diff_[f"rss_delta_mb_{suffix}"].astype(float)
+        for mem_metric in ["peak_rss_delta_mb", "traced_peak_mb"]:
+            stage_mem_mb = (
+                trace_diff_[f"{mem_metric}_{suffix}"]
+                .astype(float)
+                .where(
+                    trace_diff_[f"{mem_metric}_old"].notna()
+                    & trace_diff_[f"{mem_metric}_new"].notna(),
+                    stage_mem_mb,
+                )
+            )
+        trace_diff_[f"stage_mem_mb_{suffix}"] = stage_mem_mb.clip(
+            lower=MIN_STAGE_MEM_MB
+        )
+    ratio_cols = []
+    for metric in ["wall_time_s", "cpu_time_s", "stage_mem_mb"]:
+        metric_old = trace_diff_[f"{metric}_old"].astype(float)
+        metric_new = trace_diff_[f"{metric}_new"].astype(float)
+        trace_diff_[f"{metric}_ratio"] = metric_new / metric_old
+        ratio_cols.append(f"{metric}_ratio")
+    trace_diff_["regressed"] = trace_diff_[ratio_cols].max(axis=1) > regression_ratio
+    stage_order = list(stages_new.index) + [
+        stage for stage in stages_old.index if stage not in stages_new.index
+    ]
+    return trace_diff_.reindex(stage_order).reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline profiling traces.")
+    subparsers = parser.add_subparsers(dest="command")
+    parser_compare = subparsers.add_parser("compare", help="Compare two traces.")
+    parser_compare.add_argument("trace_old", help="Baseline trace json.")
+    parser_compare.add_argument("trace_new", help="New trace json.")
+    parser_compare.add_argument(
+        "--regression-ratio",
+        type=float,
+        default=1.2,
+        help="Flag stages whose time or memory grows by more than this ratio.",
+    )
+    args = parser.parse_args()
+    if args.command != "compare":
+        parser.print_help()
+        sys.exit(1)
+    trace_old = read_trace(args.trace_old)
+    trace_new = read_trace(args.trace_new)
+    trace_diff = compare_traces(
+        trace_old, trace_new, regression_ratio=args.regression_ratio
+    )
+    print(
+        f"Peak resident memory of the run (MB): {trace_old.get('peak_rss_mb')} -> "
+        f"{trace_new.get('peak_rss_mb')}"
+    )
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(
+            trace_diff[
+                [
+                    "stage",
+                    "occurrence",
+                    "wall_time_s_old",
+                    "wall_time_s_new",
+                    "wall_time_s_ratio",
+                    "cpu_time_s_ratio",
+                    "stage_mem_mb_ratio",
+                    "rows_out_old",
+                    "rows_out_new",
+                    "regressed",
+                ]
+            ].round(3)
+        )
+    sys.exit(int(trace_diff.regressed.any()))
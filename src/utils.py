@@ -1,5 +1,7 @@
 from pathlib import Path
 import inflection
+import numpy as np
+import pandas as pd
 import geopandas as gpd
 
 
@@ -27,3 +29,96 @@ def read_shp(file, data_name=""):
     print(f"{data_name} cooridnate sytem is {gdf_.crs.srs}")
     gdf_.columns = [inflection.underscore(col_name) for col_name in gdf_.columns]
     return gdf_
+
+
+# Segment ids: seg_id = route_id x SEG_ID_ROUTE_FACTOR + ordinal of the AADT interval on
+# the route (in start milepost order). The 11 digit route ids keep seg_id in int64.
+SEG_ID_ROUTE_FACTOR = 10000
+
+
+def get_seg_ids(route_ids, ordinals):
+    """
+    Get the int64 segment ids from the route ids and the ordinals of the segments on
+    their routes.
+    """
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    assert (ordinals < SEG_ID_ROUTE_FACTOR).all(), "Too many segments on a route."
+    route_ids = np.asarray(pd.to_numeric(pd.Series(route_ids).astype(str)), np.int64)
+    return route_ids * SEG_ID_ROUTE_FACTOR + ordinals
+
+
+def get_lrs_keys(route_ids, mileposts):
+    """
+    int64 keys of (route id, milepost) with the milepost rounded to a thousandth of a
+    mile, for exact lookups of tables keyed by route and milepost.
+    """
+    route_ids = np.asarray(pd.to_numeric(pd.Series(route_ids).astype(str)), np.int64)
+    milli_mp = np.round(np.asarray(mileposts, dtype=float) * 1000).astype(np.int64)
+    return route_ids * 10**6 + milli_mp
+
+
+def lookup_seg_ids(seg_df_, route_ids, mileposts):
+    """
+    Find the seg_id of the segments in seg_df_ (route_id, aadt_interval_left, seg_id)
+    that start at the given route ids and mileposts. Not found gives -1.
+    """
+    query_keys = get_lrs_keys(route_ids, mileposts)
+    if len(seg_df_) == 0:
+        return np.full(len(query_keys), -1, dtype=np.int64)
+    seg_keys = get_lrs_keys(seg_df_.route_id.values, seg_df_.aadt_interval_left.values)
+    sort_order = np.argsort(seg_keys, kind="mergesort")
+    seg_keys = seg_keys[sort_order]
+    idx = np.clip(np.searchsorted(seg_keys, query_keys), 0, len(seg_keys) - 1)
+    return np.where(
+        seg_keys[idx] == query_keys,
+        seg_df_.seg_id.values.astype(np.int64)[sort_order][idx],
+        -1,
+    )
+
+
+def merge_join_sorted(left_df_, right_dfs, on="seg_id"):
+    """
+    Left join several tables to left_df_ on an int64 key with one sort and
+    searchsorted per right table, instead of a chain of hash merges.
+    Parameters
+    ----------
+    left_df_: pd.DataFrame()
+        Left table.
+    right_dfs: list
+        Right tables with unique keys in the on column.
+    on: str
+        Key column, e.g. seg_id.
+    Returns
+    -------
+    pd.DataFrame()
+        left_df_ (same rows and order) with the other columns of the right tables.
+        Rows without a match have missing values.
+    """
+    left_keys = left_df_[on].values.astype(np.int64)
+    joined_dfs = [left_df_.reset_index(drop=True)]
+    for right_df in right_dfs:
+        right_cols_df = pd.DataFrame(right_df.drop(columns=on))
+        if len(right_df) == 0:
+            joined_dfs.append(
+                pd.DataFrame(index=range(len(left_keys)), columns=right_cols_df.columns)
+            )
+            continue
+        right_keys = right_df[on].values.astype(np.int64)
+        sort_order = np.argsort(right_keys, kind="mergesort")
+        right_keys = right_keys[sort_order]
+        if (right_keys[1:] == right_keys[:-1]).any():
+            raise ValueError(f"Duplicate {on} in a right table.")
+        idx = np.clip(np.searchsorted(right_keys, left_keys), 0, len(right_keys) - 1)
+        is_found = right_keys[idx] == left_keys
+        joined_dfs.append(
+            right_cols_df.iloc[sort_order[idx]]
+            .reset_index(drop=True)
+            .where(pd.Series(is_found), axis=0)
+        )
+    joined_df = pd.concat(joined_dfs, axis=1)
+    joined_df.index = left_df_.index
+    if isinstance(left_df_, gpd.GeoDataFrame):
+        joined_df = gpd.GeoDataFrame(
+            joined_df, geometry=left_df_.geometry.name, crs=left_df_.crs
+        )
+    return joined_df
@@ -0,0 +1,133 @@
+"""
+Serialize GeoDataFrames to compact GeoJSON with a fixed coordinate precision and an
+attribute whitelist. Write gzip and brotli precompressed copies of the static map
+assets so a static file server can send them as is.
+Created by: Apoorba Bibeka
+"""
+import os
+import gzip
+import json
+import numpy as np
+from shapely.geometry import mapping
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def round_coords(coords, precision=5):
+    """
+    Round a GeoJSON coordinate array and drop consecutive duplicate vertices.
+    Parameters
+    ----------
+    coords: tuple or list
+        Coordinates from shapely.geometry.mapping; a point, a list of points, or a
+        nested list of points.
+    precision: int
+        Number of decimal places to keep. 5 decimal places is ~1 m in EPSG:4326.
+    Returns
+    -------
+    list
+        Rounded coordinates with the same nesting as coords.
+    """
+    if len(coords) == 0:
+        return []
+    if isinstance(coords[0], (int, float)):
+        return [round(value, precision) for value in coords]
+    if isinstance(coords[0][0], (int, float)):
+        coords_rounded = np.round(np.asarray(coords, dtype=float), precision)
+        keep = np.ones(len(coords_rounded), dtype=bool)
+        keep[1:] = (coords_rounded[1:] != coords_rounded[:-1]).any(axis=1)
+        # Lines need 2 points and rings need 4; keep all vertices of collapsed parts.
+        is_ring = (coords_rounded[0] == coords_rounded[-1]).all()
+        if keep.sum() < (4 if is_ring else 2):
+            return coords_rounded.tolist()
+        return coords_rounded[keep].tolist()
+    return [round_coords(part, precision) for part in coords]
+
+
+def to_compact_geojson(gdf, precision=5, properties=None):
+    """
+    Serialize gdf to a compact GeoJSON FeatureCollection string.
+    Parameters
+    ----------
+    gdf: gpd.GeoDataFrame()
+        Data to serialize. Should be in EPSG:4326 for web maps.
+    precision: int
+        Number of decimal places to keep for the coordinates.
+    properties: list
+        Whitelist of columns to keep as feature properties. None keeps all columns.
+    Returns
+    -------
+    str
+        GeoJSON FeatureCollection. The index of gdf is used as the feature "id" (as
+        in gpd.GeoDataFrame.to_json()).
+    """
+    if properties is None:
+        properties = [col for col in gdf.columns if col != gdf.geometry.name]
+    prop_df = gdf[list(properties)]
+    prop_records = (
+        prop_df.astype(object).where(prop_df.notna(), None).to_dict(orient="records")
+    )
+    features = []
+    for feature_id, geom, prop in zip(
+        gdf.index.astype(str), gdf.geometry.values, prop_records
+    ):
+        if geom is None or geom.is_empty:
+            geometry = None
+        else:
+            geom_mapping = mapping(geom)
+            geometry = {
+                "type": geom_mapping["type"],
+                "coordinates": round_coords(geom_mapping["coordinates"], precision),
+            }
+        features.append(
+            {
+                "id": feature_id,
+                "type": "Feature",
+                "properties": prop,
+                "geometry": geometry,
+            }
+        )
+    return json.dumps(
+        {"type": "FeatureCollection", "features": features},
+        separators=(",", ":"),
+        default=str,
+    )
+
+
+def write_precompressed(text, path):
+    """
+    Write text to path along with gzip (path.gz) and brotli (path.br) sidecars. The
+    brotli sidecar is skipped if the brotli package is not installed.
+    Parameters
+    ----------
+    text: str
+        File content; GeoJSON, html, etc.
+    path: str
+        Output path for the uncompressed file.
+    Returns
+    -------
+    sizes_: dict
+        Number of bytes written to each file.
+    """
+    data = text.encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(data)
+    sizes_ = {path: len(data)}
+    # mtime=0 so that the same content always gives the same .gz file.
+    with open(f"{path}.gz", "wb") as f:
+        with gzip.GzipFile(
+            filename="", mode="wb", fileobj=f, compresslevel=9, mtime=0
+        ) as f_gz:
+            f_gz.write(data)
+    sizes_[f"{path}.gz"] = os.path.getsize(f"{path}.gz")
+    if brotli is None:
+        print(f"brotli is not installed; skipping {path}.br")
+    else:
+        data_br = brotli.compress(data, quality=11)
+        with open(f"{path}.br", "wb") as f:
+            f.write(data_br)
+        sizes_[f"{path}.br"] = len(data_br)
+    return sizes_
@@ -0,0 +1,149 @@
+"""
+Exact 1-D optimal clustering (Ckmeans) for classifying the severity index, incident
+factor, and composite scores into legend bins. The dynamic program minimizes the
+within-class sum of squares on the sorted unique values; each layer of the program is
+solved with divide and conquer over the monotone split points, so k classes take
+O(k n log n) for n unique values. All layers for k = 2..max_k come out of one call.
+Created by: Apoorba Bibeka
+"""
+import numpy as np
+
+
+def get_within_ssq(cum_wt, cum_wt_x, cum_wt_x2, cls_st, cls_end):
+    """
+    Weighted within-class sum of squares of the sorted values cls_st..cls_end
+    (inclusive) from prefix sums.
+    """
+    wt = cum_wt[cls_end + 1] - cum_wt[cls_st]
+    wt_x = cum_wt_x[cls_end + 1] - cum_wt_x[cls_st]
+    wt_x2 = cum_wt_x2[cls_end + 1] - cum_wt_x2[cls_st]
+    return np.maximum(wt_x2 - wt_x**2 / wt, 0)
+
+
+def solve_ckmeans_layer(ssq_prev, k, cum_wt, cum_wt_x, cum_wt_x2):
+    """
+    Solve one layer of the Ckmeans dynamic program:
+    ssq_k[i] = min over j of ssq_(k-1)[j - 1] + within_ssq(j, i).
+    The optimal j is monotone in i, so the layer is solved by divide and conquer. All
+    subproblems at the same recursion depth are evaluated together.
+    Parameters
+    ----------
+    ssq_prev: np.array
+        Optimal sum of squares with k - 1 classes for the first i + 1 values.
+    k: int
+        Number of classes.
+    cum_wt, cum_wt_x, cum_wt_x2: np.array
+        Prefix sums of the weights, weight x value, and weight x value^2.
+    Returns
+    -------
+    (ssq_k, cls_st_k): tuple
+        ssq_k: optimal sum of squares with k classes for the first i + 1 values.
+        cls_st_k: start of the last class in the optimal solution.
+    """
+    num_val = len(cum_wt) - 1
+    ssq_k = np.full(num_val, np.inf)
+    cls_st_k = np.zeros(num_val, dtype=np.int64)
+    # Subproblems: rows i in [lo, hi] with the optimal j in [opt_lo, opt_hi].
+    lo = np.array([k - 1])
+    hi = np.array([num_val - 1])
+    opt_lo = np.array([k - 1])
+    opt_hi = np.array([num_val - 1])
+    while len(lo) > 0:
+        mid = (lo + hi) // 2
+        cand_hi = np.minimum(mid, opt_hi)
+        num_cand = cand_hi - opt_lo + 1
+        task_idx = np.repeat(np.arange(len(mid)), num_cand)
+        cand_j = opt_lo[task_idx] + (
+            np.arange(num_cand.sum())
+            - np.repeat(np.cumsum(num_cand) - num_cand, num_cand)
+        )
+        cand_cost = ssq_prev[cand_j - 1] + get_within_ssq(
+            cum_wt, cum_wt_x, cum_wt_x2, cand_j, mid[task_idx]
+        )
+        # Arg min within each subproblem; ties go to the smallest j.
+        task_min = np.minimum.reduceat(cand_cost, np.cumsum(num_cand) - num_cand)
+        is_min = cand_cost <= task_min[task_idx]
+        _, first_min = np.unique(task_idx[is_min], return_index=True)
+        best_j = cand_j[is_min][first_min]
+        ssq_k[mid] = task_min
+        cls_st_k[mid] = best_j
+        has_left = mid - 1 >= lo
+        has_right = mid + 1 <= hi
+        lo, hi, opt_lo, opt_hi = (
+            np.concatenate([lo[has_left], mid[has_right] + 1]),
+            np.concatenate([mid[has_left] - 1, hi[has_right]]),
+            np.concatenate([opt_lo[has_left], best_j[has_right]]),
+            np.concatenate([best_j[has_left], opt_hi[has_right]]),
+        )
+    return ssq_k, cls_st_k
+
+
+def get_optimal_breaks(values, max_k=7, min_k=2):
+    """
+    Get the optimal 1-D class breaks for k = min_k..max_k classes.
+    Parameters
+    ----------
+    values: array-like
+        Values to classify, e.g. severity index or IF. Missing values are ignored.
+    max_k: int
+        Maximum number of classes.
+    min_k: int
+        Minimum number of classes.
+    Returns
+    -------
+    dict
+        {k: {"breaks": breaks, "centers": centers, "within_ssq": within_ssq}}
+        breaks: k + 1 class bounds [min, upper bound of class 1, ..., max].
+        centers: mean of each class.
+        within_ssq: total within-class sum of squares.
+        Only k up to the number of unique values are returned.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    uniq_val, uniq_cnt = np.unique(values, return_counts=True)
+    num_val = len(uniq_val)
+    max_k = min(max_k, num_val)
+    cum_wt = np.concatenate([[0], np.cumsum(uniq_cnt)]).astype(float)
+    cum_wt_x = np.concatenate([[0], np.cumsum(uniq_cnt * uniq_val)])
+    cum_wt_x2 = np.concatenate([[0], np.cumsum(uniq_cnt * uniq_val**2)])
+    ssq_layer = get_within_ssq(
+        cum_wt,
+        cum_wt_x,
+        cum_wt_x2,
+        np.zeros(num_val, dtype=np.int64),
+        np.arange(num_val),
+    )
+    cls_st_layers = [np.zeros(num_val, dtype=np.int64)]
+    optimal_breaks = {}
+    for k in range(1, max_k + 1):
+        if k > 1:
+            ssq_layer, cls_st_k = solve_ckmeans_layer(
+                ssq_layer, k, cum_wt, cum_wt_x, cum_wt_x2
+            )
+            cls_st_layers.append(cls_st_k)
+        if k < min_k:
+            continue
+        # Backtrack the class starts from the last value.
+        cls_st = np.zeros(k, dtype=np.int64)
+        cls_end = num_val - 1
+        for layer in range(k - 1, -1, -1):
+            cls_st[layer] = cls_st_layers[layer][cls_end]
+            cls_end = cls_st[layer] - 1
+        cls_end = np.concatenate([cls_st[1:] - 1, [num_val - 1]])
+        cls_wt = cum_wt[cls_end + 1] - cum_wt[cls_st]
+        optimal_breaks[k] = {
+            "breaks": np.concatenate([[uniq_val[0]], uniq_val[cls_end]]),
+            "centers": (cum_wt_x[cls_end + 1] - cum_wt_x[cls_st]) / cls_wt,
+            "within_ssq": float(ssq_layer[-1]),
+        }
+    return optimal_breaks
+
+
+def classify_by_breaks(values, breaks):
+    """
+    Assign class labels (0..k-1) using the breaks from get_optimal_breaks. A value
+    equal to a class upper bound belongs to that class. Missing values get -1.
+    """
+    values = np.asarray(values, dtype=float)
+    labels = np.searchsorted(breaks[1:-1], values, side="left")
+    return np.where(np.isnan(values), -1, labels)
@@ -1,15 +1,20 @@
 """
-Visualize severity index using pdf, cdf, and k-means clustering.
+Visualize severity index using pdf, cdf, and exact 1-D k-means clustering.
 Created by: Apoorba Bibeka
 """
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import os
 import seaborn as sns
-from sklearn.cluster import KMeans
 import matplotlib.pyplot as plt
 import matplotlib.ticker as plticker
 from src.utils import get_project_root
+from src.visualization.optimal_breaks import get_optimal_breaks
+from src.visualization.distribution_summary import get_distribution_summaries
+from src.visualization.distribution_summary import get_cached_summaries
+from src.visualization.distribution_summary import plot_distribution_summary
+from src.visualization.optimal_breaks import classify_by_breaks
 
 
 plt.rcParams.update({'font.size': 14})
@@ -23,6 +28,19 @@ LOC_X = plticker.MultipleLocator(
     )  # this locator puts ticks at regular intervals
 
 
+def get_summaries(df_, y_var, facet_col_=None, sharex_=True, path_cache_dir_=None):
+    """
+    Get the distribution summaries, from the cache when path_cache_dir_ is given.
+    """
+    if path_cache_dir_ is None:
+        return get_distribution_summaries(
+            df_, y_var, facet_col=facet_col_, sharex=sharex_
+        )
+    return get_cached_summaries(
+        df_, y_var, path_cache_dir_, facet_col=facet_col_, sharex=sharex_
+    )
+
+
 def plot_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
                  quantile_90th_,
                  loc_x=LOC_X,
@@ -30,9 +48,10 @@ def plot_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
                  y_var="severity_index",
                  y_label="Severity Index",
                  title_="2015-2019 Severity Index CDF",
-                 img_file_="severity_index_cdf_2015_2019"):
+                 img_file_="severity_index_cdf_2015_2019",
+                 path_cache_dir_=None):
     """
-
+    Plot the CDF and PDF of y_var from the binned distribution summary.
     Parameters
     ----------
     crash_df_fil_si_geom_gdf_no_nan_
@@ -41,20 +60,20 @@ def plot_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
     loc_y
     title_
     img_file_
+    path_cache_dir_
+        Folder with the cached distribution summaries. None computes the summary
+        without caching.
 
     Returns
     -------
 
     """
-    si_cdf_plot = sns.distplot(
-        crash_df_fil_si_geom_gdf_no_nan_[y_var], hist_kws={"cumulative": True},
-        kde_kws={"cumulative": True},
-    )
-    sns.distplot(
-        crash_df_fil_si_geom_gdf_no_nan_[y_var],
-        ax=si_cdf_plot,
-        axlabel=y_label,
-    )
+    summary = get_summaries(
+        crash_df_fil_si_geom_gdf_no_nan_, y_var, path_cache_dir_=path_cache_dir_
+    )["all"]
+    si_cdf_plot_fig, si_cdf_plot = plt.subplots()
+    plot_distribution_summary(si_cdf_plot, summary)
+    si_cdf_plot.set_xlabel(y_label)
     si_cdf_plot.set_title(title_)
     if bool(loc_x):
         si_cdf_plot.xaxis.set_major_locator(loc_x)
@@ -62,7 +81,6 @@ def plot_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
         si_cdf_plot.yaxis.set_major_locator(loc_y)
     plt.axvline(quantile_90th_, color='red')
     plt.text(quantile_90th_-10, 0.90, r"$90^{th}$"+"\nPercentile\n= "f"{round(quantile_90th_,2)}", fontsize=10)
-    si_cdf_plot_fig = si_cdf_plot.get_figure()
     plt.tight_layout()
     si_cdf_plot_fig.set_size_inches(6, 4)
     si_cdf_plot_fig.savefig(
@@ -80,9 +98,11 @@ def plot_facet_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
                        title_="2015-2019 Severity Index CDF for Different Route Class",
                        img_file_="severity_index_cdf_2015_2019_rt_cls",
                        facet_col_="route_class",
-                       sharex_=True):
+                       sharex_=True,
+                       path_cache_dir_=None):
     """
-
+    Plot the CDF and PDF of y_var for each facet from the binned distribution
+    summaries. All facets are summarized in one pass.
     Parameters
     ----------
     crash_df_fil_si_geom_gdf_no_nan_
@@ -92,53 +112,78 @@ def plot_facet_cdf_pdf(crash_df_fil_si_geom_gdf_no_nan_,
     img_file_
     facet_col_
     sharex_
+    path_cache_dir_
+        Folder with the cached distribution summaries. None computes the summaries
+        without caching.
 
     Returns
     -------
 
     """
-    si_cdf_plot_rt_cls = sns.FacetGrid(
-        crash_df_fil_si_geom_gdf_no_nan_, col=facet_col_, height=4, aspect=1,
-        sharex=sharex_
+    summaries = get_summaries(
+        crash_df_fil_si_geom_gdf_no_nan_,
+        y_var,
+        facet_col_=facet_col_,
+        sharex_=sharex_,
+        path_cache_dir_=path_cache_dir_,
     )
-    si_cdf_plot_rt_cls.map(
-        sns.distplot, y_var, hist_kws={"cumulative": True},
-        kde_kws={"cumulative": True}
+    si_cdf_plot_rt_cls_fig, si_cdf_plot_rt_cls_axes = plt.subplots(
+        1, len(summaries), figsize=(4 * len(summaries), 4), sharex=sharex_,
+        sharey=True, squeeze=False
     )
-    si_cdf_plot_rt_cls.map(sns.distplot, y_var, color="orange")
-    for ax in si_cdf_plot_rt_cls.axes.flat:
+    for ax, (facet_name, summary) in zip(
+            si_cdf_plot_rt_cls_axes.flat, summaries.items()):
+        plot_distribution_summary(ax, summary)
+        ax.set_title(f"{facet_col_} = {facet_name}")
+        ax.set_xlabel(y_label)
         if bool(loc_x):
             ax.xaxis.set_major_locator(loc_x)
         if bool(loc_y):
             ax.yaxis.set_major_locator(loc_y)
     plt.subplots_adjust(top=0.85)
-    si_cdf_plot_rt_cls.fig.suptitle(title_)
-    si_cdf_plot_rt_cls.set_xlabels(y_label)
+    si_cdf_plot_rt_cls_fig.suptitle(title_)
     plt.tight_layout()
-    si_cdf_plot_rt_cls.savefig(
+    si_cdf_plot_rt_cls_fig.savefig(
         fname=os.path.join(path_to_fig, f"{img_file_}.png")
     )
     plt.close()
     return 0
 
 
-def apply_kmeans_cluster_plot(crash_df_fil_si_geom_gdf_no_nan_):
+def apply_kmeans_cluster_plot(crash_df_fil_si_geom_gdf_no_nan_, n_clusters=2):
     """
-
+    Cluster the severity index with exact 1-D k-means (Ckmeans) and plot the cluster
+    centroids and the points by cluster.
     Parameters
     ----------
     crash_df_fil_si_geom_gdf_no_nan_
-
+        Data with non-missing severity index.
+    n_clusters
+        Number of clusters. Capped at the number of unique severity index values.
     Returns
     -------
-
+    optimal_breaks_si: dict
+        Class breaks, centers, and within-class sum of squares for 2..n_clusters
+        clusters from get_optimal_breaks.
     """
-    X = crash_df_fil_si_geom_gdf_no_nan_.severity_index.values.reshape(-1, 1)
-    kmeans_si = KMeans(n_clusters=2, random_state=0).fit(X)
-    list(kmeans_si.labels_)
-    colors = ["r", "b"]
-    centroids = kmeans_si.cluster_centers_
-    Z = kmeans_si.predict(X)
+    si_values = crash_df_fil_si_geom_gdf_no_nan_.severity_index.values
+    # get_optimal_breaks only returns up to one class per unique value.
+    num_uniq_si = np.unique(si_values[np.isfinite(si_values)]).size
+    if num_uniq_si < 2:
+        raise ValueError(
+            f"Need at least 2 unique severity index values to cluster; got "
+            f"{num_uniq_si}."
+        )
+    if n_clusters > num_uniq_si:
+        print(
+            f"Only {num_uniq_si} unique severity index values; using {num_uniq_si} "
+            f"clusters instead of {n_clusters}."
+        )
+        n_clusters = num_uniq_si
+    optimal_breaks_si = get_optimal_breaks(si_values, max_k=n_clusters)
+    colors = sns.color_palette("bright", n_clusters)
+    centroids = optimal_breaks_si[n_clusters]["centers"]
+    Z = classify_by_breaks(si_values, optimal_breaks_si[n_clusters]["breaks"])
     fig_kmean_si_center, ax_kmean_si_center = plt.subplots()
     loc_y_centroid = plticker.MultipleLocator(
         base=2
@@ -152,19 +197,18 @@ def apply_kmeans_cluster_plot(crash_df_fil_si_geom_gdf_no_nan_):
     )
 
     # Plot each class as a separate colour
-    n_clusters = 2
     fig_kmean_si, ax_kmean_si = plt.subplots()
     for n in range(n_clusters):
         # Filter data points to plot each in turn.
-        ys = crash_aadt_fil_si_geom_gdf_no_nan.severity_index.values[Z == n]
-        xs = crash_aadt_fil_si_geom_gdf_no_nan.severity_index.index[Z == n]
+        ys = si_values[Z == n]
+        xs = crash_df_fil_si_geom_gdf_no_nan_.severity_index.index[Z == n]
         ax_kmean_si.scatter(xs, ys, color=colors[n])
         ax_kmean_si.yaxis.set_major_locator(loc_y_centroid)
     ax_kmean_si.set_title("Severity Index Points by Cluster")
     fig_kmean_si.savefig(
         fname=os.path.join(path_to_fig, "severity_index_points_kmeans_cluster.png")
     )
-    return 0
+    return optimal_breaks_si
 
 
 if __name__ == "__main__":
@@ -173,6 +217,9 @@ if __name__ == "__main__":
     path_processed_data = os.path.join(path_to_prj_dir, "data", "processed")
     path_crash_aadt_si = os.path.join(path_interim_data, "aadt_crash_ncdot.gpkg")
     path_to_fig = os.path.join(path_to_prj_dir, "reports", "figures")
+    path_distribution_summaries = os.path.join(
+        path_interim_data, "distribution_summaries"
+    )
     path_hpms_2018_nc_fil = os.path.join(
         path_interim_data, "nhs_hpms_2018_routes.csv"
     )
@@ -195,11 +242,13 @@ if __name__ == "__main__":
     crash_aadt_fil_si_geom_gdf_no_nan.severity_index.describe()
     quantile_90th_si = crash_aadt_fil_si_geom_gdf.severity_index.quantile(.90)
     plot_cdf_pdf(crash_aadt_fil_si_geom_gdf_no_nan,
-                 quantile_90th_=quantile_90th_si)
+                 quantile_90th_=quantile_90th_si,
+                 path_cache_dir_=path_distribution_summaries)
 
     plt.rcParams.update({'font.size': 14,
                          'xtick.labelsize':10})
-    plot_facet_cdf_pdf(crash_aadt_fil_si_geom_gdf_no_nan)
+    plot_facet_cdf_pdf(crash_aadt_fil_si_geom_gdf_no_nan,
+                       path_cache_dir_=path_distribution_summaries)
     plot_facet_cdf_pdf(
         crash_df_fil_si_geom_gdf_no_nan_=crash_aadt_fil_si_geom_gdf_no_nan,
         loc_x=LOC_X,
@@ -209,7 +258,8 @@ if __name__ == "__main__":
         title_="2015-2019 Severity Index CDF for Different Route Class",
         img_file_="severity_index_cdf_2015_2019_rt_cls_vary_scale",
         facet_col_="route_class",
-        sharex_=False)
+        sharex_=False,
+        path_cache_dir_=path_distribution_summaries)
 
     quantile_90th_inc_fac = crash_aadt_fil_si_geom_gdf.inc_fac.quantile(.90)
     crash_aadt_fil_si_geom_gdf.inc_fac.describe()
@@ -220,7 +270,8 @@ if __name__ == "__main__":
                  y_var="inc_fac",
                  y_label="Incident Factor",
                  title_="Incident Factor",
-                 img_file_="inc_fac_cdf")
+                 img_file_="inc_fac_cdf",
+                 path_cache_dir_=path_distribution_summaries)
 
     plot_facet_cdf_pdf(
         crash_df_fil_si_geom_gdf_no_nan_=crash_aadt_fil_si_geom_gdf_no_nan,
@@ -231,7 +282,8 @@ if __name__ == "__main__":
         title_="Incident Factor CDF for Different Route Class",
         img_file_="inc_fac_cdf_rt_cls",
         facet_col_="route_class",
-        sharex_=True
+        sharex_=True,
+        path_cache_dir_=path_distribution_summaries
     )
 
     apply_kmeans_cluster_plot(crash_aadt_fil_si_geom_gdf_no_nan)